@@ -0,0 +1,81 @@
+import logging
+import os
+import pysam
+from defaults import ALIGNMENT_DECODING_THREADS
+
+logger = logging.getLogger(__name__)
+
+# Alignment files opened by this process. A stage's pool workers run many tasks, so handles are kept open and the
+# header and index are only loaded once per worker and stage. Forked workers inherit the parent's registry but must
+# not share its file offsets, so handles are only reused by the process which opened them. Handles the parent opens
+# just to read a header are closed again before it forks the next pool.
+open_bams = {}
+
+# CRAMs are decoded against this reference. These are set once by the main process before the pools are created, so
+# the workers inherit them.
+alignment_reference = None
+alignment_decoding_threads = ALIGNMENT_DECODING_THREADS
+
+
+def set_alignment_options(reference=None, decoding_threads=ALIGNMENT_DECODING_THREADS):
+    global alignment_reference, alignment_decoding_threads
+    alignment_reference = reference
+    alignment_decoding_threads = decoding_threads
+
+
+def is_cram(bam):
+    return bam.endswith(".cram")
+
+
+def open_alignment_file(bam, reference=None, decoding_threads=1):
+    # CRAMs and multi-threaded decoding need the AlignmentFile interface of the newer pysam releases
+    if not hasattr(pysam, "AlignmentFile"):
+        if is_cram(bam):
+            raise Exception("Reading CRAM %s needs a pysam with CRAM support, this is pysam %s" % (
+                bam, getattr(pysam, "__version__", "unknown")))
+        if decoding_threads > 1:
+            logger.warn("Ignoring %d decoding threads for %s, not supported by this pysam" % (decoding_threads, bam))
+        return pysam.Samfile(bam, "rb")
+
+    kwargs_dict = {"reference_filename": reference} if reference and is_cram(bam) else {}
+    if decoding_threads > 1:
+        kwargs_dict["threads"] = decoding_threads
+    return pysam.AlignmentFile(bam, "rc" if is_cram(bam) else "rb", **kwargs_dict)
+
+
+def get_bam_handle(bam):
+    pid = os.getpid()
+    if open_bams.get(bam, (None, None))[0] != pid:
+        open_bams[bam] = (pid, open_alignment_file(bam, reference=alignment_reference,
+                                                   decoding_threads=alignment_decoding_threads))
+    return open_bams[bam][1]
+
+
+def get_bam_handles(bams):
+    return [get_bam_handle(bam) for bam in bams]
+
+
+def is_bam_handle_open(bam):
+    return open_bams.get(bam, (None, None))[0] == os.getpid()
+
+
+def close_bam_handle(bam):
+    # Handles inherited from the parent are only dropped from the registry, the parent still uses them
+    opener_pid, bam_handle = open_bams.pop(bam, (None, None))
+    if opener_pid == os.getpid():
+        bam_handle.close()
+
+
+def get_bam_contigs(bam):
+    # (name, length) of the contigs in header order. A handle opened just for this is closed again, one the
+    # caller already holds is left open.
+    was_open = is_bam_handle_open(bam)
+    bam_handle = get_bam_handle(bam)
+    contigs = zip(bam_handle.references, bam_handle.lengths)
+    if not was_open:
+        close_bam_handle(bam)
+    return contigs
+
+
+def get_bam_contig_lengths(bam):
+    return dict(get_bam_contigs(bam))
@@ -0,0 +1,215 @@
+import argparse
+import array
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import shutil
+import tempfile
+import traceback
+from functools import partial
+from defaults import *
+from library_stats import get_index_file
+from bam_utils import get_bam_handle, get_bam_contigs
+
+logger = logging.getLogger(__name__)
+
+# Binned read counts per contig, one flat file of unsigned 16-bit counts per contig and track. The files are
+# memory-mapped when read, so slicing a region only touches the pages it needs. Counts saturate at the type maximum.
+COVERAGE_PROFILE_SUFFIX = ".metasv_coverage"
+COVERAGE_PROFILE_VERSION = 1
+COVERAGE_TYPECODE = "H"
+COVERAGE_MAX_COUNT = 2 ** (8 * array.array(COVERAGE_TYPECODE).itemsize) - 1
+
+# "reads" counts the non-duplicate reads overlapping a bin and "very_good_reads" only the uniquely mapped ones with
+# few edits and little soft-clipping
+COVERAGE_TRACKS = ["reads", "very_good_reads"]
+
+
+def is_very_good_read(aln):
+    if aln.mapq < 20 or aln.cigar is None:
+        return False
+    try:
+        if int(aln.opt("NM")) >= 2:
+            return False
+    except KeyError:
+        return False
+    return sum([length for (op, length) in aln.cigar if op == 4]) <= 10
+
+
+def get_track_file(profile_dir, contig_index, track):
+    return os.path.join(profile_dir, "%d.%s.cov" % (contig_index, track))
+
+
+def build_contig_profile(bam, chrom, contig_index, contig_length, profile_dir, bin_size=COVERAGE_BIN_SIZE):
+    func_logger = logging.getLogger("%s-%s" % (build_contig_profile.__name__, multiprocessing.current_process()))
+
+    try:
+        num_bins = (contig_length + bin_size - 1) / bin_size
+        counts = array.array(COVERAGE_TYPECODE, [0]) * num_bins
+        very_good_counts = array.array(COVERAGE_TYPECODE, [0]) * num_bins
+
+        for aln in get_bam_handle(bam).fetch(chrom):
+            if aln.is_unmapped or aln.is_duplicate:
+                continue
+            very_good = is_very_good_read(aln)
+            for index in xrange(aln.pos / bin_size, min(num_bins, (max(aln.aend, aln.pos + 1) - 1) / bin_size + 1)):
+                if counts[index] < COVERAGE_MAX_COUNT:
+                    counts[index] += 1
+                if very_good and very_good_counts[index] < COVERAGE_MAX_COUNT:
+                    very_good_counts[index] += 1
+
+        for track, track_counts in zip(COVERAGE_TRACKS, [counts, very_good_counts]):
+            track_file = get_track_file(profile_dir, contig_index, track)
+            with open(track_file + ".tmp", "wb") as track_fd:
+                track_counts.tofile(track_fd)
+            os.rename(track_file + ".tmp", track_file)
+
+        func_logger.info("Built coverage profile for %s with %d bins" % (chrom, num_bins))
+        return chrom
+    except Exception as e:
+        func_logger.error('Caught exception in worker thread')
+
+        # This prints the type, value, and stack trace of the
+        # current exception being handled.
+        traceback.print_exc()
+
+        print()
+        raise e
+
+
+def build_contig_profile_callback(result, result_list):
+    if result is not None:
+        result_list.append(result)
+
+
+def get_coverage_profile(bam, profile_dir=None, chromosomes=[], bin_size=COVERAGE_BIN_SIZE, num_threads=1,
+                         fallback_dir=None):
+    func_logger = logging.getLogger(get_coverage_profile.__name__)
+
+    # The profile is kept next to the BAM by default and reused as long as the index and the binning don't change
+    profile_dir = profile_dir or (bam + COVERAGE_PROFILE_SUFFIX)
+    meta_file = os.path.join(profile_dir, "profile.json")
+
+    contigs = dict([(chrom, [index, length]) for index, (chrom, length) in enumerate(get_bam_contigs(bam)) if
+                    not chromosomes or chrom in chromosomes])
+
+    index_file = get_index_file(bam)
+    if index_file is None:
+        func_logger.error("BAM %s is not indexed, can't build the coverage profile" % bam)
+        return None
+    key = {"version": COVERAGE_PROFILE_VERSION, "index_mtime": os.path.getmtime(index_file), "bin_size": bin_size,
+           "typecode": COVERAGE_TYPECODE, "tracks": COVERAGE_TRACKS}
+
+    built_contigs = {}
+    if os.path.isfile(meta_file):
+        try:
+            with open(meta_file) as meta_fd:
+                meta = json.load(meta_fd)
+            if meta.get("key") == key:
+                built_contigs = meta["contigs"]
+        except (IOError, ValueError):
+            func_logger.warn("Ignoring unreadable coverage profile %s" % meta_file)
+
+    is_temporary = False
+    missing_contigs = [chrom for chrom in contigs if chrom not in built_contigs]
+    if missing_contigs:
+        # BAMs in read-only locations get their profile built in a temporary directory under fallback_dir instead,
+        # without caching. The directory is removed when the profile is closed.
+        try:
+            if not os.path.isdir(profile_dir):
+                os.makedirs(profile_dir)
+            if not os.access(profile_dir, os.W_OK):
+                raise OSError("%s is not writable" % profile_dir)
+        except OSError as e:
+            temp_profile_dir = tempfile.mkdtemp(prefix="metasv_coverage.", dir=fallback_dir)
+            func_logger.warn("Can't write the coverage profile to %s (%s), building it in %s instead" % (
+                profile_dir, str(e), temp_profile_dir))
+            profile_dir = temp_profile_dir
+            is_temporary = True
+            meta_file = os.path.join(profile_dir, "profile.json")
+            built_contigs = {}
+            missing_contigs = contigs.keys()
+
+        func_logger.info("Building coverage profile of %s for %d contigs in %s" % (bam, len(missing_contigs),
+                                                                                   profile_dir))
+
+        pool = multiprocessing.Pool(num_threads)
+        built_list = []
+        for chrom in missing_contigs:
+            contig_index, contig_length = contigs[chrom]
+            pool.apply_async(build_contig_profile, args=[bam, chrom, contig_index, contig_length, profile_dir],
+                             kwds={"bin_size": bin_size},
+                             callback=partial(build_contig_profile_callback, result_list=built_list))
+        pool.close()
+        pool.join()
+
+        if len(built_list) != len(missing_contigs):
+            func_logger.error("Coverage profile could not be built for all the contigs")
+            if is_temporary:
+                shutil.rmtree(profile_dir, ignore_errors=True)
+            return None
+
+        built_contigs.update(dict([(chrom, contigs[chrom]) for chrom in built_list]))
+        with open(meta_file + ".tmp", "w") as meta_fd:
+            json.dump({"key": key, "contigs": built_contigs}, meta_fd)
+        os.rename(meta_file + ".tmp", meta_file)
+
+    return CoverageProfile(profile_dir, is_temporary=is_temporary)
+
+
+class CoverageProfile:
+    def __init__(self, profile_dir, is_temporary=False):
+        with open(os.path.join(profile_dir, "profile.json")) as meta_fd:
+            meta = json.load(meta_fd)
+        self.profile_dir = profile_dir
+        self.is_temporary = is_temporary
+        self.bin_size = meta["key"]["bin_size"]
+        self.contigs = dict([(str(chrom), tuple(contig)) for chrom, contig in meta["contigs"].items()])
+        self.maps = {}
+
+    def get_map(self, chrom, track):
+        if (chrom, track) not in self.maps:
+            contig_index, contig_length = self.contigs[chrom]
+            with open(get_track_file(self.profile_dir, contig_index, track), "rb") as track_fd:
+                self.maps[(chrom, track)] = mmap.mmap(track_fd.fileno(), 0, access=mmap.ACCESS_READ) if \
+                    contig_length else ""
+        return self.maps[(chrom, track)]
+
+    def bins(self, chrom, start, end, track="reads"):
+        # Counts of the bins overlapping [start, end), at least one bin even for an empty region
+        track_map = self.get_map(str(chrom), track)
+        itemsize = array.array(COVERAGE_TYPECODE).itemsize
+        num_bins = len(track_map) / itemsize
+        first_bin = min(max(0, start / self.bin_size), max(0, num_bins - 1))
+        last_bin = min(max(first_bin, (end - 1) / self.bin_size), num_bins - 1)
+        return array.array(COVERAGE_TYPECODE, track_map[first_bin * itemsize:(last_bin + 1) * itemsize])
+
+    def close(self):
+        for track_map in self.maps.values():
+            if track_map:
+                track_map.close()
+        self.maps = {}
+        if self.is_temporary:
+            shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    FORMAT = '%(levelname)s %(asctime)-15s %(name)-20s %(message)s'
+    logging.basicConfig(level=logging.INFO, format=FORMAT)
+
+    parser = argparse.ArgumentParser(description="Build the binned coverage profile of an indexed BAM",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--bam", help="Indexed BAM", required=True)
+    parser.add_argument("--profile_dir", help="Directory for the profile, next to the BAM by default")
+    parser.add_argument("--chromosomes", nargs="+", help="Chromosomes to profile", default=[])
+    parser.add_argument("--bin_size", type=int, help="Bin size", default=COVERAGE_BIN_SIZE)
+    parser.add_argument("--num_threads", type=int, help="Number of threads to use", default=1)
+
+    args = parser.parse_args()
+
+    profile = get_coverage_profile(args.bam, profile_dir=args.profile_dir, chromosomes=args.chromosomes,
+                                   bin_size=args.bin_size, num_threads=args.num_threads)
+    if profile is not None:
+        profile.close()
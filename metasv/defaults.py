@@ -29,6 +29,7 @@ SC_MIN_AVG_BASE_QUAL = 20
 SC_MIN_MAPQ = 5
 SC_MAX_NM = 10
 SC_MIN_MATCHES = 50
+SC_TILE_SIZE = 5000000
 
 
 ISIZE_MIN = 250
@@ -36,11 +37,17 @@ ISIZE_MAX = 450
 ISIZE_MEAN = 350.0
 ISIZE_SD = 50.0
 
+# For estimating the library statistics from the BAMs
+LIBRARY_STATS_NUM_LOCI = 1000
+LIBRARY_STATS_MIN_MAPQ = 20
+COVERAGE_BIN_SIZE = 50
+
 # For assembly read-extraction
 EXTRACTION_MAX_READ_PAIRS = 10000
 EXTRACTION_MAX_NM = 5
 EXTRACTION_MAX_INTERVAL_TRUNCATION = 10000
 EXTRACTION_TRUNCATION_PAD = 4000
+EXTRACTION_MATE_MERGE_DIST = 1000
 
 # For running SPAdes
 ASSEMBLY_MAX_TOOLS = 1
@@ -51,6 +58,7 @@ SPADES_MAX_INTERVAL_SIZE_2BP = 1000000
 
 # For running AGE
 AGE_TIMEOUT = 300  # in seconds
+AGE_PROCS_PER_THREAD = 2
 AGE_MIN_CONTIG_LENGTH = 200
 AGE_PAD = 500
 AGE_MAX_REGION_LENGTH = 1000000
@@ -64,4 +72,11 @@ AGE_DIST_TO_EXP_BP_INS = 25
 
 # For genotyping
 GT_WINDOW = 100
-GT_NORMAL_FRAC = 0.05
\ No newline at end of file
+GT_ERROR_RATE = 0.05
+GT_SHARDS_PER_THREAD = 8
+GT_MIN_SOFT_CLIP = 20
+GT_BREAKPOINT_TOLERANCE = 20
+GT_MAX_GQ = 99
+
+# For reading the alignments
+ALIGNMENT_DECODING_THREADS = 1
\ No newline at end of file
@@ -31,6 +31,60 @@ class TimedExternalCmd:
         retcode = self.p.returncode
         self.logger.info("Returned code %d (%g seconds)" % (retcode, time.time() - start_time))
         return retcode
+    # Non-blocking alternative to run(), the timeout is enforced whenever poll() is called
+    def start(self, cmd_log_fd_out=None, cmd_log_fd_err=None, timeout=None):
+        self.logger.info("Starting %s with arguments %s" % (self.cmd[0].upper(), str(self.cmd[1::])))
+        cmd_log_fd_err = cmd_log_fd_err or cmd_log_fd_out
+        self.p = subprocess.Popen(self.cmd, stderr=cmd_log_fd_err, stdout=cmd_log_fd_out)
+        self.start_time = time.time()
+        self.timeout = timeout
+    def poll(self):
+        if self.p.poll() is None:
+            if not self.timeout or time.time() - self.start_time <= self.timeout:
+                return False
+            self.enforce_timeout()
+            self.p.wait()
+        return True
+    def get_retcode(self):
+        if self.did_timeout:
+            self.logger.error("Timed out after %d seconds", self.timeout)
+            return None
+        retcode = self.p.returncode
+        self.logger.info("Returned code %d (%g seconds)" % (retcode, time.time() - self.start_time))
+        return retcode
+
+
+class TimedExternalCmdPool:
+    # Keeps up to max_running commands going at once. Jobs are pulled lazily from an iterable of
+    # (tag, TimedExternalCmd, start kwargs) and (tag, command, return code) is yielded as each one finishes.
+    def __init__(self, max_running=1, poll_interval=0.01):
+        self.max_running = max(1, max_running)
+        self.poll_interval = poll_interval
+    def run(self, jobs):
+        jobs = iter(jobs)
+        running = []
+        jobs_left = True
+        while True:
+            while jobs_left and len(running) < self.max_running:
+                try:
+                    tag, cmd, start_kwargs = next(jobs)
+                except StopIteration:
+                    jobs_left = False
+                    break
+                cmd.start(**start_kwargs)
+                running.append((tag, cmd))
+            if not running:
+                return
+            finished = []
+            still_running = []
+            for tag, cmd in running:
+                (finished if cmd.poll() else still_running).append((tag, cmd))
+            running = still_running
+            if not finished:
+                time.sleep(self.poll_interval)
+                continue
+            for tag, cmd in finished:
+                yield tag, cmd, cmd.get_retcode()
 
 
 class TestTimedExternalCmd(unittest.TestCase):
@@ -63,6 +117,25 @@ class TestTimedExternalCmd(unittest.TestCase):
         self.assertIsNot(retcode, 0)
         return
 
+    def test_pool_run(self):
+        start_tick = time.time()
+        jobs = [(i, TimedExternalCmd("sleep 1", self.logger), {"timeout": 2}) for i in xrange(4)]
+        results = list(TimedExternalCmdPool(max_running=4).run(jobs))
+        run_time = time.time() - start_tick
+        self.assertEqual(sorted([tag for tag, cmd, retcode in results]), range(4))
+        self.assertEqual([retcode for tag, cmd, retcode in results], [0] * 4)
+        self.assertAlmostEqual(run_time, 1, delta=0.2)
+        return
+
+    def test_pool_timeout(self):
+        jobs = [(0, TimedExternalCmd("sleep 2", self.logger), {"timeout": 1}),
+                (1, TimedExternalCmd("sleep 0", self.logger), {"timeout": 1})]
+        results = dict([(tag, (cmd, retcode)) for tag, cmd, retcode in TimedExternalCmdPool(max_running=1).run(jobs)])
+        self.assertTrue(results[0][0].did_timeout)
+        self.assertIsNone(results[0][1])
+        self.assertEqual(results[1][1], 0)
+        return
+
     logger = None
 
 
@@ -3,9 +3,10 @@ import logging
 import multiprocessing
 import time
 from functools import partial, update_wrapper
-from defaults import EXTRACTION_MAX_READ_PAIRS, EXTRACTION_MAX_NM, EXTRACTION_MAX_INTERVAL_TRUNCATION, EXTRACTION_TRUNCATION_PAD
+from defaults import EXTRACTION_MAX_READ_PAIRS, EXTRACTION_MAX_NM, EXTRACTION_MAX_INTERVAL_TRUNCATION, EXTRACTION_TRUNCATION_PAD, \
+    EXTRACTION_MATE_MERGE_DIST
 
-import pysam
+from bam_utils import get_bam_handles
 
 compl_table = [chr(i) for i in xrange(256)]
 compl_table[ord('A')] = 'T'
@@ -69,16 +70,37 @@ def discordant_with_normal_orientation(aln, mate, chr_tid, chr_start, chr_end, i
     if aln.is_reverse and mate.is_reverse or not aln.is_reverse and not mate.is_reverse: return False
     return not (isize_min <= abs(aln.tlen) <= isize_max)
 
-def get_mate(aln, bam_handles):
-    mate = None
+def get_mates(alns, bam_handles, merge_dist=EXTRACTION_MATE_MERGE_DIST):
+    # Resolve the mates of many reads at once. The mate positions are sorted and close ones are merged into a
+    # few windows, each fetched once, instead of one mate() seek per read. BAMs are tried in order and the first
+    # one holding a read's mate wins.
+    wanted = {}
+    for aln in alns:
+        if aln.rnext < 0:
+            continue
+        wanted[(aln.qname, not aln.is_read1)] = (aln.rnext, aln.pnext)
+
+    mates = {}
     for bam_handle in bam_handles:
-        try:
-            mate = bam_handle.mate(aln)
-        except ValueError:
-            pass
-        if mate is not None:
-            return mate
-    return mate
+        if not wanted:
+            break
+        windows = []
+        for tid, pnext in sorted(set(wanted.values())):
+            if windows and windows[-1][0] == tid and pnext - windows[-1][2] <= merge_dist:
+                windows[-1][2] = pnext + 1
+            else:
+                windows.append([tid, pnext, pnext + 1])
+
+        for tid, start, end in windows:
+            for mate in bam_handle.fetch(bam_handle.getrname(tid), start=start, end=end):
+                # Skip secondary and supplementary alignments
+                if mate.flag & 0x900:
+                    continue
+                key = (mate.qname, mate.is_read1)
+                if key in wanted and wanted[key] == (mate.tid, mate.pos):
+                    mates[key] = mate
+                    del wanted[key]
+    return mates
 
 
 def extract_read_pairs(bam_handles, region, prefix, extract_fns, pad=0, max_read_pairs = EXTRACTION_MAX_READ_PAIRS,
@@ -121,10 +143,14 @@ def extract_read_pairs(bam_handles, region, prefix, extract_fns, pad=0, max_read
     aln_pairs = []
     if len(aln_dict) <= max_read_pairs:
         logger.info("Building mate dictionary from %d reads" % len(aln_list))
+        mates = get_mates([aln_pair[0] if aln_pair[0] is not None else aln_pair[1] for aln_pair in aln_dict.values()
+                           if None in aln_pair],
+                          bam_handles)
+        logger.info("Found %d mates outside the region" % len(mates))
         for aln_pair in aln_dict.values():
             missing_index = 0 if aln_pair[0] is None else (1 if aln_pair[1] is None else 2)
             if missing_index < 2:
-                mate = get_mate(aln_pair[1 - missing_index], bam_handles)
+                mate = mates.get((aln_pair[1 - missing_index].qname, missing_index == 0))
                 if mate is not None:
                     aln_pair[missing_index] = mate
                     aln_pairs.append(aln_pair)
@@ -182,7 +208,7 @@ if __name__ == "__main__":
         extract_fn = partial(discordant, isize_min=args.isize_min, isize_max=args.isize_max)
         update_wrapper(extract_fn, discordant)
 
-    bam_handles = [pysam.Samfile(bam, "rb") for bam in args.bams]
+    bam_handles = get_bam_handles(args.bams)
 
     extract_read_pairs(bam_handles, args.region, args.prefix, [extract_fn], pad=args.pad,
                        max_read_pairs=args.max_read_pairs)
@@ -1,3 +1,4 @@
+import mmap
 import os
 
 
@@ -18,3 +19,39 @@ def get_contigs(reference):
                 name = name.split(" ")[0]
                 contigs.append(Contig(name, int(length)))
     return contigs
+
+
+class SharedSequences:
+    # Sequences packed back to back into one anonymous shared memory map with an offset index. Processes forked
+    # after it's built, like pool workers, read the same pages instead of going back to the FASTA files. The layout
+    # comes from the (key, length) list, so the sequences can be stored one at a time as they're read. fetch()
+    # returns a copy of just the sequence asked for.
+    def __init__(self, lengths):
+        self.index = {}
+        offset = 0
+        for key, length in lengths:
+            self.index[key] = (offset, length)
+            offset += length
+        self.buffer = mmap.mmap(-1, max(1, offset))
+
+    def store(self, key, sequence):
+        # A sequence not matching its expected length is dropped from the index, the caller reads it elsewhere
+        offset, length = self.index[key]
+        if len(sequence) != length:
+            del self.index[key]
+            return False
+        self.buffer[offset:offset + length] = sequence
+        return True
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def fetch(self, key):
+        offset, length = self.index[key]
+        return self.buffer[offset:offset + length]
+
+    def size(self):
+        return sum([length for offset, length in self.index.values()])
@@ -3,8 +3,6 @@ import sys
 import datetime
 import os
 from collections import OrderedDict
-import json
-import base64
 import logging
 from functools import partial
 
@@ -12,6 +10,8 @@ import pybedtools
 import pysam
 import vcf
 import fasta_utils
+from info_utils import encode_info, decode_info
+from genotype import GT_FORMAT
 
 mydir = os.path.dirname(os.path.realpath(__file__))
 vcf_template = os.path.join(mydir, "resources/template.vcf")
@@ -23,8 +23,8 @@ def check_duplicates(interval1,interval2,max_dist=10):
        abs(interval1.end-interval2.end)>max_dist or \
        interval1.fields[3].split(",")[1] != interval2.fields[3].split(",")[1]:
         return None
-    info1=json.loads(base64.b64decode(interval1.fields[3].split(",")[0]))
-    info2=json.loads(base64.b64decode(interval2.fields[3].split(",")[0]))
+    info1=decode_info(interval1.fields[3].split(",")[0])
+    info2=decode_info(interval2.fields[3].split(",")[0])
     svmethods= sorted(list(set(info1["SVMETHOD"]+info2["SVMETHOD"])))
     sources = []
     if "SOURCES" in info1:
@@ -44,7 +44,7 @@ def check_duplicates(interval1,interval2,max_dist=10):
     info1.update(
         {"END": end, "SVMETHOD": svmethods, "NUM_SVMETHODS": len(svmethods)})
     return pybedtools.Interval(interval1.chrom, start,end, name="%s,%s,%d,%s" % (
-                               base64.b64encode(json.dumps(info1)), 
+                               encode_info(info1), 
                                info1["SVTYPE"], end-start,
                                ";".join(svmethods)), 
                                score = interval1.score, 
@@ -58,7 +58,7 @@ def get_interval_info(feature,pass_calls):
     pos = feature.start
     end = feature.end
     genotype = "./." if len(feature.fields) < 12 else feature.fields[11]
-    if genotype == "0/0":
+    if genotype.split(":")[0] == "0/0":
         func_logger.info("Skipping homozygous reference %s" % str(feature))
         return None
 
@@ -69,11 +69,11 @@ def get_interval_info(feature,pass_calls):
     sub_methods = [name.split(",")[3] for name in sub_names]
     svmethods = (";".join([name.split(",")[3] for name in sub_names])).split(";")
     try:
-        info = json.loads(base64.b64decode(name.split(",")[0]))
+        info = decode_info(name.split(",")[0])
     except TypeError:
         info = dict()
     if len(feature.fields) > 10:
-        info.update(json.loads(base64.b64decode(feature.fields[10])))
+        info.update(decode_info(feature.fields[10]))
     if feature.fields[9] != ".":
         info["INSERTION_SEQUENCE"] = feature.fields[9]
 
@@ -293,7 +293,7 @@ def merge_idp_itx(fasta_file,record_dup,records_del,del_pos,del_interval,score,s
     alt = [vcf.model._SV(svtype)]
     qual = "."
     sv_filter = ["PASS"] if "LowQual" not in score else ["LowQual"]
-    sv_format = "GT"
+    sv_format = record_dup.FORMAT
     sample_indexes = [0]
     vcf_record = vcf.model._Record(record_dup.CHROM, pos, sv_id, ref, alt, qual,
                                    sv_filter, info, sv_format, sample_indexes)
@@ -323,7 +323,7 @@ def merge_ctx(fasta_file,record_del,record_ins,score):
     alt = [vcf.model._SV("CTX")]
     qual = "."
     sv_filter = ["PASS"] if "LowQual" not in score else ["LowQual"]
-    sv_format = "GT"
+    sv_format = record_del.FORMAT
     sample_indexes = [0]
     vcf_record = vcf.model._Record(record_del.CHROM, pos, sv_id, ref, alt, qual,
                                    sv_filter, info, sv_format, sample_indexes)
@@ -435,7 +435,7 @@ def convert_metasv_bed_to_vcf(bedfile=None, vcf_out=None, workdir=None, vcf_temp
             if interval_info:
                 updated_interval = pybedtools.Interval(interval.chrom, interval_info["pos"], 
                                                        interval_info["end"], name="%s,%s,%d,%s" % (
-                                                       base64.b64encode(json.dumps(interval_info["info"])), 
+                                                       encode_info(interval_info["info"]), 
                                                        interval_info["sv_type"], interval_info["sv_length"],
                                                        ";".join(interval_info["svmethods"])), 
                                                        score = interval.score, 
@@ -479,7 +479,7 @@ def convert_metasv_bed_to_vcf(bedfile=None, vcf_out=None, workdir=None, vcf_temp
         bedtool = pybedtools.BedTool(filterd_bed)
         for interval in bedtool:
             name_split=interval.name.split(",")
-            info = json.loads(base64.b64decode(name_split[0]))
+            info = decode_info(name_split[0])
             sv_type = name_split[1]
             sv_id = "."
             ref = fasta_file.fetch(str(interval.chrom), interval.start, interval.start + 1) if fasta_file else "."
@@ -487,11 +487,12 @@ def convert_metasv_bed_to_vcf(bedfile=None, vcf_out=None, workdir=None, vcf_temp
             qual = "."
             sv_filter = [interval.fields[7]]
             genotype = interval.fields[6]
-            sv_format = "GT"
+            # Genotypes without the likelihoods, like ./. for ungenotyped calls, only fill in the leading fields
+            sv_format = ":".join(GT_FORMAT.split(":")[:len(genotype.split(":"))])
             sample_indexes = [0]
             vcf_record = vcf.model._Record(interval.chrom, interval.start, sv_id, ref, alt, qual,
                                            sv_filter, info, sv_format, sample_indexes)
-            vcf_record.samples = vcf_template_reader._parse_samples([genotype], "GT", vcf_record)
+            vcf_record.samples = vcf_template_reader._parse_samples([genotype], sv_format, vcf_record)
             vcf_records.append(vcf_record)
             
     if contigs:
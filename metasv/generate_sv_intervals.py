@@ -4,18 +4,25 @@ import argparse
 import multiprocessing
 import logging
 import collections
+import bisect
+import heapq
+import array
 import itertools
 import traceback
+import random
+import shutil
+import tempfile
+import unittest
 from functools import partial
-import json
-import base64
 import time
 
-import pysam
 import pybedtools
+import pysam
 
 from defaults import *
 from sv_interval import *
+from info_utils import encode_info, decode_info
+from bam_utils import get_bam_handle, get_bam_contig_lengths
 
 precise_methods = set(["AS", "SR", "JM"])
 
@@ -28,16 +35,35 @@ def concatenate_files(files, output):
                 outfile.write(infile.read())
 
 
+def analyze_cigar(cigar):
+    # Single pass over the CIGAR: number of soft-clips, length of the soft-clip, M and I bases before and
+    # after it and the total insertion length
+    num_soft_clips = 0
+    soft_clip = 0
+    dist_L_end = 0
+    dist_end = 0
+    ins_lengths = 0
+    for op, length in cigar:
+        if op == 4:
+            num_soft_clips += 1
+            soft_clip = length
+            dist_L_end = dist_end
+            dist_end = 0
+        elif op == 0:
+            dist_end += length
+        elif op == 1:
+            dist_end += length
+            ins_lengths += length
+    return num_soft_clips, soft_clip, dist_L_end, dist_end, ins_lengths
+
+
 def find_softclip(aln):
-    if aln.cigar is None:
+    cigar = aln.cigar
+    if cigar is None:
         return None
-    soft_clips = [(i, length) for i,(op, length) in enumerate(aln.cigar) if op == 4]
-    if len(soft_clips) != 1:
+    num_soft_clips, soft_clip, dist_L_end, dist_R_end, ins_lengths = analyze_cigar(cigar)
+    if num_soft_clips != 1:
         return None
-    
-    i, soft_clip = soft_clips[0]
-    dist_L_end = sum(map(lambda x:x[1] if x[0] in [0,1,4] else 0, aln.cigar[0:i]))
-    dist_R_end = sum(map(lambda x:x[1] if x[0] in [0,1,4] else 0, aln.cigar[i+1:]))
 
     return soft_clip, dist_L_end, dist_R_end
 
@@ -52,26 +78,22 @@ def is_good_candidate(aln, min_avg_base_qual=20, min_mapq=5, min_soft_clip=20, m
         return False
     if aln.mapq < min_mapq:
         return False
-    if aln.cigar is None:
+    cigar = aln.cigar
+    if cigar is None:
         return False
 
+    num_soft_clips, soft_clip, dist_L_end, dist_R_end, ins_lengths = analyze_cigar(cigar)
     if not good_neigh_check:
-        soft_clip_tuple = find_softclip(aln)
-        if not soft_clip_tuple:
+        if num_soft_clips != 1:
+            return False
+        if not (min_soft_clip <= soft_clip):
             return False
-        else:
-            soft_clip, dist_L_end, dist_R_end = soft_clip_tuple
-            if not (min_soft_clip <= soft_clip):
-                return False
     else:
         if skip_soft_clip:
-            soft_clip_tuple = find_softclip(aln)
-            if soft_clip_tuple:
-                if soft_clip_tuple[0] > min_soft_clip:
-                    return False
+            if num_soft_clips == 1 and soft_clip > min_soft_clip:
+                return False
     
             
-    ins_lengths = sum([0] + [length for (op, length) in aln.cigar if op == 1])
     mismatches = int(aln.opt("XM")) if "XM" in aln.tags else 0
     matches = aln.alen - ins_lengths - mismatches
     nm = int(aln.opt("NM"))
@@ -79,10 +101,10 @@ def is_good_candidate(aln, min_avg_base_qual=20, min_mapq=5, min_soft_clip=20, m
         return False
 
     if not good_neigh_check:
-        if aln.cigar[0][0] == 4:
-            avg_base_quality = float(sum(map(ord, aln.qual[:soft_clip]))) / soft_clip
+        if cigar[0][0] == 4:
+            avg_base_quality = float(sum(bytearray(aln.qual[:soft_clip]))) / soft_clip
         else:
-            avg_base_quality = float(sum(map(ord, aln.qual[-soft_clip:]))) / soft_clip
+            avg_base_quality = float(sum(bytearray(aln.qual[-soft_clip:]))) / soft_clip
 
         return avg_base_quality - 33 >= min_avg_base_qual
     else:
@@ -97,7 +119,7 @@ def get_interval(aln, pad=500):
     return max(0, end - pad), end + pad
 
 
-def merged_interval_features(feature, bam_handle,find_svtype=False):
+def merged_interval_features(feature, bam_handle,find_svtype=False, read_cache=None):
     support_list = feature.name.split(",")
     locations = sorted(map(int, support_list[0:-1:3]))
     other_bp_ends = support_list[-1] if not find_svtype else ','.join(support_list[1::3])
@@ -106,13 +128,13 @@ def merged_interval_features(feature, bam_handle,find_svtype=False):
     plus_support = len([i for i in support_list[2::3] if i == "+"])
     minus_support = len(locations) - plus_support
     locations_span = max(locations) - min(locations)
-    interval_readcount = bam_handle.count(reference=str(feature.chrom), start=feature.start, end=feature.end)
+    interval_readcount = count_reads(feature, bam_handle, read_cache=read_cache)
     info = {"SC_PLUS_SUPPORT":plus_support, "SC_MINUS_SUPPORT":minus_support, 
             "SC_LOCATIONS_SPAN":locations_span, "SC_NUM_UNIQUE_LOCATIONS":num_unique_locations,
             "SC_COUNT_STR": count_str, "SC_COVERAGE":interval_readcount, "SC_OTHER_BP_ENDS": other_bp_ends, 
             "SC_SC_BP_ENDS": "%s-%s"%(feature.start, feature.end)}
     name = "%s,%s,0,SC" % (
-        base64.b64encode(json.dumps(info)), feature.fields[6].split(',')[0])
+        encode_info(info), feature.fields[6].split(',')[0])
 
     return pybedtools.Interval(feature.chrom, feature.start, feature.end, name=name, score=feature.score,
                                otherfields=[str(interval_readcount)]+feature.fields[6:])
@@ -137,7 +159,7 @@ def add_other_bp_fields(feature,pad):
 
 def get_full_interval(feature,pad):
     name_fields = feature.name.split(",")
-    info = json.loads(base64.b64decode(name_fields[0]))
+    info = decode_info(name_fields[0])
     other_bp_ends=info["SC_OTHER_BP_ENDS"]
     start = feature.start
     end = feature.end
@@ -150,7 +172,7 @@ def get_full_interval(feature,pad):
 
     sv_len = 0 if sv_type == "INS" else max(end-start,0)
     info["SOURCES"] = "%s-%d-%s-%d-%d-SoftClip" % (feature.chrom, start, feature.chrom, end, sv_len)
-    name = "%s,%s,%d,%s"%(base64.b64encode(json.dumps(info)),sv_type,sv_len,'SC')
+    name = "%s,%s,%d,%s"%(encode_info(info),sv_type,sv_len,'SC')
     
     
     return pybedtools.Interval(feature.chrom, start, end, name=name, score=feature.score,
@@ -276,10 +298,23 @@ def check_overlap(start,end,chrom,interval,overlap_ratio=OVERLAP_RATIO):
     else:
         return False, start,end
 
+def sort_intervals(intervals):
+    return sorted(intervals, key=lambda x: (x.chrom, x.start, x.end))
+
+
+def each_interval(intervals, func):
+    # Same as BedTool.each: features for which func returns nothing are dropped
+    return [result for result in itertools.imap(func, intervals) if result]
+
+
+def cut_intervals(intervals, columns):
+    return [pybedtools.create_interval_from_list([interval.fields[i] for i in columns]) for interval in intervals]
+
+
 def blind_merge(intervals,cols,ops):
     func_logger = logging.getLogger("%s-%s" % (blind_merge.__name__, multiprocessing.current_process()))
     try:
-        columns=map(lambda x:int(x)+4,range(len(cols.split(","))))
+        columns=map(int,cols.split(",")) if cols else []
         operations=ops.split(',')    
         if columns and not operations:
             func_logger.error("Aborting!")
@@ -299,20 +334,21 @@ def blind_merge(intervals,cols,ops):
         start = intervals[0].start
         end = intervals[0].end
         chrom = intervals[0].chrom
-        other_fields = {c:[intervals[0].fields[c-1]] if c<=len(intervals[0].fields) else [""]  for c,o in column_operations.iteritems()}
-        for interval in intervals[1:]:
+        other_fields = {c:[] for c in column_operations}
+        for interval in intervals:
             start = min(start, int(interval.start))
             end = max(end, int(interval.end))
+            fields = interval.fields
             for c in column_operations: 
-                other_fields[c].append(interval.fields[c-1])
+                other_fields[c].append(fields[c-1] if c<=len(fields) else "")
         operation_function={"collapse":(lambda x: ",".join(x)), 
-                            "sum": "%s"%(lambda x:sum(map(lambda y:int(y) if y else 0,x))),
-                            "min": "%s"%(lambda x:min(map(lambda y:int(y) if y else 0,x))),
-                            "max": "%s"%(lambda x:max(map(lambda y:int(y) if y else 0,x))),
-                            "first": "%s"%(lambda x:x[0]),
-                            "last": "%s"%(lambda x:x[-1]),
+                            "sum": (lambda x:"%d" % sum(map(lambda y:int(y) if y else 0,x))),
+                            "min": (lambda x:"%d" % min(map(lambda y:int(y) if y else 0,x))),
+                            "max": (lambda x:"%d" % max(map(lambda y:int(y) if y else 0,x))),
+                            "first": (lambda x:x[0]),
+                            "last": (lambda x:x[-1]),
                             "distinct": (lambda x:",".join(set(x))),
-                            "count": (lambda x:len(x))}
+                            "count": (lambda x:"%d" % len(x))}
         for c,o in column_operations.iteritems():
             if o in operation_function:
                 other_fields[c] = operation_function[o](other_fields[c])
@@ -333,15 +369,28 @@ def blind_merge(intervals,cols,ops):
         print()
         raise e
 
-    
-def merge_intervals_bed(bedtool, overlap_ratio , c ,o):
-    bedtool=bedtool.sort().cut([0,1,2]+(map(lambda x: int(x)-1,c.split(',')) if c else []))
-    new_intervals = []
 
-    if bedtool.count()==0:
-        return bedtool
+def merge_bed_intervals(intervals, c, o, d=0):
+    # Same as bedtools merge -c c -o o -d d on sorted intervals: an interval joins the current cluster
+    # if it starts no more than d bases past the cluster end (negative d requires that much overlap)
+    clusters = []
+    cluster_end = None
+    for interval in intervals:
+        if clusters and clusters[-1][0].chrom == interval.chrom and interval.start - cluster_end <= d:
+            clusters[-1].append(interval)
+            cluster_end = max(cluster_end, interval.end)
+        else:
+            clusters.append([interval])
+            cluster_end = interval.end
+    return [blind_merge(cluster, c, o) for cluster in clusters]
 
-    intervals=[intv for intv in bedtool]
+
+def merge_intervals_bed(intervals, overlap_ratio , c ,o):
+    intervals = sort_intervals(intervals)
+    new_intervals = []
+
+    if not intervals:
+        return intervals
 
     current_merged_interval_list = [intervals[0]]
     start = intervals[0].start
@@ -362,27 +411,24 @@ def merge_intervals_bed(bedtool, overlap_ratio , c ,o):
             chrom = next_interval.chrom
 
     new_intervals.append(current_merged_interval_list)
-    merged_bed = pybedtools.BedTool([blind_merge(intervals,c,o) for intervals in new_intervals])
                                      
-    return merged_bed.sort()
+    return sort_intervals([blind_merge(intervals,c,o) for intervals in new_intervals])
 
-def merge_for_each_sv(bedtool,c,o,svs_to_softclip=SVS_SOFTCLIP_SUPPORTED,
+def merge_for_each_sv(intervals,c,o,svs_to_softclip=SVS_SOFTCLIP_SUPPORTED,
                       overlap_ratio=OVERLAP_RATIO,d=0, reciprocal_for_2bp=True,
                       sv_type_field = [3,1], inter_tools = False):
-    merged_bedtool = pybedtools.BedTool([])
+    intervals = list(intervals)
+    merged_intervals = []
     for svtype in svs_to_softclip:
-        sv_bedtool = bedtool.filter(lambda x: svtype in x.fields[sv_type_field[0]].split(',')[sv_type_field[1]]).sort()
-        if sv_bedtool.count()==0: continue
+        sv_intervals = sort_intervals([x for x in intervals if svtype in x.fields[sv_type_field[0]].split(',')[sv_type_field[1]]])
+        if not sv_intervals: continue
         if svtype == "INS" or not reciprocal_for_2bp:
-            sv_bedtool=sv_bedtool.merge(c=c, o=o, d=d)
+            sv_intervals = merge_bed_intervals(sv_intervals, c=c, o=o, d=d)
         else:
-            sv_bedtool = merge_intervals_bed(sv_bedtool,overlap_ratio=overlap_ratio,
+            sv_intervals = merge_intervals_bed(sv_intervals,overlap_ratio=overlap_ratio,
                                                   c=c,o=o)
-        if len(merged_bedtool) > 0:
-            merged_bedtool=sv_bedtool.cat(merged_bedtool,postmerge=False)
-        else:
-            merged_bedtool = sv_bedtool
-    return merged_bedtool.sort()
+        merged_intervals += sv_intervals
+    return sort_intervals(merged_intervals)
     
 
 def fix_merged_fields(feature,inter_tools=True):
@@ -398,7 +444,7 @@ def fix_merged_fields(feature,inter_tools=True):
         info["SC_SUBINTERVAL_INFOs"]=[]
     for i in range(n):    
         sub_interval=name_fields[i*4:(i+1)*4]
-        sub_info=json.loads(base64.b64decode(sub_interval[0]))
+        sub_info=decode_info(sub_interval[0])
         if not inter_tools:
             if "SC_SUBINTERVAL_INFOs" not in sub_info:
                 info["SC_SUBINTERVAL_INFOs"].append(sub_info)
@@ -435,7 +481,7 @@ def fix_merged_fields(feature,inter_tools=True):
     info["NUM_SVTOOLS"] = len(sv_tools)
     
     return pybedtools.Interval(feature.chrom, feature.start, feature.end, name="%s,%s,%d,%s" % (
-            base64.b64encode(json.dumps(info)), sv_type, sv_length,
+            encode_info(info), sv_type, sv_length,
             ";".join(sv_methods)),
             score = feature.score if not inter_tools else "%d"%len(sv_methods), otherfields=feature.fields[6:])
 
@@ -449,7 +495,7 @@ def fine_tune_bps(feature,pad):
     sv_length = int(name_fields[2])
     if sv_type  == "INS":
         return feature
-    info = json.loads(base64.b64decode(name_fields[0]))
+    info = decode_info(name_fields[0])
     if "SC_SUBINTERVAL_INFOs" in info:
         L_bps=[]
         R_bps=[]
@@ -465,7 +511,7 @@ def fine_tune_bps(feature,pad):
             R_bp=sum(map(lambda x:x[0],R_bps))/len(R_bps)
             sv_length = R_bp-L_bp
             return pybedtools.Interval(feature.chrom, L_bp, R_bp, name="%s,%s,%d,%s" % (
-                    base64.b64encode(json.dumps(info)), sv_type, sv_length,sv_methods),    score = feature.score , otherfields=feature.fields[6:])
+                    encode_info(info), sv_type, sv_length,sv_methods),    score = feature.score , otherfields=feature.fields[6:])
         elif L_bps or R_bps:
             return pybedtools.Interval(feature.chrom, feature.start, feature.end, name=feature.name,
                                        score = "-1", otherfields=feature.fields[6:])
@@ -479,7 +525,7 @@ def find_other_bp_interval(feature,pad):
     sv_type = name_fields[1]
     sv_methods = name_fields[3]
     sv_length = int(name_fields[2])
-    info = json.loads(base64.b64decode(name_fields[0]))
+    info = decode_info(name_fields[0])
 
     other_bps=map(lambda y: map(int,y['SC_OTHER_BP_ENDS'].split('-')),info["SC_SUBINTERVAL_INFOs"])
     start_interval=min(map(lambda x:x[0],other_bps))
@@ -517,14 +563,14 @@ def add_neighbour_support(feature,bam_handle, min_mapq=SC_MIN_MAPQ,
                       isize_mean=ISIZE_MEAN,
                       min_isize=ISIZE_MEAN-2*ISIZE_SD, max_isize=ISIZE_MEAN+2*ISIZE_SD, 
                       max_dist_sc= 250, max_dist_other_bp = 500, wiggle = 20, 
-                      mean_read_length = MEAN_READ_LENGTH, find_svtype=False):
+                      mean_read_length = MEAN_READ_LENGTH, find_svtype=False, read_cache=None):
     
     if not find_svtype:
         name_fields = feature.name.split(",")
         svtype = name_fields[1]
         sv_methods = name_fields[3]
         sv_length = int(name_fields[2])
-        info = json.loads(base64.b64decode(name_fields[0]))
+        info = decode_info(name_fields[0])
 
         other_bp_start, other_bp_end = map(int,info["SC_OTHER_BP_ENDS"].split('-'))
     else:
@@ -536,17 +582,11 @@ def add_neighbour_support(feature,bam_handle, min_mapq=SC_MIN_MAPQ,
     neigh_support_sv={k:[] for k in SVS_SOFTCLIP_SUPPORTED}
     chr2_count={}
     soft_clip_location = (feature.start+feature.end)/2
-    for aln in bam_handle.fetch(reference=str(feature.chrom), start=feature.start, end=feature.end):
+    for aln, svtype_neigh in get_neighbour_reads(feature, bam_handle, read_cache=read_cache, min_mapq=min_mapq,
+                                                 min_soft_clip=min_soft_clip, max_nm=max_nm, min_matches=min_matches,
+                                                 skip_soft_clip=skip_soft_clip, min_isize=min_isize,
+                                                 max_isize=max_isize):
         soft_clip_location = (feature.start+feature.end)/2        
-        if not is_good_candidate(aln, min_mapq=min_mapq,
-                                 min_soft_clip=min_soft_clip, max_nm=max_nm,
-                                 min_matches=min_matches,skip_soft_clip=skip_soft_clip, 
-                                 good_neigh_check= True): continue
-
-        svtype_neigh = infer_svtype(aln, min_isize, max_isize)
-        if svtype_neigh == "NONE":
-            continue
-        
         if svtype_neigh == "CTX;INS":
             # TODO : Should be fixed to handle CTX
             svtype_neigh = "INS"
@@ -598,7 +638,7 @@ def add_neighbour_support(feature,bam_handle, min_mapq=SC_MIN_MAPQ,
         if svtype == "INS": 
             chr2_str=",".join(map(lambda x: "%s;%d;%d;%d"%(x[0],len(x[1]),min(x[1]),max(x[1])+mean_read_length/2),chr2_count.items()))
             info.update({"SC_CHR2_STR": chr2_str})
-        name = "%s,%s,%d,%s"%(base64.b64encode(json.dumps(info)),svtype,sv_length,sv_methods)
+        name = "%s,%s,%d,%s"%(encode_info(info),svtype,sv_length,sv_methods)
         return pybedtools.Interval(feature.chrom, feature.start, feature.end, name=name, score=feature.score,
                                    otherfields=feature.fields[6:]+["%s;%s;%s"%(num_neigh_support,
                                                                                plus_support,
@@ -635,14 +675,14 @@ def filter_low_neigh_read_support(feature,thr_sv_abs,plus_minus_thr_scale,ls_sca
         return None
     return feature  
 
-def resolve_none_svs(bam_handle, workdir, unmerged_none_bed, min_mapq=SC_MIN_MAPQ,
+def resolve_none_svs(bam_handle, merged_none_intervals, min_mapq=SC_MIN_MAPQ,
                           min_soft_clip=SC_MIN_SOFT_CLIP, min_support_ins=MIN_SUPPORT_INS, 
                           min_support_frac_ins=MIN_SUPPORT_FRAC_INS, max_nm=SC_MAX_NM, min_matches=SC_MIN_MATCHES, 
                           isize_mean=ISIZE_MEAN, isize_sd=ISIZE_SD, svs_to_softclip=SVS_SOFTCLIP_SUPPORTED,
-                          merge_max_dist=-int(1*SC_PAD), mean_read_length=MEAN_READ_LENGTH, 
+                          mean_read_length=MEAN_READ_LENGTH, 
                           mean_read_coverage=MEAN_READ_COVERAGE,min_ins_cov_frac=MIN_INS_COVERAGE_FRAC, 
                           max_ins_cov_frac=MAX_INS_COVERAGE_FRAC,num_sd=2,plus_minus_thr_scale=0.4, 
-                          none_thr_scale=1.4, ls_scale=1.4, other_scale=1.4):
+                          none_thr_scale=1.4, ls_scale=1.4, other_scale=1.4, read_cache=None):
     func_logger = logging.getLogger("%s-%s" % (resolve_none_svs.__name__, multiprocessing.current_process()))
 
 
@@ -654,35 +694,28 @@ def resolve_none_svs(bam_handle, workdir, unmerged_none_bed, min_mapq=SC_MIN_MAP
     min_isize = isize_mean - num_sd * isize_sd
     max_isize = isize_mean + num_sd * isize_sd
 
-    bedtool_none=pybedtools.BedTool(unmerged_none_bed)
-    func_logger.info("%d unresolved intervals" % (bedtool_none.count()))        
-    merged_none_bed = os.path.join(workdir, "merged_none.bed")
-    bedtool_none=bedtool_none.merge(c="4,5,6,7",o="collapse,sum,collapse,collapse", d=merge_max_dist).sort().moveto(merged_none_bed)
-    func_logger.info("%d merged unresolved intervals" % (bedtool_none.count()))
+    # The NONE intervals come already merged from the scan, one cluster at a time
+    func_logger.debug("%d merged unresolved intervals" % (len(merged_none_intervals)))
 
-
-
-    filtered_none_bed = os.path.join(workdir, "filtered_none.bed")
-    bedtool_none = bedtool_none.filter(lambda x: int(x.score) >= 0).each(
-            partial(merged_interval_features, bam_handle=bam_handle,find_svtype=True)).moveto(
-    filtered_none_bed)
-    func_logger.info("%d filtered unresolved intervals" % (bedtool_none.count()))
+    none_intervals = each_interval(filter(lambda x: int(x.score) >= 0, merged_none_intervals),
+                                   partial(merged_interval_features, bam_handle=bam_handle,find_svtype=True,
+                                           read_cache=read_cache))
+    func_logger.debug("%d filtered unresolved intervals" % (len(none_intervals)))
 
     # Now filter based on coverage
-    coverage_filtered_none_bed = os.path.join(workdir, "coverage_filtered_none.bed")
-    bedtool_none = bedtool_none.filter(lambda x: (float(x.fields[6])/abs(x.start-x.end+1)*mean_read_length)<=(max_ins_cov_frac*mean_read_coverage)).moveto(coverage_filtered_none_bed)
-    func_logger.info("%d coverage filtered unresolved intervals" % (bedtool_none.count()))
+    none_intervals = filter(lambda x: (float(x.fields[6])/abs(x.start-x.end+1)*mean_read_length)<=(max_ins_cov_frac*mean_read_coverage), none_intervals)
+    func_logger.debug("%d coverage filtered unresolved intervals" % (len(none_intervals)))
 
     # Add number of neighbouring reads that support SC
-    bedtool_none=bedtool_none.each(partial(add_neighbour_support,bam_handle=bam_handle, min_mapq=min_mapq, 
+    none_intervals = sort_intervals(each_interval(none_intervals, partial(add_neighbour_support,bam_handle=bam_handle, min_mapq=min_mapq, 
                              min_soft_clip=min_soft_clip, max_nm=max_nm, min_matches=min_matches,
                              skip_soft_clip=False, isize_mean=isize_mean, min_isize=min_isize, 
                              max_isize=max_isize, mean_read_length=mean_read_length,
-                             find_svtype=True)).sort().moveto(coverage_filtered_none_bed)
-    func_logger.info("%d coverage filtered unresolved intervals" % (bedtool_none.count()))
+                             find_svtype=True, read_cache=read_cache)))
+    func_logger.debug("%d coverage filtered unresolved intervals" % (len(none_intervals)))
 
     resolved_intervals=[]
-    for interval in bedtool_none:
+    for interval in none_intervals:
         other_thr_scale=1 if "NONE" in interval.fields[7] else other_scale
         for svs in interval.fields[8].split(","):
             svs_fields=svs.split(";")
@@ -712,12 +745,9 @@ def resolve_none_svs(bam_handle, workdir, unmerged_none_bed, min_mapq=SC_MIN_MAP
                 name = "%d,%s,%s" % (soft_clip_location, other_bp, strand)
                 resolved_intervals.append(pybedtools.Interval(interval.chrom,interval.start, interval.end, 
                                                               name=name, score="1", strand=strand, otherfields=[svtype]))
-    if not resolved_intervals:
-        return None
-    resolved_none_bed = os.path.join(workdir, "resolved_none.bed")
-    bedtool_none = pybedtools.BedTool(resolved_intervals).sort().moveto(resolved_none_bed)
-    func_logger.info("%d resolved intervals" % (bedtool_none.count()))
-    return resolved_none_bed
+    resolved_intervals = sort_intervals(resolved_intervals)
+    func_logger.debug("%d resolved intervals" % (len(resolved_intervals)))
+    return resolved_intervals
 
 
 def get_bp_intervals(skip_bed,workdir,assembly_max_tools=ASSEMBLY_MAX_TOOLS,pad=SC_PAD):
@@ -733,7 +763,7 @@ def get_bp_intervals(skip_bed,workdir,assembly_max_tools=ASSEMBLY_MAX_TOOLS,pad=
         sv_methods = name_fields[3]
         sv_length = int(name_fields[2])
         chromosome = interval.chrom
-        info = json.loads(base64.b64decode(name_fields[0]))    
+        info = decode_info(name_fields[0])    
 
         methods = set(sv_methods.split(";"))
         num_tools = int(info.get("NUM_SVTOOLS", 1))
@@ -772,6 +802,312 @@ def get_bp_intervals(skip_bed,workdir,assembly_max_tools=ASSEMBLY_MAX_TOOLS,pad=
         
     
 
+class NeighbourRead(object):
+    # Just the alignment fields which add_neighbour_support and the functions it calls look at
+    __slots__ = ["pos", "aend", "pnext", "tlen", "rlen", "tid", "rnext", "is_reverse", "mate_is_unmapped", "cigar"]
+
+    def __init__(self, aln):
+        for attr in NeighbourRead.__slots__:
+            setattr(self, attr, getattr(aln, attr))
+
+
+class ReadCache:
+    # Reads seen while scanning a region, kept so that the per-interval read counts and neighbour support
+    # queries inside the region don't have to go back to the BAM. Neighbour reads are the ones which pass
+    # the good_neigh_check filter with the given thresholds and have an inferred SV type. Reads which no
+    # query still to come can overlap are evicted as the scan moves on.
+    def __init__(self, chrom, start=None, end=None, min_mapq=SC_MIN_MAPQ, min_soft_clip=SC_MIN_SOFT_CLIP,
+                 max_nm=SC_MAX_NM, min_matches=SC_MIN_MATCHES, min_isize=ISIZE_MEAN - 2 * ISIZE_SD,
+                 max_isize=ISIZE_MEAN + 2 * ISIZE_SD):
+        self.chrom = chrom
+        self.start = start if start is not None else 0
+        self.end = end
+        self.min_mapq = min_mapq
+        self.min_soft_clip = min_soft_clip
+        self.max_nm = max_nm
+        self.min_matches = min_matches
+        self.min_isize = min_isize
+        self.max_isize = max_isize
+
+        self.read_starts = array.array("i")
+        self.read_ends = array.array("i")
+        self.max_read_span = 0
+        self.neighbour_starts = array.array("i")
+        self.neighbour_ends = array.array("i")
+        self.neighbour_reads = []
+        self.max_neighbour_span = 0
+
+    def __len__(self):
+        return len(self.read_starts)
+
+    def add(self, aln):
+        # Same end position as the BAM index uses for overlap queries
+        read_end = aln.pos + 1 if aln.is_unmapped or aln.aend is None else max(aln.aend, aln.pos + 1)
+        self.read_starts.append(aln.pos)
+        self.read_ends.append(read_end)
+        self.max_read_span = max(self.max_read_span, read_end - aln.pos)
+
+        svtype = infer_svtype(aln, self.min_isize, self.max_isize)
+        if svtype == "NONE" or not is_good_candidate(aln, min_mapq=self.min_mapq, min_soft_clip=self.min_soft_clip,
+                                                     max_nm=self.max_nm, min_matches=self.min_matches,
+                                                     good_neigh_check=True):
+            return
+        self.neighbour_starts.append(aln.pos)
+        self.neighbour_ends.append(read_end)
+        self.neighbour_reads.append((NeighbourRead(aln), svtype))
+        self.max_neighbour_span = max(self.max_neighbour_span, read_end - aln.pos)
+
+    def evict(self, start):
+        # Drops the reads ending before start. Later queries starting before start go back to the BAM.
+        if start <= self.start:
+            return
+        self.start = start
+        num_reads = bisect.bisect_left(self.read_starts, start - self.max_read_span)
+        del self.read_starts[:num_reads]
+        del self.read_ends[:num_reads]
+        num_neighbours = bisect.bisect_left(self.neighbour_starts, start - self.max_neighbour_span)
+        del self.neighbour_starts[:num_neighbours]
+        del self.neighbour_ends[:num_neighbours]
+        del self.neighbour_reads[:num_neighbours]
+
+    def covers(self, chrom, start, end):
+        return chrom == self.chrom and self.start <= start and (self.end is None or end <= self.end)
+
+    def count(self, start, end):
+        lo = bisect.bisect_right(self.read_starts, start - self.max_read_span)
+        hi = bisect.bisect_left(self.read_starts, end)
+        return sum(1 for i in xrange(lo, hi) if self.read_ends[i] > start)
+
+    def fetch_neighbours(self, start, end):
+        lo = bisect.bisect_right(self.neighbour_starts, start - self.max_neighbour_span)
+        hi = bisect.bisect_left(self.neighbour_starts, end)
+        return [self.neighbour_reads[i] for i in xrange(lo, hi) if self.neighbour_ends[i] > start]
+
+
+def get_neighbour_reads(feature, bam_handle, read_cache=None, min_mapq=SC_MIN_MAPQ, min_soft_clip=SC_MIN_SOFT_CLIP,
+                        max_nm=SC_MAX_NM, min_matches=SC_MIN_MATCHES, skip_soft_clip=False,
+                        min_isize=ISIZE_MEAN - 2 * ISIZE_SD, max_isize=ISIZE_MEAN + 2 * ISIZE_SD):
+    if read_cache is not None and not skip_soft_clip and read_cache.covers(str(feature.chrom), feature.start,
+                                                                           feature.end):
+        return read_cache.fetch_neighbours(feature.start, feature.end)
+
+    neighbours = []
+    for aln in bam_handle.fetch(reference=str(feature.chrom), start=feature.start, end=feature.end):
+        if not is_good_candidate(aln, min_mapq=min_mapq,
+                                 min_soft_clip=min_soft_clip, max_nm=max_nm,
+                                 min_matches=min_matches,skip_soft_clip=skip_soft_clip, 
+                                 good_neigh_check= True): continue
+        svtype_neigh = infer_svtype(aln, min_isize, max_isize)
+        if svtype_neigh == "NONE":
+            continue
+        neighbours.append((aln, svtype_neigh))
+    return neighbours
+
+
+def count_reads(feature, bam_handle, read_cache=None):
+    if read_cache is not None and read_cache.covers(str(feature.chrom), feature.start, feature.end):
+        return read_cache.count(feature.start, feature.end)
+    return bam_handle.count(reference=str(feature.chrom), start=feature.start, end=feature.end)
+
+
+def is_reciprocal_overlap(start, end, other_start, other_end, overlap_ratio):
+    overlap_length = min(end, other_end) - max(start, other_start)
+    return overlap_length > 0 and overlap_length >= overlap_ratio * (end - start) and \
+           overlap_length >= overlap_ratio * (other_end - other_start)
+
+
+class SoftClipCluster(object):
+    # Candidate intervals merged as bedtools merge -c 4,5,6,7 -o collapse,sum,collapse,collapse would merge them.
+    # Every candidate interval has a score of 1, so the summed score is the number of members. The member
+    # coordinates are packed in arrays so that the cluster can still be split up again.
+    __slots__ = ["chrom", "start", "end", "first_seq", "names", "strands", "svtypes", "member_starts", "member_ends"]
+
+    def __init__(self, chrom, start, first_seq=0):
+        self.chrom = chrom
+        self.start = start
+        self.end = start
+        self.first_seq = first_seq
+        self.names = []
+        self.strands = []
+        self.svtypes = []
+        self.member_starts = array.array("i")
+        self.member_ends = array.array("i")
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, start, end, name, strand, svtype):
+        self.end = max(self.end, end)
+        self.names.append(name)
+        self.strands.append(strand)
+        self.svtypes.append(svtype)
+        self.member_starts.append(start)
+        self.member_ends.append(end)
+
+    def absorb(self, cluster):
+        self.end = max(self.end, cluster.end)
+        self.names += cluster.names
+        self.strands += cluster.strands
+        self.svtypes += cluster.svtypes
+        self.member_starts.extend(cluster.member_starts)
+        self.member_ends.extend(cluster.member_ends)
+
+    def members(self):
+        return zip(self.member_starts, self.member_ends, self.names, self.strands, self.svtypes)
+
+    def to_interval(self):
+        return pybedtools.Interval(self.chrom, self.start, self.end, name=",".join(self.names),
+                                   score="%d" % len(self.names), strand=",".join(self.strands),
+                                   otherfields=[",".join(self.svtypes)])
+
+    def member_intervals(self):
+        return [pybedtools.Interval(self.chrom, start, end, name=name, score="1", strand=strand, otherfields=[svtype])
+                for start, end, name, strand, svtype in self.members()]
+
+
+class SoftClipClusterer:
+    # Merges candidate intervals with bedtools merge -d semantics while the reads are being scanned. The reads
+    # come sorted by position but an interval can start up to pad bases before its read, so intervals are held
+    # back until the scan has moved far enough and are then merged in sorted order. Only the open cluster is
+    # kept, the closed ones are handed to on_close.
+    def __init__(self, chrom, on_close, d=0):
+        self.chrom = chrom
+        self.on_close = on_close
+        self.d = d
+        self.pending = []
+        self.num_added = 0
+        self.num_merged = 0
+        self.cluster = None
+
+    def add(self, start, end, name, strand, svtype, rank=0):
+        # Intervals with the same coordinates are merged by rank and then in the order they were added
+        heapq.heappush(self.pending, (start, end, rank, self.num_added, name, strand, svtype))
+        self.num_added += 1
+
+    def flush(self, min_start=None, keep=None):
+        # Merges the held back intervals which start before min_start, or all of them, and closes the open
+        # cluster once no interval starting at min_start or later can join it. Intervals for which keep
+        # returns False are dropped.
+        pending = self.pending
+        while pending and (min_start is None or pending[0][0] < min_start):
+            start, end, rank, seq, name, strand, svtype = heapq.heappop(pending)
+            if keep is not None and not keep(start, end, svtype):
+                continue
+            if self.cluster is None or start - self.cluster.end > self.d:
+                self.close_cluster()
+                self.cluster = SoftClipCluster(self.chrom, start, first_seq=self.num_merged)
+            self.cluster.add(start, end, name, strand, svtype)
+            self.num_merged += 1
+        if min_start is not None and self.cluster is not None and min_start - self.cluster.end > self.d:
+            self.close_cluster()
+
+    def close_cluster(self):
+        if self.cluster is not None:
+            cluster, self.cluster = self.cluster, None
+            self.on_close(cluster)
+
+    def close(self, keep=None):
+        self.flush(keep=keep)
+        self.close_cluster()
+
+    def get_min_start(self):
+        # No cluster closed from now on starts before this, apart from the ones of intervals not added yet
+        starts = [self.cluster.start] if self.cluster is not None else []
+        if self.pending:
+            starts.append(self.pending[0][0])
+        return min(starts) if starts else None
+
+
+def merge_into_clusters(clusters, intervals, chrom, d=0):
+    # Merges more (start, end, name, strand, svtype) intervals into the clusters of a clusterer, with the same
+    # result as if they had been clustered along with the rest. Clusters which one of the new intervals starts
+    # inside of are split back into their members, all the others are merged as a whole.
+    if not intervals:
+        return clusters
+    intervals = sorted(intervals, key=lambda x: (x[0], x[1]))
+    interval_starts = [interval[0] for interval in intervals]
+
+    # Same order as a stable sort of the original members followed by the new intervals
+    items = []
+    num_members = 0
+    for cluster in clusters:
+        i = bisect.bisect_left(interval_starts, cluster.start)
+        if i < len(interval_starts) and interval_starts[i] <= cluster.member_starts[-1]:
+            items += [((member[0], member[1], cluster.first_seq + j), member) for j, member in
+                      enumerate(cluster.members())]
+        else:
+            items.append(((cluster.start, cluster.member_ends[0], cluster.first_seq), cluster))
+        num_members = max(num_members, cluster.first_seq + len(cluster))
+    items += [((interval[0], interval[1], num_members + j), interval) for j, interval in enumerate(intervals)]
+    items.sort(key=lambda x: x[0])
+
+    merged_clusters = []
+    merged_cluster = None
+    for key, item in items:
+        if merged_cluster is None or key[0] - merged_cluster.end > d:
+            if merged_cluster is not None:
+                merged_clusters.append(merged_cluster)
+            merged_cluster = SoftClipCluster(chrom, key[0])
+        if isinstance(item, SoftClipCluster):
+            merged_cluster.absorb(item)
+        else:
+            merged_cluster.add(*item)
+    merged_clusters.append(merged_cluster)
+    return merged_clusters
+
+
+class SoftClipClusterBuffer:
+    # Closed clusters of one side and SV type and the resolved NONE intervals to merge into them, held until
+    # nothing which is still to come can join them
+    def __init__(self, chrom, d=0):
+        self.chrom = chrom
+        self.d = d
+        self.clusters = []
+        self.intervals = []
+
+    def add_cluster(self, cluster):
+        self.clusters.append(cluster)
+
+    def add_interval(self, start, end, name, strand, svtype):
+        self.intervals.append((start, end, name, strand, svtype))
+
+    def get_min_start(self):
+        starts = [cluster.start for cluster in self.clusters] + [interval[0] for interval in self.intervals]
+        return min(starts) if starts else None
+
+    def flush(self, min_start=None):
+        # The merged clusters which no cluster or interval starting at min_start or later can join, or all of them
+        if not self.clusters and not self.intervals:
+            return []
+        merged_clusters = merge_into_clusters(self.clusters, self.intervals, self.chrom, d=self.d)
+        if min_start is None:
+            self.clusters = []
+            self.intervals = []
+            return merged_clusters
+
+        done_clusters = list(itertools.takewhile(lambda x: min_start - x.end > self.d, merged_clusters))
+        if done_clusters:
+            if len(done_clusters) == len(merged_clusters):
+                self.clusters = []
+                self.intervals = []
+            else:
+                next_start = merged_clusters[len(done_clusters)].start
+                self.clusters = [cluster for cluster in self.clusters if cluster.start >= next_start]
+                self.intervals = [interval for interval in self.intervals if interval[0] >= next_start]
+        return done_clusters
+
+
+def get_sc_anchor(feature):
+    """Position of the soft-clip cluster of a full interval, used to assign it to one tile."""
+    info = decode_info(feature.name.split(",")[0])
+    return sum(map(int, info["SC_SC_BP_ENDS"].split("-"))) / 2
+
+
+def get_tiles(chromosome_length, tile_size=SC_TILE_SIZE):
+    if tile_size <= 0:
+        return [(None, None)]
+    return [(start, min(start + tile_size, chromosome_length)) for start in xrange(0, chromosome_length, tile_size)]
+
 
 def generate_sc_intervals(bam, chromosome, workdir, min_avg_base_qual=SC_MIN_AVG_BASE_QUAL, min_mapq=SC_MIN_MAPQ,
                           min_soft_clip=SC_MIN_SOFT_CLIP,
@@ -781,29 +1117,186 @@ def generate_sc_intervals(bam, chromosome, workdir, min_avg_base_qual=SC_MIN_AVG
                           overlap_ratio=OVERLAP_RATIO,merge_max_dist=-int(1*SC_PAD), 
                           mean_read_length=MEAN_READ_LENGTH, mean_read_coverage=MEAN_READ_COVERAGE, 
                           min_ins_cov_frac=MIN_INS_COVERAGE_FRAC, max_ins_cov_frac=MAX_INS_COVERAGE_FRAC,
-                          num_sd = 2, plus_minus_thr_scale=0.4, none_thr_scale=1.4, ls_scale=1.4, other_scale=1.4, unmerged_other_bed=None):
+                          num_sd = 2, plus_minus_thr_scale=0.4, none_thr_scale=1.4, ls_scale=1.4, other_scale=1.4, unmerged_other_bed=None,
+                          start=None, end=None):
     func_logger = logging.getLogger("%s-%s" % (generate_sc_intervals.__name__, multiprocessing.current_process()))
 
     if not os.path.isdir(workdir):
         func_logger.error("Working directory %s doesn't exist" % workdir)
         return None
 
-        
+    # Reads are scanned pad bases beyond the tile on both sides so that clusters near the tile edges are complete
+    region = chromosome if start is None else "%s:%d-%d" % (chromosome, start, end)
+    fetch_start = None if start is None else max(0, start - pad)
+    fetch_end = None if end is None else end + pad
 
-    func_logger.info("Generating candidate intervals from %s for chromsome %s" % (bam, chromosome))
+    func_logger.info("Generating candidate intervals from %s for region %s" % (bam, region))
     pybedtools.set_tempdir(workdir)
 
     
     min_isize = isize_mean - num_sd * isize_sd
     max_isize = isize_mean + num_sd * isize_sd
 
-    unmerged_intervals = []
     start_time = time.time()
     ignore_none = False
-    unmerged_none_intervals=[]
     try:
-        sam_file = pysam.Samfile(bam, "rb")
-        for aln in sam_file.fetch(reference=str(chromosome)):
+        sam_file = get_bam_handle(bam)
+        # Keep what the later stages need to know about the scanned reads, so that they don't fetch them again
+        read_cache = ReadCache(str(chromosome), fetch_start, fetch_end, min_mapq=min_mapq, min_soft_clip=min_soft_clip,
+                               max_nm=max_nm, min_matches=min_matches, min_isize=min_isize, max_isize=max_isize)
+
+        thr_sv={"INS":min_support_frac_ins, "INV":MIN_SUPPORT_FRAC_INV, 
+                "DEL":MIN_SUPPORT_FRAC_DEL, "DUP": MIN_SUPPORT_FRAC_DUP}
+
+        thr_sv_abs={"INS":min_support_ins, "INV":MIN_SUPPORT_INV, 
+                "DEL":MIN_SUPPORT_DEL, "DUP": MIN_SUPPORT_DUP}
+
+        # Candidate reads are clustered per side of the breakpoint and SV type while scanning. NONE reads and
+        # breakpoints from other methods which overlap a candidate read are dropped before they are clustered,
+        # so they are held back until no later candidate can overlap them (all these intervals span 2*pad).
+        # NONE clusters are resolved as they close. The candidate clusters are merged with the NONE reads
+        # resolved for them and turned into full intervals as soon as nothing still to come can join them, so
+        # only the full intervals are kept until the end.
+        candidate_clusterers = {}
+        cluster_buffers = {}
+        full_intervals = []
+        stats = collections.Counter()
+        candidate_window = []
+        num_candidates = 0
+        num_none = 0
+        num_other = 0
+
+        def get_cluster_buffer(key):
+            if key not in cluster_buffers:
+                cluster_buffers[key] = SoftClipClusterBuffer(chromosome, d=merge_max_dist)
+            return cluster_buffers[key]
+
+        def resolve_none_cluster(cluster):
+            stats["unresolved"] += len(cluster)
+            stats["other"] += cluster.svtypes.count("OTHERS")
+            for interval in resolve_none_svs(sam_file, [cluster.to_interval()],
+                                          min_mapq=min_mapq,
+                                          min_soft_clip=min_soft_clip, min_support_ins=min_support_ins, 
+                                          min_support_frac_ins=min_support_frac_ins, max_nm=max_nm, min_matches=min_matches, 
+                                          isize_mean=isize_mean, isize_sd=isize_sd, svs_to_softclip=svs_to_softclip,
+                                          mean_read_length=mean_read_length, 
+                                          mean_read_coverage=mean_read_coverage,min_ins_cov_frac=min_ins_cov_frac, 
+                                          max_ins_cov_frac=max_ins_cov_frac, num_sd=num_sd,
+                                          plus_minus_thr_scale=plus_minus_thr_scale, 
+                                          none_thr_scale=none_thr_scale, ls_scale=ls_scale, other_scale=other_scale,
+                                          read_cache=read_cache):
+                name_fields = interval.name.split(",")
+                side = "L" if int(name_fields[0]) <= int(name_fields[1]) else "R"
+                get_cluster_buffer((side, interval.fields[6])).add_interval(
+                    interval.start, interval.end, interval.name, interval.strand, interval.fields[6])
+                stats["resolved"] += 1
+
+        def add_full_intervals(cluster, side, svtype):
+            stats[side] += 1
+
+            # Check if the other break point also can be merged for the merged intervals (for 2bp SVs)
+            interval = cluster.to_interval()
+            if len(set(cluster.svtypes))!=1:
+                func_logger.warn("More than one svtypes: %s",(str(interval)))
+            bp_merged_intervals = [interval]
+            if svtype != "INS":
+                name_fields_0 = interval.name.split(',')
+                other_bps = map(lambda x:int(name_fields_0[3*x+1]), range(len(name_fields_0)/3))
+                if (min(other_bps)+2*pad-max(other_bps))<=(-merge_max_dist):
+                    member_intervals = cluster.member_intervals()
+                    other_bp_intervals=merge_bed_intervals(sort_intervals(each_interval(
+                        member_intervals, partial(generate_other_bp_interval,pad=pad))),
+                        c="4,5,6,7", o="collapse,sum,collapse,collapse", d=merge_max_dist)
+                    if len(other_bp_intervals)>1:
+                        bp_merged_intervals = []
+                        for intvl in other_bp_intervals:
+                            name_fields = intvl.name.split(',')
+                            names = set(",".join(name_fields[3*x:3*x+3]) for x in range(len(name_fields)/3))
+                            bp_merged_intervals.extend(merge_bed_intervals(sort_intervals(
+                                [x for x in member_intervals if x.name in names]),
+                                c="4,5,6,7", o="collapse,sum,collapse,collapse", d=merge_max_dist))
+
+            # Sorted at the end as if all the clusters had been merged at once, sides first and then SV types
+            order = ["L", "R"].index(side), cluster.start, cluster.end, list(svs_to_softclip).index(svtype)
+            for index, bp_interval in enumerate(bp_merged_intervals):
+                intervals = [add_other_bp_fields(bp_interval, pad=pad)]
+                stats["bp merged"] += len(intervals)
+
+                intervals = each_interval(filter(lambda x: int(x.score) >= 0, intervals),
+                                          partial(merged_interval_features, bam_handle=sam_file, read_cache=read_cache))
+                stats["filtered"] += len(intervals)
+
+                # Now filter based on coverage
+                intervals = filter(lambda x: (x.fields[3].split(",")[1]!="INS" or 
+                                              ((min_ins_cov_frac*mean_read_coverage)<=(float(x.fields[6])/abs(x.start-x.end+1)*mean_read_length)<=(max_ins_cov_frac*mean_read_coverage))), intervals)
+                stats["coverage filtered"] += len(intervals)
+
+                # Add number of neighbouring reads that support SC
+                intervals = each_interval(intervals, partial(add_neighbour_support,bam_handle=sam_file, min_mapq=min_mapq, 
+                                             min_soft_clip=min_soft_clip, max_nm=max_nm, min_matches=min_matches,
+                                             skip_soft_clip=False, isize_mean=isize_mean, min_isize=min_isize, 
+                                             max_isize=max_isize, mean_read_length=mean_read_length,
+                                             read_cache=read_cache))
+
+                intervals = each_interval(intervals, partial(filter_low_frac_support,thr_sv=thr_sv,
+                                          plus_minus_thr_scale=plus_minus_thr_scale,ls_scale=ls_scale))
+                intervals = each_interval(intervals, partial(filter_low_neigh_read_support,
+                                          thr_sv_abs=thr_sv_abs,
+                                          plus_minus_thr_scale=plus_minus_thr_scale,ls_scale=ls_scale))
+                stats["neighbour support filtered"] += len(intervals)
+
+                # For 2bp SVs, the interval will be the cover of two intervals on the BP
+                intervals = each_interval(intervals, partial(get_full_interval,pad=pad))
+                stats["full filtered"] += len(intervals)
+                full_intervals.extend(((x.start, x.end, bp_interval.start, bp_interval.end) + order + (index,), x)
+                                      for x in intervals)
+
+        def flush_cluster_buffers(min_start=None):
+            for (side, svtype), cluster_buffer in cluster_buffers.iteritems():
+                buffer_min_start = min_start
+                if min_start is not None:
+                    clusterers = [candidate_clusterers.get((side, svtype)), none_clusterer]
+                    buffer_min_start = min([min_start] + [x.get_min_start() for x in clusterers if
+                                                          x is not None and x.get_min_start() is not None])
+                for cluster in cluster_buffer.flush(buffer_min_start):
+                    add_full_intervals(cluster, side, svtype)
+
+        none_clusterer = SoftClipClusterer(chromosome, resolve_none_cluster, d=merge_max_dist)
+
+        if unmerged_other_bed:
+            func_logger.info("Gather intervals from breakpoints in other methods")
+            for x in pybedtools.BedTool(unmerged_other_bed):
+                if x.chrom == chromosome and (fetch_start is None or fetch_start <= x.start) and (
+                        fetch_end is None or x.start < fetch_end):
+                    none_clusterer.add(x.start, x.end, x.name, x.strand, x.fields[6], rank=1)
+                    num_other += 1
+            func_logger.info("%d bps in other methods" % num_other)
+
+        def keep_none(start, end, svtype):
+            overlap_ratio_ = min(0.5, overlap_ratio) if svtype == "OTHERS" else overlap_ratio
+            return not any(is_reciprocal_overlap(start, end, other_start, other_end, overlap_ratio_) for
+                           other_end, other_start in candidate_window)
+
+        # Intervals outside of the read cache go back to the BAM while the scan is still going on, so the scan
+        # iterates on its own copy of the file handle
+        next_flush = None
+        for aln in sam_file.fetch(reference=str(chromosome), start=fetch_start, end=fetch_end,
+                                  multiple_iterators=True):
+            read_cache.add(aln)
+            if next_flush is None or aln.pos >= next_flush:
+                for clusterer in candidate_clusterers.values():
+                    clusterer.flush(aln.pos - pad)
+                none_clusterer.flush(aln.pos - 3 * pad, keep=keep_none)
+                while candidate_window and candidate_window[0][0] <= aln.pos - 3 * pad:
+                    heapq.heappop(candidate_window)
+                # No interval of this read or a later one starts before aln.pos - pad
+                flush_cluster_buffers(aln.pos - pad)
+                # Nothing which is still to come queries the cache before the pending intervals and clusters
+                pending_starts = [x.get_min_start() for x in
+                                  candidate_clusterers.values() + cluster_buffers.values() + [none_clusterer]]
+                read_cache.evict(min([aln.pos - pad] + [x for x in pending_starts if x is not None]))
+                next_flush = aln.pos + pad
+
             if abs(aln.tlen) > max_considered_isize:
                 continue
             if not is_good_candidate(aln, min_avg_base_qual=min_avg_base_qual, min_mapq=min_mapq,
@@ -830,8 +1323,8 @@ def generate_sc_intervals(bam, chromosome, workdir, min_avg_base_qual=SC_MIN_AVG
             if svtype == "NONE":
                 if not ignore_none:
                     name = "%d,%d-%d-%d,%s" % (soft_clip_location, soft_clip, dist_L_end, dist_R_end,strand)
-                    unmerged_none_intervals.append(
-                        pybedtools.Interval(chromosome, interval[0], interval[1], name=name, score="1", strand=strand, otherfields=["NONE"]))
+                    none_clusterer.add(interval[0], interval[1], name, strand, "NONE")
+                    num_none += 1
                 continue
 
             other_bp = find_other_bp(aln,isize_mean, svtype, soft_clip, dist_L_end,
@@ -842,184 +1335,142 @@ def generate_sc_intervals(bam, chromosome, workdir, min_avg_base_qual=SC_MIN_AVG
             if svtype not in svs_to_softclip:
                 continue
 
-            unmerged_intervals.append(
-                pybedtools.Interval(chromosome, interval[0], interval[1], name=name, score="1", strand=strand, otherfields=[svtype]))
+            side = "L" if soft_clip_location <= other_bp else "R"
+            if (side, svtype) not in candidate_clusterers:
+                candidate_clusterers[(side, svtype)] = SoftClipClusterer(
+                    chromosome, get_cluster_buffer((side, svtype)).add_cluster, d=merge_max_dist)
+            candidate_clusterers[(side, svtype)].add(interval[0], interval[1], name, strand, svtype)
+            heapq.heappush(candidate_window, (interval[1], interval[0]))
+            num_candidates += 1
 
-        if not unmerged_intervals:
-            sam_file.close()
+        if not num_candidates:
             func_logger.warn("No intervals generated")
             return None
 
-        unmerged_bed = os.path.join(workdir, "unmerged.bed")
-        bedtool = pybedtools.BedTool(unmerged_intervals).sort().moveto(unmerged_bed)
-        func_logger.info("%d candidate reads" % (bedtool.count()))
+        none_clusterer.close(keep=keep_none)
+        for clusterer in candidate_clusterers.values():
+            clusterer.close()
+        flush_cluster_buffers()
+        func_logger.info("%d candidate reads" % num_candidates)
 
-        thr_sv={"INS":min_support_frac_ins, "INV":MIN_SUPPORT_FRAC_INV, 
-                "DEL":MIN_SUPPORT_FRAC_DEL, "DUP": MIN_SUPPORT_FRAC_DUP}
+        if not num_none:
+            func_logger.info("No NONE reads")
+        else:
+            func_logger.info("%d candidate NONE reads" % num_none)
+        if num_other:
+            func_logger.info("%d new bps in other methods" % stats["other"])
+        if stats["unresolved"]:
+            func_logger.info("%d unresolved intervals" % stats["unresolved"])
+            if stats["resolved"]:
+                func_logger.info("%d candidate all reads" % (num_candidates + stats["resolved"]))
+        for side in ["L", "R"]:
+            func_logger.info("%d merged intervals with %s bp support" % (stats[side], side))
+        for stage in ["bp merged", "filtered", "coverage filtered", "neighbour support filtered", "full filtered"]:
+            func_logger.info("%d %s intervals" % (stats[stage], stage))
+
+        intervals = [x for key, x in sorted(full_intervals, key=lambda x: x[0])]
+        if start is not None:
+            # Neighbouring tiles see the same reads near their shared edge, keep only the intervals anchored in this tile
+            intervals = [x for x in intervals if start <= get_sc_anchor(x) < end]
+
+        # The two breakpoints of an SV can be in different tiles, so the full intervals are merged per chromosome
+        full_filtered_bed = os.path.join(workdir, "full.bed")
+        pybedtools.BedTool(intervals).saveas(full_filtered_bed)
+    except Exception as e:
+        func_logger.error('Caught exception in worker thread')
 
-        thr_sv_abs={"INS":min_support_ins, "INV":MIN_SUPPORT_INV, 
-                "DEL":MIN_SUPPORT_DEL, "DUP": MIN_SUPPORT_DUP}
+        # This prints the type, value, and stack trace of the
+        # current exception being handled.
+        traceback.print_exc()
 
+        print()
+        raise e
 
+    pybedtools.cleanup(remove_all=True)
+    func_logger.info("Generated intervals in %g seconds for region %s" % ((time.time() - start_time), region))
 
-        unmerged_none_bed = None
-        if not unmerged_none_intervals:
-            func_logger.info("No NONE reads")
-        else:
-            unmerged_none_bed = os.path.join(workdir, "unmerged_none.bed")
-            bedtool_none = pybedtools.BedTool(unmerged_none_intervals).sort().moveto(unmerged_none_bed)
-            func_logger.info("%d candidate NONE reads" % (bedtool_none.count()))        
+    return full_filtered_bed
 
-        unmerged_other_bed_chr = os.path.join(workdir, "unmerged_other.bed")
-        if unmerged_other_bed:
-            func_logger.info("Gather intervals from breakpoints in other methods")
-            bedtool_unmerged_other = pybedtools.BedTool(unmerged_other_bed).filter(lambda x:x.chrom==chromosome).sort()
-            func_logger.info("%d bps in other methods" % (bedtool_none.count()))        
-            if bedtool_unmerged_other.count()>0:
-                bedtool_unmerged_other=bedtool_unmerged_other.subtract(unmerged_bed, A=True, f=0.5, r=True ).moveto(unmerged_other_bed_chr)
-                if bedtool_unmerged_other.count()>0:
-                    func_logger.info("%d new bps in other methods" % (bedtool_unmerged_other.count()))        
-                    if unmerged_none_bed:
-                        bedtool_none=bedtool_none.cat(bedtool_unmerged_other,postmerge=False).sort().moveto(unmerged_none_bed)
-                    else:
-                        unmerged_none_bed=unmerged_other_bed_chr
-
-
-        #Resolve NONE type SVs
-        if unmerged_none_bed:
-            bedtool_none=pybedtools.BedTool(unmerged_none_bed)
-            bedtool_none=bedtool_none.intersect(bedtool,f=overlap_ratio,r=True,wa=True,v=True).moveto(unmerged_none_bed)
-            if len(bedtool_none)>0:
-                resolved_none_bed=resolve_none_svs(sam_file, workdir, unmerged_none_bed, min_mapq=min_mapq,
-                                          min_soft_clip=min_soft_clip, min_support_ins=min_support_ins, 
-                                          min_support_frac_ins=min_support_frac_ins, max_nm=max_nm, min_matches=min_matches, 
-                                          isize_mean=isize_mean, isize_sd=isize_sd, svs_to_softclip=svs_to_softclip,
-                                          merge_max_dist=merge_max_dist, mean_read_length=mean_read_length, 
-                                          mean_read_coverage=mean_read_coverage,min_ins_cov_frac=min_ins_cov_frac, 
-                                          max_ins_cov_frac=max_ins_cov_frac, num_sd=num_sd,
-                                          plus_minus_thr_scale=plus_minus_thr_scale, 
-                                          none_thr_scale=none_thr_scale, ls_scale=ls_scale, other_scale=other_scale)
-                if resolved_none_bed:
-                    unmerged_all_bed = os.path.join(workdir, "unmerged_all.bed")
-                    bedtool = bedtool.cat(resolved_none_bed,postmerge=False).sort().moveto(unmerged_all_bed)
-                    func_logger.info("%d candidate all reads" % (bedtool.count()))
-
-
-        bedtool_lr={"L":bedtool.filter(lambda x: int(x.name.split(",")[0])<=int(x.name.split(",")[1])).sort(),
-                    "R":bedtool.filter(lambda x: int(x.name.split(",")[0])>int(x.name.split(",")[1])).sort()}
-        bp_merged_intervals = []
-        for k_bt,bt in bedtool_lr.iteritems():
-            merged_bed = os.path.join(workdir, "merged_%s.bed"%k_bt)
-            m_bt=merge_for_each_sv(bt,c="4,5,6,7",o="collapse,sum,collapse,collapse",
-                                        svs_to_softclip=svs_to_softclip,d=merge_max_dist,
-                                        reciprocal_for_2bp=False, sv_type_field = [6,0])
-            m_bt = m_bt.moveto(merged_bed)
-            func_logger.info("%d merged intervals with left bp support" % (m_bt.count()))
 
-            # Check if the other break point also can be merged for the merged intervals (for 2bp SVs)
-            for interval in m_bt:
-                sv_type = interval.fields[6].split(',')[0]
-                if len(set(interval.fields[6].split(',')))!=1:
-                    func_logger.warn("More than one svtypes: %s",(str(interval)))
-                if  sv_type == "INS":
-                    bp_merged_intervals.append(interval)
-                else:
-                    name_fields_0 = interval.name.split(',')
-                    other_bps = map(lambda x:int(name_fields_0[3*x+1]), range(len(name_fields_0)/3))
-                    if (min(other_bps)+2*pad-max(other_bps))>(-merge_max_dist):
-                        bp_merged_intervals.append(interval)
-                        continue
-
-                    other_bp_bedtool=bt.filter(lambda x: x.name in interval.name and x.fields[6]==sv_type).each(partial(generate_other_bp_interval,pad=pad)).sort().merge(c="4,5,6,7", o="collapse,sum,collapse,collapse", d=merge_max_dist)
-                    if len(other_bp_bedtool)==1:
-                        bp_merged_intervals.append(interval)
-                    else:
-                        for intvl in other_bp_bedtool:
-                            bp_merged_intervals.extend(bt.filter(lambda x: x.name in intvl.name and x.fields[6]==sv_type).sort().merge(c="4,5,6,7", o="collapse,sum,collapse,collapse", d=merge_max_dist))
-                    
-        bp_merged_bed = os.path.join(workdir, "bp_merged.bed")
-        bedtool=pybedtools.BedTool(bp_merged_intervals).each(partial(add_other_bp_fields,pad=pad)).sort().moveto(bp_merged_bed)       
-        func_logger.info("%d BP merged intervals" % (bedtool.count()))
-
-        filtered_bed = os.path.join(workdir, "filtered.bed")
-        bedtool = bedtool.filter(lambda x: int(x.score) >= 0).each(
-            partial(merged_interval_features, bam_handle=sam_file)).moveto(
-            filtered_bed)
-        func_logger.info("%d filtered intervals" % (bedtool.count()))
-        
-        # Now filter based on coverage
-        coverage_filtered_bed = os.path.join(workdir, "coverage_filtered.bed")
-        bedtool = bedtool.filter(lambda x: (x.fields[3].split(",")[1]!="INS" or 
-                                           ((min_ins_cov_frac*mean_read_coverage)<=(float(x.fields[6])/abs(x.start-x.end+1)*mean_read_length)<=(max_ins_cov_frac*mean_read_coverage)))).moveto(coverage_filtered_bed)
-        func_logger.info("%d coverage filtered intervals" % (bedtool.count()))
-
-
-        # Add number of neighbouring reads that support SC
-        bedtool=bedtool.each(partial(add_neighbour_support,bam_handle=sam_file, min_mapq=min_mapq, 
-                                     min_soft_clip=min_soft_clip, max_nm=max_nm, min_matches=min_matches,
-                                     skip_soft_clip=False, isize_mean=isize_mean, min_isize=min_isize, 
-                                     max_isize=max_isize, mean_read_length=mean_read_length)).sort().moveto(coverage_filtered_bed)
-
-        neigh_coverage_filtered_bed = os.path.join(workdir, "neigh_filtered.bed")
-        bedtool = bedtool.each(partial(filter_low_frac_support,thr_sv=thr_sv,
-                               plus_minus_thr_scale=plus_minus_thr_scale,ls_scale=ls_scale)).each(
-                               partial(filter_low_neigh_read_support,
-                               thr_sv_abs=thr_sv_abs,
-                               plus_minus_thr_scale=plus_minus_thr_scale,ls_scale=ls_scale)).sort().moveto(
-                               neigh_coverage_filtered_bed)
-        func_logger.info("%d neighbour support filtered intervals" % (bedtool.count()))
-
-        # For 2bp SVs, the interval will be the cover of two intervals on the BP
-        full_filtered_bed = os.path.join(workdir, "full_neigh_filtered.bed")
-        bedtool = bedtool.each(partial(get_full_interval,pad=pad)).sort().moveto(full_filtered_bed)
-        func_logger.info("%d full filtered intervals" % (bedtool.count()))
+def merge_sc_intervals(bam, chromosome, bed_files, workdir, min_mapq=SC_MIN_MAPQ, min_soft_clip=SC_MIN_SOFT_CLIP,
+                       pad=SC_PAD, min_support_ins=MIN_SUPPORT_INS, min_support_frac_ins=MIN_SUPPORT_FRAC_INS,
+                       max_nm=SC_MAX_NM, min_matches=SC_MIN_MATCHES, isize_mean=ISIZE_MEAN, isize_sd=ISIZE_SD,
+                       svs_to_softclip=SVS_SOFTCLIP_SUPPORTED, overlap_ratio=OVERLAP_RATIO,
+                       merge_max_dist=-int(1*SC_PAD), mean_read_length=MEAN_READ_LENGTH, num_sd=2,
+                       plus_minus_thr_scale=0.4, ls_scale=1.4):
+    # Merges the full intervals of all the tiles of a chromosome, so that the two breakpoints of an SV are merged
+    # even when they were found in different tiles
+    func_logger = logging.getLogger("%s-%s" % (merge_sc_intervals.__name__, multiprocessing.current_process()))
+
+    if not os.path.isdir(workdir):
+        func_logger.error("Working directory %s doesn't exist" % workdir)
+        return None
+
+    func_logger.info("Merging intervals from %s for chromosome %s" % (bam, chromosome))
+    pybedtools.set_tempdir(workdir)
+
+    min_isize = isize_mean - num_sd * isize_sd
+    max_isize = isize_mean + num_sd * isize_sd
+
+    thr_sv={"INS":min_support_frac_ins, "INV":MIN_SUPPORT_FRAC_INV,
+            "DEL":MIN_SUPPORT_FRAC_DEL, "DUP": MIN_SUPPORT_FRAC_DUP}
+    thr_sv_abs={"INS":min_support_ins, "INV":MIN_SUPPORT_INV,
+            "DEL":MIN_SUPPORT_DEL, "DUP": MIN_SUPPORT_DUP}
+
+    start_time = time.time()
+    try:
+        sam_file = get_bam_handle(bam)
+        intervals = sort_intervals([x for bed_file in bed_files for x in pybedtools.BedTool(bed_file)])
+        func_logger.info("%d full filtered intervals" % (len(intervals)))
 
         # Now merge on full intervals
         merged_full_filtered_bed = os.path.join(workdir, "merged_full.bed")
-        if bedtool.count()>0:
-            bedtool=merge_for_each_sv(bedtool,c="4,5,6,7,9",o="collapse,collapse,collapse,collapse,collapse",
-                                      svs_to_softclip=svs_to_softclip,
-                                      overlap_ratio=overlap_ratio,
-                                      reciprocal_for_2bp=True, 
-                                      sv_type_field = [3,1], d=merge_max_dist)
-        bedtool = bedtool.each(partial(fix_merged_fields,inter_tools=False)).each(partial(fine_tune_bps,pad=pad)).sort()
-        func_logger.info("%d merged intervals" % (bedtool.count()))
+        if intervals:
+            intervals=merge_for_each_sv(intervals,c="4,5,6,7,9",o="collapse,collapse,collapse,collapse,collapse",
+                                        svs_to_softclip=svs_to_softclip,
+                                        overlap_ratio=overlap_ratio,
+                                        reciprocal_for_2bp=True, 
+                                        sv_type_field = [3,1], d=merge_max_dist)
+        intervals = sort_intervals(each_interval(each_interval(intervals, partial(fix_merged_fields,inter_tools=False)),
+                                                 partial(fine_tune_bps,pad=pad)))
+        func_logger.info("%d merged intervals" % (len(intervals)))
         
         # Recover 2-BP intervals with only 1-end SC
-        bedtool_1end = bedtool.filter(lambda x: x.score == "-1").sort()
-        bedtool = bedtool.filter(lambda x: x.score != "-1").sort()
-        func_logger.info("%d fine intervals" % (bedtool.count()))
-        func_logger.info("%d 2-BP intervals with 1-end SC" % (bedtool_1end.count()))
-        if bedtool_1end.count()>0:
-            bedtool_1end_resolved = bedtool_1end.each(partial(find_other_bp_interval,pad=pad)).sort()
-            bedtool_1end_resolved = bedtool_1end_resolved.each(partial(merged_interval_features,bam_handle=sam_file)).each(
-                                                        partial(add_neighbour_support,bam_handle=sam_file, min_mapq=min_mapq, 
-                                                            min_soft_clip=min_soft_clip, max_nm=max_nm, min_matches=min_matches, 
-                                                            isize_mean=isize_mean, min_isize=min_isize, max_isize=max_isize, 
-                                                            mean_read_length=mean_read_length)).each(
-                                                        partial(filter_low_frac_support,thr_sv=thr_sv,
-                                                                plus_minus_thr_scale=plus_minus_thr_scale,ls_scale=ls_scale)).each(
-                                                       partial(filter_low_neigh_read_support,
-                                                       thr_sv_abs=thr_sv_abs,
-                                                       plus_minus_thr_scale=plus_minus_thr_scale,ls_scale=ls_scale)).each(partial(
-                                                        get_full_interval,pad=pad)).cut([0,1,2,3,4,5,6,8]).sort()
-
-            func_logger.info("%d recovered 2-BP intervals with 1-end SC" % (bedtool_1end_resolved.count()))
-            if bedtool_1end_resolved.count()>0:
-                bedtool_1end_resolved = bedtool_1end_resolved.cat(bedtool_1end, postmerge=False).sort()
-                bedtool_1end_resolved=merge_for_each_sv(bedtool_1end_resolved,c="4,5,6,7,8",o="collapse,collapse,collapse,collapse,collapse",
+        intervals_1end = [x for x in intervals if x.score == "-1"]
+        intervals = [x for x in intervals if x.score != "-1"]
+        func_logger.info("%d fine intervals" % (len(intervals)))
+        func_logger.info("%d 2-BP intervals with 1-end SC" % (len(intervals_1end)))
+        if intervals_1end:
+            intervals_1end_resolved = sort_intervals(each_interval(intervals_1end, partial(find_other_bp_interval,pad=pad)))
+            for func in [partial(merged_interval_features,bam_handle=sam_file),
+                         partial(add_neighbour_support,bam_handle=sam_file, min_mapq=min_mapq, 
+                                 min_soft_clip=min_soft_clip, max_nm=max_nm, min_matches=min_matches, 
+                                 isize_mean=isize_mean, min_isize=min_isize, max_isize=max_isize, 
+                                 mean_read_length=mean_read_length),
+                         partial(filter_low_frac_support,thr_sv=thr_sv,
+                                 plus_minus_thr_scale=plus_minus_thr_scale,ls_scale=ls_scale),
+                         partial(filter_low_neigh_read_support,
+                                 thr_sv_abs=thr_sv_abs,
+                                 plus_minus_thr_scale=plus_minus_thr_scale,ls_scale=ls_scale),
+                         partial(get_full_interval,pad=pad)]:
+                intervals_1end_resolved = each_interval(intervals_1end_resolved, func)
+            intervals_1end_resolved = sort_intervals(cut_intervals(intervals_1end_resolved, [0,1,2,3,4,5,6,8]))
+
+            func_logger.info("%d recovered 2-BP intervals with 1-end SC" % (len(intervals_1end_resolved)))
+            if intervals_1end_resolved:
+                intervals_1end_resolved = sort_intervals(intervals_1end_resolved + intervals_1end)
+                intervals_1end_resolved=merge_for_each_sv(intervals_1end_resolved,c="4,5,6,7,8",o="collapse,collapse,collapse,collapse,collapse",
                                           svs_to_softclip=svs_to_softclip,
                                           overlap_ratio=overlap_ratio,
                                           reciprocal_for_2bp=True, 
                                           sv_type_field = [3,1], d=merge_max_dist)
-                bedtool_1end_resolved = bedtool_1end_resolved.each(partial(fix_merged_fields,inter_tools=False)).each(partial(fine_tune_bps,pad=pad))
-                bedtool_1end_resolved = bedtool_1end_resolved.filter(lambda x: x.score != "-1").sort()
-                bedtool = bedtool.cat(bedtool_1end_resolved, postmerge=False).sort()
-
-        bedtool=bedtool.moveto(merged_full_filtered_bed)
-        func_logger.info("%d merged full intervals" % (bedtool.count()))
+                intervals_1end_resolved = each_interval(each_interval(intervals_1end_resolved, partial(fix_merged_fields,inter_tools=False)),
+                                                        partial(fine_tune_bps,pad=pad))
+                intervals_1end_resolved = [x for x in intervals_1end_resolved if x.score != "-1"]
+                intervals = sort_intervals(intervals + intervals_1end_resolved)
 
-        sam_file.close()
+        pybedtools.BedTool(intervals).saveas(merged_full_filtered_bed)
+        func_logger.info("%d merged full intervals" % (len(intervals)))
     except Exception as e:
         func_logger.error('Caught exception in worker thread')
 
@@ -1031,7 +1482,7 @@ def generate_sc_intervals(bam, chromosome, workdir, min_avg_base_qual=SC_MIN_AVG
         raise e
 
     pybedtools.cleanup(remove_all=True)
-    func_logger.info("Generated intervals in %g seconds for region %s" % ((time.time() - start_time), chromosome))
+    func_logger.info("Merged intervals in %g seconds for chromosome %s" % ((time.time() - start_time), chromosome))
 
     return merged_full_filtered_bed
 
@@ -1047,7 +1498,7 @@ def parallel_generate_sc_intervals(bams, chromosomes, skip_bed, workdir, num_thr
                                    overlap_ratio=OVERLAP_RATIO, mean_read_length=MEAN_READ_LENGTH,
                                    mean_read_coverage=MEAN_READ_COVERAGE, min_ins_cov_frac=MIN_INS_COVERAGE_FRAC,
                                    max_ins_cov_frac=MAX_INS_COVERAGE_FRAC,
-                                   assembly_max_tools=ASSEMBLY_MAX_TOOLS):
+                                   assembly_max_tools=ASSEMBLY_MAX_TOOLS, tile_size=SC_TILE_SIZE):
     func_logger = logging.getLogger(
         "%s-%s" % (parallel_generate_sc_intervals.__name__, multiprocessing.current_process()))
 
@@ -1055,12 +1506,14 @@ def parallel_generate_sc_intervals(bams, chromosomes, skip_bed, workdir, num_thr
         func_logger.info("Creating directory %s" % workdir)
         os.makedirs(workdir)
 
+    bam_chromosome_lengths = {}
+    for bam in bams:
+        bam_chromosome_lengths[bam] = get_bam_contig_lengths(bam)
+
     if not chromosomes:
         func_logger.info("Chromosome list unspecified. Inferring from the BAMs")
         for bam in bams:
-            bamfile = pysam.Samfile(bam, "rb")
-            chromosomes += list(bamfile.references)
-            bamfile.close()
+            chromosomes += bam_chromosome_lengths[bam].keys()
         chromosomes = sorted(list(set(chromosomes)))
         func_logger.info("Chromosome list inferred as %s" % (str(chromosomes)))
 
@@ -1079,11 +1532,24 @@ def parallel_generate_sc_intervals(bams, chromosomes, skip_bed, workdir, num_thr
     unmerged_other_bed = get_bp_intervals(skip_bed,workdir,assembly_max_tools,pad)
 
 
+    # Chromosomes are split into fixed-size tiles which the pool hands out to workers as they become free,
+    # so large chromosomes no longer straggle
+    tiles = []
+    for bam, chromosome in itertools.product(bams, chromosomes):
+        if chromosome not in bam_chromosome_lengths[bam]:
+            func_logger.warn("Chromosome %s not in %s" % (chromosome, bam))
+            continue
+        tiles += [(bam, chromosome, start, end) for start, end in
+                  get_tiles(bam_chromosome_lengths[bam][chromosome], tile_size)]
+    func_logger.info("Scanning %d tiles of size %d" % (len(tiles), tile_size))
+
     bed_files = []
-    for index, (bam, chromosome) in enumerate(itertools.product(bams, chromosomes)):
+    tile_workdirs = {}
+    for index, (bam, chromosome, start, end) in enumerate(tiles):
         process_workdir = os.path.join(workdir, str(index))
         if not os.path.isdir(process_workdir):
             os.makedirs(process_workdir)
+        tile_workdirs[process_workdir] = (bam, chromosome)
 
 
         args_list = [bam, chromosome, process_workdir]
@@ -1093,13 +1559,41 @@ def parallel_generate_sc_intervals(bams, chromosomes, skip_bed, workdir, num_thr
                        "isize_mean": isize_mean, "isize_sd": isize_sd, "svs_to_softclip": svs_to_softclip, 
                        "merge_max_dist": merge_max_dist, "mean_read_length": mean_read_length,
                        "mean_read_coverage": mean_read_coverage, "min_ins_cov_frac": min_ins_cov_frac,
-                       "max_ins_cov_frac": max_ins_cov_frac,"unmerged_other_bed": unmerged_other_bed}
+                       "max_ins_cov_frac": max_ins_cov_frac,"unmerged_other_bed": unmerged_other_bed,
+                       "start": start, "end": end}
         pool.apply_async(generate_sc_intervals, args=args_list, kwds=kwargs_dict,
                          callback=partial(generate_sc_intervals_callback, result_list=bed_files))
 
     pool.close()
     pool.join()
 
+    # The tiles are merged per chromosome, once all of them are done
+    chromosome_bed_files = collections.defaultdict(list)
+    for bed_file in sorted(bed_files, key=lambda x: int(os.path.basename(os.path.dirname(x)))):
+        if os.path.exists(bed_file) and os.path.getsize(bed_file) > 0:
+            chromosome_bed_files[tile_workdirs[os.path.dirname(bed_file)]].append(bed_file)
+
+    pool = multiprocessing.Pool(num_threads)
+    bed_files = []
+    for index, (bam, chromosome) in enumerate(itertools.product(bams, chromosomes)):
+        if (bam, chromosome) not in chromosome_bed_files:
+            continue
+        merge_workdir = os.path.join(workdir, "merged_%d" % index)
+        if not os.path.isdir(merge_workdir):
+            os.makedirs(merge_workdir)
+
+        args_list = [bam, chromosome, chromosome_bed_files[(bam, chromosome)], merge_workdir]
+        kwargs_dict = {"min_mapq": min_mapq, "min_soft_clip": min_soft_clip, "pad": pad,
+                       "min_support_ins": min_support_ins, "min_support_frac_ins": min_support_frac_ins,
+                       "max_nm": max_nm, "min_matches": min_matches, "isize_mean": isize_mean, "isize_sd": isize_sd,
+                       "svs_to_softclip": svs_to_softclip, "merge_max_dist": merge_max_dist,
+                       "mean_read_length": mean_read_length}
+        pool.apply_async(merge_sc_intervals, args=args_list, kwds=kwargs_dict,
+                         callback=partial(generate_sc_intervals_callback, result_list=bed_files))
+
+    pool.close()
+    pool.join()
+
     # Remove empty BED files, which can cause merging issues with pybedtools
     bed_files = [bed_file for bed_file in bed_files if os.path.exists(bed_file) and os.path.getsize(bed_file) > 0]
 
@@ -1146,8 +1640,8 @@ def parallel_generate_sc_intervals(bams, chromosomes, skip_bed, workdir, num_thr
     if len(sc_skip_bedtool):
         bedtool = bedtool.cat(sc_skip_bedtool, postmerge=False)
     bedtool = bedtool.sort()
-    bedtool = merge_for_each_sv(bedtool,c="4",o="collapse",svs_to_softclip=svs_to_softclip,
-                                  overlap_ratio=overlap_ratio, reciprocal_for_2bp=True, d=merge_max_dist)
+    bedtool = pybedtools.BedTool(merge_for_each_sv(bedtool,c="4",o="collapse",svs_to_softclip=svs_to_softclip,
+                                  overlap_ratio=overlap_ratio, reciprocal_for_2bp=True, d=merge_max_dist))
     bedtool = bedtool.each(partial(fix_merged_fields,inter_tools=True)).sort().moveto(interval_bed)
     if len(nonsc_skip_bedtool):
         bedtool = bedtool.cat(nonsc_skip_bedtool, postmerge=False).sort().moveto(interval_bed)
@@ -1160,6 +1654,73 @@ def parallel_generate_sc_intervals(bams, chromosomes, skip_bed, workdir, num_thr
     return bedtool.fn
 
 
+class TestTiledSoftClipIntervals(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.bam = os.path.join(self.workdir, "deletion.bam")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def simulate_deletion(self, start, end, length, num_pairs=3000):
+        # Homozygous deletion of start-end, with the reads across its junction soft-clipped on their shorter side
+        rand = random.Random(0)
+        alignments = []
+        for index in xrange(num_pairs):
+            fragment_start = rand.randint(start - 3000, start + 4000)
+            isize = int(rand.gauss(ISIZE_MEAN, ISIZE_SD / 2))
+            ends = []
+            for read_start in [fragment_start, fragment_start + isize - 100]:
+                if read_start + 100 <= start:
+                    ends.append((read_start, [(0, 100)]))
+                elif read_start >= start:
+                    ends.append((read_start + end - start, [(0, 100)]))
+                elif start - read_start >= 50:
+                    ends.append((read_start, [(0, start - read_start), (4, 100 - start + read_start)]))
+                else:
+                    ends.append((end, [(4, start - read_start), (0, 100 - start + read_start)]))
+            tlen = ends[1][0] + sum(length for op, length in ends[1][1] if op == 0) - ends[0][0]
+            for is_first, (pos, cigar), (mate_pos, mate_cigar) in [(True, ends[0], ends[1]),
+                                                                   (False, ends[1], ends[0])]:
+                aln = pysam.AlignedSegment()
+                aln.query_name = "fragment%d" % index
+                aln.query_sequence = "A" * 100
+                aln.flag = 0x61 if is_first else 0x91
+                aln.reference_id = 0
+                aln.reference_start = pos
+                aln.mapping_quality = 60
+                aln.cigartuples = cigar
+                aln.next_reference_id = 0
+                aln.next_reference_start = mate_pos
+                aln.template_length = tlen if is_first else -tlen
+                aln.query_qualities = pysam.qualitystring_to_array("I" * 100)
+                aln.set_tag("NM", 0)
+                alignments.append(aln)
+
+        header = {"HD": {"VN": "1.0", "SO": "coordinate"}, "SQ": [{"SN": "chr1", "LN": length}]}
+        bam_file = pysam.AlignmentFile(self.bam, "wb", header=header)
+        for aln in sorted(alignments, key=lambda x: x.reference_start):
+            bam_file.write(aln)
+        bam_file.close()
+        pysam.index(self.bam)
+
+    def get_intervals(self, tiles):
+        bed_files = []
+        for start, end in tiles:
+            tile_workdir = tempfile.mkdtemp(dir=self.workdir)
+            bed_file = generate_sc_intervals(self.bam, "chr1", tile_workdir, start=start, end=end)
+            if bed_file and os.path.getsize(bed_file) > 0:
+                bed_files.append(bed_file)
+        merged_bed_file = merge_sc_intervals(self.bam, "chr1", bed_files, tempfile.mkdtemp(dir=self.workdir))
+        return [(x.start, x.end, x.name.split(",")[1]) for x in pybedtools.BedTool(merged_bed_file)]
+
+    def test_deletion_across_tile_edge(self):
+        self.simulate_deletion(10000, 11000, 21000)
+        intervals = self.get_intervals(get_tiles(21000, tile_size=0))
+        self.assertEqual(intervals, [(10000, 11000, "DEL")])
+        self.assertEqual(self.get_intervals(get_tiles(21000, tile_size=10500)), intervals)
+
+
 if __name__ == "__main__":
     FORMAT = '%(levelname)s %(asctime)-15s %(name)-20s %(message)s'
     logging.basicConfig(level=logging.INFO, format=FORMAT)
@@ -1197,6 +1758,8 @@ if __name__ == "__main__":
     parser.add_argument("--max_ins_cov_frac", type=float, default=MAX_INS_COVERAGE_FRAC, help="Maximum read coverage around the insertion breakpoint.")
     parser.add_argument("--assembly_max_tools", type=int, default=ASSEMBLY_MAX_TOOLS,
                            help="Skip assembly if more than this many tools support a call (default 1)")
+    parser.add_argument("--sc_tile_size", type=int, default=SC_TILE_SIZE,
+                        help="Size of the genomic tiles scanned independently. Use 0 to scan whole chromosomes")
 
     args = parser.parse_args()
 
@@ -1211,4 +1774,5 @@ if __name__ == "__main__":
                                    isize_sd=args.isize_sd, svs_to_softclip=args.svs_to_softclip, 
                                    overlap_ratio=args.overlap_ratio, mean_read_length=args.mean_read_length,
                                    mean_read_coverage=args.mean_read_coverage, min_ins_cov_frac=args.min_ins_cov_frac,
-                                   max_ins_cov_frac=args.max_ins_cov_frac, assembly_max_tools=args.assembly_max_tools)
+                                   max_ins_cov_frac=args.max_ins_cov_frac, assembly_max_tools=args.assembly_max_tools,
+                                   tile_size=args.sc_tile_size)
@@ -1,23 +1,33 @@
 import logging
+import math
 import os
 import multiprocessing
 import traceback
 import argparse
+import bisect
+import heapq
+import random
 import sys
 import time
-import json
-import base64
+import unittest
 from functools import partial
 import pybedtools
-import pysam
 
-from defaults import ISIZE_MEAN, ISIZE_SD, GT_WINDOW, GT_NORMAL_FRAC
+from defaults import ISIZE_MEAN, ISIZE_SD, GT_WINDOW, GT_ERROR_RATE, GT_SHARDS_PER_THREAD, GT_MIN_SOFT_CLIP, \
+    GT_BREAKPOINT_TOLERANCE, GT_MAX_GQ, MEAN_READ_LENGTH, MEAN_READ_COVERAGE
+from info_utils import decode_info
+from bam_utils import get_bam_handles
+from library_stats import get_index_read_volumes, BAI_LINEAR_WINDOW
 
 GT_HET = "0/1"
 GT_HOM = "1/1"
 GT_REF = "0/0"
 GT_UNK = "./."
 
+# FORMAT of the genotype column, the genotype followed by its quality, the PHRED-scaled likelihoods of 0/0, 0/1 and
+# 1/1 and the REF and ALT read counts
+GT_FORMAT = "GT:GQ:PL:AD"
+
 
 def count_reads_supporting_ref(chrom, start, end, bam_handle, isize_min, isize_max, window):
     total_normal_reads = 0
@@ -29,44 +39,229 @@ def count_reads_supporting_ref(chrom, start, end, bam_handle, isize_min, isize_m
         if aln.is_duplicate or not aln.is_paired:
             continue
         total_reads += 1
-        if aln.is_unmapped or aln.mate_is_unmapped:
+        if not is_normal_pair_read(aln, isize_min, isize_max):
             continue
-        if aln.rnext != aln.tid: continue
-        if aln.is_reverse:
-            if not (aln.pnext < aln.pos and not aln.mate_is_reverse): continue
-        else:
-            if not (aln.pnext > aln.pos and aln.mate_is_reverse): continue
         if not (((aln.aend - end) >= 20 and (end - aln.pos) >= 20) or (
                 (start - aln.pos) >= 20 and (aln.aend - start) >= 20)):
             continue
-        tlen = abs(aln.tlen)
-        if isize_min <= tlen <= isize_max:
-            total_normal_reads += 1
-            total_read_bases = total_read_bases + aln.qlen
+        total_normal_reads += 1
+        total_read_bases = total_read_bases + aln.qlen
     return total_normal_reads, total_read_bases, total_reads
 
 
+def is_normal_pair_read(aln, isize_min, isize_max):
+    # The breakpoint independent part of the checks in count_reads_supporting_ref
+    if aln.is_unmapped or aln.mate_is_unmapped:
+        return False
+    if aln.rnext != aln.tid:
+        return False
+    if aln.is_reverse:
+        if not (aln.pnext < aln.pos and not aln.mate_is_reverse): return False
+    else:
+        if not (aln.pnext > aln.pos and aln.mate_is_reverse): return False
+    return isize_min <= abs(aln.tlen) <= isize_max
+
+
+def is_pair_resolvable(sv_type, sv_length, isize_min, isize_max):
+    # Whether the ALT pairs spanning a breakpoint stand out from the normal pairs. Smaller deletions and insertions
+    # keep the insert size within its normal range and pairs can span smaller inversions and duplications as a
+    # whole. Insertions of unknown length are assumed to be long.
+    sv_length = abs(sv_length)
+    if sv_type == "INS" and not sv_length:
+        return True
+    if sv_type in ["DEL", "INS"]:
+        return sv_length > isize_max - isize_min
+    return sv_length > isize_max
+
+
+def is_ref_supporting_read(aln, location, is_normal, use_pairs=True):
+    # Reads of normal pairs spanning the breakpoint by at least 20 bases on each side and, if the pairs can tell the
+    # alleles apart, normal pairs spanning the breakpoint, counted the same way as the discordant pairs for ALT
+    if not is_normal:
+        return False
+    if aln.pos + 20 <= location <= aln.aend - 20:
+        return True
+    if not use_pairs:
+        return False
+    left, right = sorted([aln.pos, aln.pnext])
+    return left < location < right
+
+
+def is_split_read(aln):
+    try:
+        aln.opt("SA")
+        return True
+    except KeyError:
+        return False
+
+
+def is_alt_supporting_read(aln, location, sv_type, isize_min, isize_max, is_split=False, use_pairs=True,
+                           tolerance=GT_BREAKPOINT_TOLERANCE, min_soft_clip=GT_MIN_SOFT_CLIP):
+    if aln.is_unmapped:
+        return False
+
+    # Split reads and reads with a long soft-clip, with the clip at the breakpoint
+    if aln.cigar:
+        for (op, length), junction in [(aln.cigar[0], aln.pos), (aln.cigar[-1], aln.aend)]:
+            if op in [4, 5] and (is_split or length >= min_soft_clip) and abs(junction - location) <= tolerance:
+                return True
+    if not use_pairs:
+        return False
+
+    # Pairs with one end unmapped or on another chromosome, the anchored read pointing at the breakpoint
+    if aln.mate_is_unmapped or aln.rnext != aln.tid:
+        if sv_type in ["DEL", "INV", "DUP"]:
+            return False
+        return aln.aend >= location if aln.is_reverse else aln.pos <= location
+
+    # Pairs spanning the breakpoint with the orientation and insert size the SV type leaves behind
+    left, right = sorted([aln.pos, aln.pnext])
+    if not left < location < right:
+        return False
+    left_is_reverse, right_is_reverse = (aln.is_reverse, aln.mate_is_reverse) if aln.pos <= aln.pnext else (
+        aln.mate_is_reverse, aln.is_reverse)
+    if sv_type == "INV":
+        return left_is_reverse == right_is_reverse
+    if sv_type == "DUP":
+        return left_is_reverse and not right_is_reverse
+    if left_is_reverse or not right_is_reverse:
+        return False
+    if sv_type == "DEL":
+        return abs(aln.tlen) > isize_max
+    if sv_type == "INS":
+        return abs(aln.tlen) < isize_min
+    return not isize_min <= abs(aln.tlen) <= isize_max
+
+
+def sweep_breakpoint_evidence(chrom, breakpoints, bam_handle, isize_min, isize_max, window):
+    # REF, ALT and total read counts of the intervals with (location, interval index, SV type, use pairs)
+    # breakpoints, from a single sorted pass over the BAM. All the windows have the same width, so sorted by location
+    # both their starts and ends are sorted and the windows overlapping a read are a contiguous run found by
+    # bisection. A read pair supports ALT at most once per interval, even when its reads are near both breakpoints,
+    # and REF at most once per breakpoint. The REF counts are summed over the breakpoints.
+    sorted_breakpoints = sorted(breakpoints)
+    window_starts = [max(0, breakpoint[0] - window) for breakpoint in sorted_breakpoints]
+    window_ends = [breakpoint[0] + window for breakpoint in sorted_breakpoints]
+
+    # Overlapping windows are fetched together
+    fetch_regions = []
+    for window_start, window_end in zip(window_starts, window_ends):
+        if fetch_regions and window_start <= fetch_regions[-1][1]:
+            fetch_regions[-1][1] = max(fetch_regions[-1][1], window_end)
+        else:
+            fetch_regions.append([window_start, window_end])
+
+    counts = {}
+    alt_reads = {}
+    ref_reads = {}
+    previous_end = -1
+    for fetch_start, fetch_end in fetch_regions:
+        for aln in bam_handle.fetch(chrom, fetch_start, fetch_end):
+            # Reads reaching back into the previous region were already counted there
+            if aln.pos < previous_end:
+                continue
+            # Secondary and supplementary alignments would count their read again
+            if aln.is_duplicate or not aln.is_paired or aln.flag & 0x900:
+                continue
+            aln_end = aln.aend if not aln.is_unmapped and aln.aend > aln.pos else aln.pos + 1
+            first = bisect.bisect_right(window_ends, aln.pos)
+            last = bisect.bisect_left(window_starts, aln_end)
+            if first >= last:
+                continue
+            is_normal = is_normal_pair_read(aln, isize_min, isize_max)
+            is_split = is_split_read(aln)
+            seen_intervals = set()
+            for index in xrange(first, last):
+                location, interval_index, sv_type, use_pairs = sorted_breakpoints[index]
+                interval_counts = counts.setdefault(interval_index, [0, 0, 0])
+                if interval_index not in seen_intervals:
+                    seen_intervals.add(interval_index)
+                    interval_counts[2] += 1
+                interval_alt_reads = alt_reads.setdefault(interval_index, set())
+                if aln.qname in interval_alt_reads:
+                    continue
+                # Clipped and split reads of normal pairs support ALT even though their pair spans the breakpoint
+                if is_alt_supporting_read(aln, location, sv_type, isize_min, isize_max, is_split=is_split,
+                                          use_pairs=use_pairs):
+                    interval_counts[1] += 1
+                    interval_alt_reads.add(aln.qname)
+                    continue
+                location_ref_reads = ref_reads.setdefault((interval_index, location), set())
+                if aln.qname not in location_ref_reads and is_ref_supporting_read(aln, location, is_normal,
+                                                                                  use_pairs=use_pairs):
+                    interval_counts[0] += 1
+                    location_ref_reads.add(aln.qname)
+        previous_end = fetch_end
+
+    return counts
+
+
+def genotype_likelihoods(ref_count, alt_count, error_rate=GT_ERROR_RATE):
+    # log10 likelihoods of 0/0, 0/1 and 1/1 with the ALT reads binomial with mean error_rate, 1/2 and 1 - error_rate.
+    # The binomial coefficient is the same for all three and is left out.
+    error_rate = min(max(error_rate, 1e-6), 0.5)
+    return [alt_count * math.log10(alt_frac) + ref_count * math.log10(1 - alt_frac) for alt_frac in
+            [error_rate, 0.5, 1 - error_rate]]
+
+
+def call_genotype(ref_count, alt_count, error_rate=GT_ERROR_RATE):
+    # The genotype, its PHRED-scaled quality and the PHRED-scaled likelihoods of 0/0, 0/1 and 1/1
+    if not ref_count + alt_count:
+        return GT_UNK, 0, [0, 0, 0]
+    gls = genotype_likelihoods(ref_count, alt_count, error_rate)
+    best = gls.index(max(gls))
+    pls = [int(round(-10 * (gl - gls[best]))) for gl in gls]
+    gq = min(GT_MAX_GQ, min([pl for index, pl in enumerate(pls) if index != best]))
+    return [GT_REF, GT_HET, GT_HOM][best], gq, pls
+
+
+def format_genotype(gt, gq, pls, ref_count, alt_count):
+    return ":".join([gt, str(gq), ",".join(map(str, pls)), "%d,%d" % (ref_count, alt_count)])
+
+
+def get_genotype_locations(start, end, sv_type):
+    return [start, end] if sv_type != "INS" else [start]
+
+
+def get_junction_read_counts(start, end, sv_type, ref_count, alt_count):
+    # REF and ALT reads per junction, so that both alleles are counted in the same units. REF reads are counted at
+    # every breakpoint and ALT reads across the junctions new to the ALT haplotype: a deletion or a tandem duplication
+    # has one, an inversion one at each breakpoint.
+    ref_junctions = len(set(get_genotype_locations(start, end, sv_type)))
+    alt_junctions = 2 if sv_type == "INV" and start != end else 1
+    return int(round(float(ref_count) / ref_junctions)), int(round(float(alt_count) / alt_junctions))
+
+
 def genotype_interval(chrom, start, end, sv_type, sv_length, bam_handles, isize_min, isize_max, window=GT_WINDOW,
-                      normal_frac_threshold=GT_NORMAL_FRAC):
-    func_logger = logging.getLogger("%s-%s" % (genotype_interval.__name__, multiprocessing.current_process()))
+                      error_rate=GT_ERROR_RATE):
+    return genotype_chromosome_intervals(chrom, [(start, end, sv_type, sv_length)], bam_handles, isize_min, isize_max,
+                                         window=window, error_rate=error_rate)[0]
+
+
+def genotype_chromosome_intervals(chrom, parsed_intervals, bam_handles, isize_min, isize_max, window=GT_WINDOW,
+                                  error_rate=GT_ERROR_RATE):
+    # Genotypes of (start, end, sv_type, sv_length) intervals of one chromosome with one sweep per BAM
+    func_logger = logging.getLogger(
+        "%s-%s" % (genotype_chromosome_intervals.__name__, multiprocessing.current_process()))
 
-    locations = [start, end] if sv_type != "INS" else [start]
-    total_normal, total = 0, 0
-    for location in locations:
-        for bam_handle in bam_handles:
-            total_normal_, total_bases_, total_ = count_reads_supporting_ref(chrom, location, location, bam_handle,
-                                                                             isize_min, isize_max, window)
-            total_normal += total_normal_
-            total += total_
+    breakpoints = [(location, interval_index, sv_type, is_pair_resolvable(sv_type, sv_length, isize_min, isize_max))
+                   for interval_index, (start, end, sv_type, sv_length) in enumerate(parsed_intervals) for location in
+                   get_genotype_locations(start, end, sv_type)]
 
-    normal_frac = float(total_normal) / float(max(1, total))
-    gt = GT_REF
-    if normal_frac < 1 - normal_frac_threshold:
-        gt = GT_HET if normal_frac >= normal_frac_threshold else GT_HOM
+    total_counts = [[0, 0, 0] for interval in parsed_intervals]
+    for bam_handle in bam_handles:
+        for interval_index, counts in sweep_breakpoint_evidence(chrom, breakpoints, bam_handle, isize_min, isize_max,
+                                                                window).iteritems():
+            total_counts[interval_index] = map(sum, zip(total_counts[interval_index], counts))
 
-    func_logger.info("For interval %s:%d-%d %s counts are %d, %d and normal_frac is %g gt is %s" % (
-    chrom, start, end, sv_type, total_normal, total, normal_frac, gt))
-    return gt
+    genotypes = []
+    for (start, end, sv_type, sv_length), (total_ref, total_alt, total) in zip(parsed_intervals, total_counts):
+        total_ref, total_alt = get_junction_read_counts(start, end, sv_type, total_ref, total_alt)
+        gt, gq, pls = call_genotype(total_ref, total_alt, error_rate)
+        func_logger.info("For interval %s:%d-%d %s counts are %d, %d, %d and gt is %s with GQ %d" % (
+            chrom, start, end, sv_type, total_ref, total_alt, total, gt, gq))
+        genotypes.append(format_genotype(gt, gq, pls, total_ref, total_alt))
+    return genotypes
 
 
 def parse_interval(interval):
@@ -80,11 +275,11 @@ def parse_interval(interval):
     sub_types = map(lambda x: x.split(",")[1], sub_names)
     sub_methods = [name.split(",")[3] for name in sub_names]
     try:
-        info = json.loads(base64.b64decode(name.split(",")[0]))
+        info = decode_info(name.split(",")[0])
     except TypeError:
         info = dict()
     if len(interval.fields) > 10:
-        info.update(json.loads(base64.b64decode(interval.fields[10])))
+        info.update(decode_info(interval.fields[10]))
 
     index_to_use = 0
     svlen = -1
@@ -108,8 +303,31 @@ def genotype_intervals_callback(result, result_list):
         result_list.append(result)
 
 
+def genotype_interval_list(intervals, bam_handles, window=GT_WINDOW, isize_mean=ISIZE_MEAN, isize_sd=ISIZE_SD,
+                           error_rate=GT_ERROR_RATE):
+    isize_min = max(0, isize_mean - 3 * isize_sd)
+    isize_max = isize_mean + 3 * isize_sd
+
+    # Breakpoints are grouped by chromosome so each BAM is swept once per chromosome
+    chrom_intervals = {}
+    for interval_index, interval in enumerate(intervals):
+        chrom, start, end, sv_type, svlen = parse_interval(interval)
+        chrom_intervals.setdefault(str(chrom), []).append((interval_index, (start, end, sv_type, svlen)))
+
+    genotypes = [None] * len(intervals)
+    for chrom in sorted(chrom_intervals.keys()):
+        interval_indices, parsed_intervals = zip(*chrom_intervals[chrom])
+        for interval_index, genotype in zip(interval_indices,
+                                            genotype_chromosome_intervals(chrom, parsed_intervals, bam_handles,
+                                                                          isize_min, isize_max, window,
+                                                                          error_rate)):
+            genotypes[interval_index] = genotype
+
+    return [interval.fields + [genotype] for interval, genotype in zip(intervals, genotypes)]
+
+
 def genotype_intervals(intervals_file=None, bams=[], workdir=None, window=GT_WINDOW, isize_mean=ISIZE_MEAN,
-                       isize_sd=ISIZE_SD, normal_frac_threshold=GT_NORMAL_FRAC):
+                       isize_sd=ISIZE_SD, error_rate=GT_ERROR_RATE):
     func_logger = logging.getLogger("%s-%s" % (genotype_intervals.__name__, multiprocessing.current_process()))
 
     if workdir and not os.path.isdir(workdir):
@@ -120,19 +338,12 @@ def genotype_intervals(intervals_file=None, bams=[], workdir=None, window=GT_WIN
     genotyped_intervals = []
     start_time = time.time()
 
-    isize_min = max(0, isize_mean - 3 * isize_sd)
-    isize_max = isize_mean + 3 * isize_sd
-
     try:
-        bam_handles = [pysam.Samfile(bam, "rb") for bam in bams]
-        for interval in pybedtools.BedTool(intervals_file):
-            chrom, start, end, sv_type, svlen = parse_interval(interval)
-            genotype = genotype_interval(str(chrom), start, end, sv_type, svlen, bam_handles, isize_min, isize_max, window,
-                                         normal_frac_threshold)
-            fields = interval.fields + [genotype]
-            genotyped_intervals.append(pybedtools.create_interval_from_list(fields))
-        for bam_handle in bam_handles:
-            bam_handle.close()
+        bam_handles = get_bam_handles(bams)
+        genotyped_intervals = [pybedtools.create_interval_from_list(fields) for fields in
+                               genotype_interval_list([interval for interval in pybedtools.BedTool(intervals_file)],
+                                                      bam_handles, window, isize_mean, isize_sd,
+                                                      error_rate)]
         bedtool = pybedtools.BedTool(genotyped_intervals).moveto(os.path.join(workdir, "genotyped.bed"))
     except Exception as e:
         func_logger.error('Caught exception in worker thread')
@@ -149,9 +360,88 @@ def genotype_intervals(intervals_file=None, bams=[], workdir=None, window=GT_WIN
     return bedtool.fn
 
 
+def genotype_shard(shard_index=0, interval_fields=[], bams=[], window=GT_WINDOW, isize_mean=ISIZE_MEAN,
+                   isize_sd=ISIZE_SD, error_rate=GT_ERROR_RATE):
+    func_logger = logging.getLogger("%s-%s" % (genotype_shard.__name__, multiprocessing.current_process()))
+
+    start_time = time.time()
+
+    try:
+        bam_handles = get_bam_handles(bams)
+        genotyped_fields = genotype_interval_list(
+            [pybedtools.create_interval_from_list(list(fields)) for fields in interval_fields], bam_handles, window,
+            isize_mean, isize_sd, error_rate)
+    except Exception as e:
+        func_logger.error('Caught exception in worker thread')
+
+        # This prints the type, value, and stack trace of the
+        # current exception being handled.
+        traceback.print_exc()
+
+        print()
+        raise e
+    func_logger.info("Genotyped shard %d of %d intervals in %g minutes" % (
+        shard_index, len(genotyped_fields), (time.time() - start_time) / 60.0))
+
+    return shard_index, genotyped_fields
+
+
+def get_read_volumes(bams):
+    # Per BAM, the read volumes of its linear index windows and their mean over the windows with reads
+    read_volumes = []
+    for bam in bams:
+        volumes = get_index_read_volumes(bam)
+        covered_volumes = [volume for contig_volumes in (volumes or {}).values() for volume in contig_volumes if
+                           volume]
+        read_volumes.append((volumes, float(sum(covered_volumes)) / len(covered_volumes) if covered_volumes else 0))
+    return read_volumes
+
+
+def get_relative_depth(read_volumes, chrom, location):
+    # Depth around location relative to the mean depth, averaged over the BAMs. BAMs without a BAI count as average.
+    depths = []
+    for volumes, mean_volume in read_volumes:
+        if volumes is None or not mean_volume:
+            depths.append(1.0)
+            continue
+        contig_volumes = volumes.get(chrom, [])
+        window_index = location / BAI_LINEAR_WINDOW
+        depths.append(contig_volumes[window_index] / mean_volume if window_index < len(contig_volumes) else 0.0)
+    return sum(depths) / len(depths) if depths else 1.0
+
+
+def estimate_genotyping_reads(interval, window=GT_WINDOW, mean_read_length=MEAN_READ_LENGTH,
+                              mean_read_coverage=MEAN_READ_COVERAGE, read_volumes=[]):
+    # Reads the sweep has to look at for the interval, its breakpoint windows times the local coverage
+    chrom, start, end, sv_type, svlen = parse_interval(interval)
+    reads_per_location = (2 * window + mean_read_length) * mean_read_coverage / max(1.0, mean_read_length)
+    return sum([reads_per_location * get_relative_depth(read_volumes, str(chrom), location) for location in
+                get_genotype_locations(start, end, sv_type)])
+
+
+def shard_intervals(intervals, costs, num_shards):
+    # Consecutive runs of intervals sorted by position, with about the same estimated cost. Shards don't cross
+    # chromosomes so that each one is a single sweep.
+    target_cost = float(sum(costs)) / max(1, num_shards)
+    shards = []
+    shard = []
+    shard_cost = 0
+    for interval, cost in zip(intervals, costs):
+        if shard and (shard_cost >= target_cost or interval.chrom != shard[-1].chrom):
+            shards.append((shard_cost, shard))
+            shard = []
+            shard_cost = 0
+        shard.append(interval)
+        shard_cost += cost
+    if shard:
+        shards.append((shard_cost, shard))
+    return shards
+
+
 def parallel_genotype_intervals(intervals_file=None, bams=[], workdir=None, nthreads=1, chromosomes=[],
                                 window=GT_WINDOW, isize_mean=ISIZE_MEAN, isize_sd=ISIZE_SD,
-                                normal_frac_threshold=GT_NORMAL_FRAC):
+                                error_rate=GT_ERROR_RATE, mean_read_length=MEAN_READ_LENGTH,
+                                mean_read_coverage=MEAN_READ_COVERAGE):
     func_logger = logging.getLogger("%s-%s" % (parallel_genotype_intervals.__name__, multiprocessing.current_process()))
 
     if not intervals_file:
@@ -167,43 +457,205 @@ def parallel_genotype_intervals(intervals_file=None, bams=[], workdir=None, nthr
 
     bedtool = pybedtools.BedTool(intervals_file)
     selected_intervals = [interval for interval in bedtool if not chromosomes or interval.chrom in chromosomes]
-    nthreads = min(len(selected_intervals), nthreads)
-    intervals_per_process = (len(selected_intervals) + nthreads - 1) / nthreads
-
-    pool = multiprocessing.Pool(nthreads)
-    genotyped_beds = []
-    for i in xrange(nthreads):
-        process_workdir = os.path.join(workdir, str(i))
-        if not os.path.isdir(process_workdir):
-            os.makedirs(process_workdir)
-        process_intervals = pybedtools.BedTool(
-            selected_intervals[i * intervals_per_process: (i + 1) * intervals_per_process]).saveas(
-            os.path.join(process_workdir, "ungenotyped.bed"))
-        kwargs_dict = {"intervals_file": process_intervals.fn, "bams": bams, "workdir": process_workdir, "window": window,
-                       "isize_mean": isize_mean, "isize_sd": isize_sd, "normal_frac_threshold": normal_frac_threshold}
-        pool.apply_async(genotype_intervals, kwds=kwargs_dict,
-                         callback=partial(genotype_intervals_callback, result_list=genotyped_beds))
+    if not selected_intervals:
+        func_logger.warn("No intervals to genotype")
+        return None
+    selected_intervals.sort(key=lambda interval: (interval.chrom, interval.start, interval.end))
+
+    # Many small shards sized by the estimated number of reads to examine go on the pool's shared queue, largest
+    # first, so that a few shards full of deep breakpoints don't hold up the others. The local depth comes from the
+    # BAM indexes.
+    read_volumes = get_read_volumes(bams)
+    func_logger.info("Estimating local depths from the indexes of %d of %d BAMs" % (
+        len([volumes for volumes, mean_volume in read_volumes if volumes is not None]), len(bams)))
+    costs = [estimate_genotyping_reads(interval, window=window, mean_read_length=mean_read_length,
+                                       mean_read_coverage=mean_read_coverage, read_volumes=read_volumes) for
+             interval in selected_intervals]
+    shards = shard_intervals(selected_intervals, costs, nthreads * GT_SHARDS_PER_THREAD)
+    func_logger.info("Genotyping %d intervals in %d shards" % (len(selected_intervals), len(shards)))
+
+    pool = multiprocessing.Pool(min(nthreads, len(shards)))
+    genotyped_shards = []
+    for shard_index in sorted(xrange(len(shards)), key=lambda index: shards[index][0], reverse=True):
+        kwargs_dict = {"shard_index": shard_index,
+                       "interval_fields": [tuple(interval.fields) for interval in shards[shard_index][1]],
+                       "bams": bams, "window": window, "isize_mean": isize_mean, "isize_sd": isize_sd,
+                       "error_rate": error_rate}
+        pool.apply_async(genotype_shard, kwds=kwargs_dict,
+                         callback=partial(genotype_intervals_callback, result_list=genotyped_shards))
 
     pool.close()
     pool.join()
 
-    func_logger.info("Following BED files will be merged: %s" % (str(genotyped_beds)))
-
-    if not genotyped_beds:
+    if len(genotyped_shards) != len(shards):
+        func_logger.error("Only %d of %d shards were genotyped" % (len(genotyped_shards), len(shards)))
+    if not genotyped_shards:
         func_logger.warn("No intervals generated")
         return None
 
-    pybedtools.set_tempdir(workdir)
-    bedtool = pybedtools.BedTool(genotyped_beds[0])
-
-    for bed_file in genotyped_beds[1:]:
-        bedtool = bedtool.cat(pybedtools.BedTool(bed_file), postmerge=False)
-    bedtool = bedtool.sort().moveto(os.path.join(workdir, "genotyped.bed"))
+    # Every shard comes back sorted, so a k-way merge gives the sorted output
+    sorted_shards = [[((fields[0], int(fields[1]), int(fields[2]), shard_index, index), fields) for index, fields in
+                      enumerate(genotyped_fields)] for shard_index, genotyped_fields in genotyped_shards]
+    genotyped_bed = os.path.join(workdir, "genotyped.bed")
+    with open(genotyped_bed, "w") as genotyped_fd:
+        for key, fields in heapq.merge(*sorted_shards):
+            genotyped_fd.write("\t".join(fields) + "\n")
 
     func_logger.info("Finished parallel genotyping of %d intervals in %g minutes" % (
     len(selected_intervals), (time.time() - start_time) / 60.0))
 
-    return bedtool.fn
+    return genotyped_bed
+
+
+class SimulatedAlignment(object):
+    # The fields of a pysam alignment which the genotyping looks at
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def opt(self, tag):
+        if tag not in self.tags:
+            raise KeyError(tag)
+        return self.tags[tag]
+
+
+class SimulatedBam(object):
+    def __init__(self, alignments):
+        self.alignments = sorted(alignments, key=lambda aln: aln.pos)
+
+    def fetch(self, chrom, start, end):
+        return [aln for aln in self.alignments if aln.pos < end and get_simulated_end(aln) > start]
+
+
+def get_simulated_end(aln):
+    return aln.aend if not aln.is_unmapped and aln.aend > aln.pos else aln.pos + 1
+
+
+class TestSweepBreakpointEvidence(unittest.TestCase):
+    isize_min = 250
+    isize_max = 450
+
+    def random_bam(self, rand, num_reads=3000, length=20000):
+        # Half the reads are from normal pairs, the others have random mates
+        alignments = []
+        for index in xrange(num_reads):
+            pos = rand.randint(0, length)
+            read_length = rand.choice([100, 100, 100, 50, 0])
+            is_reverse = rand.random() < 0.5
+            if rand.random() < 0.5:
+                tlen = rand.randint(self.isize_min - 50, self.isize_max + 50)
+                pnext = pos - tlen + 100 if is_reverse else pos + tlen - 100
+                mate_is_reverse = not is_reverse
+                tlen = -tlen if is_reverse else tlen
+            else:
+                pnext = pos + rand.randint(-3000, 3000)
+                mate_is_reverse = rand.random() < 0.5
+                tlen = rand.choice([1, -1]) * rand.randint(0, 3000)
+            alignments.append(SimulatedAlignment(
+                qname="r%d" % rand.randint(0, num_reads * 2 / 3), pos=pos,
+                aend=pos + read_length if read_length else None, is_unmapped=not read_length,
+                is_duplicate=rand.random() < 0.05, is_paired=rand.random() < 0.95,
+                mate_is_unmapped=rand.random() < 0.05, tid=0, rnext=rand.choice([0, 0, 0, 0, 1]),
+                is_reverse=is_reverse, pnext=pnext, mate_is_reverse=mate_is_reverse, tlen=tlen,
+                qlen=read_length, flag=rand.choice([0, 0, 0, 0x100, 0x800]),
+                cigar=rand.choice([[(4, 30), (0, 70)], [(0, 100)], [(0, 70), (4, 30)], [(5, 5), (0, 95)], None]),
+                tags=rand.choice([{}, {}, {"SA": "chr1,1,+,50M50S,60,0"}])))
+        return SimulatedBam(alignments)
+
+    def count_naively(self, breakpoints, bam, window):
+        # Every read against every breakpoint of every interval
+        counts = {}
+        for interval_index in set([breakpoint[1] for breakpoint in breakpoints]):
+            interval_breakpoints = sorted([breakpoint for breakpoint in breakpoints if breakpoint[1] == interval_index])
+            interval_counts = [0, 0, 0]
+            alt_reads = set()
+            ref_reads = set()
+            for aln in bam.alignments:
+                if aln.is_duplicate or not aln.is_paired or aln.flag & 0x900:
+                    continue
+                near_breakpoints = [breakpoint for breakpoint in interval_breakpoints if
+                                    aln.pos < breakpoint[0] + window and
+                                    get_simulated_end(aln) > max(0, breakpoint[0] - window)]
+                if not near_breakpoints:
+                    continue
+                interval_counts[2] += 1
+                is_normal = is_normal_pair_read(aln, self.isize_min, self.isize_max)
+                for location, index, sv_type, use_pairs in near_breakpoints:
+                    if aln.qname in alt_reads:
+                        break
+                    if is_alt_supporting_read(aln, location, sv_type, self.isize_min, self.isize_max,
+                                              is_split=is_split_read(aln), use_pairs=use_pairs):
+                        interval_counts[1] += 1
+                        alt_reads.add(aln.qname)
+                    elif (aln.qname, location) not in ref_reads and is_ref_supporting_read(aln, location, is_normal,
+                                                                                             use_pairs=use_pairs):
+                        interval_counts[0] += 1
+                        ref_reads.add((aln.qname, location))
+            if interval_counts[2]:
+                counts[interval_index] = interval_counts
+        return counts
+
+    def test_sweep_matches_naive_count(self):
+        rand = random.Random(0)
+        bams = [self.random_bam(rand) for index in xrange(2)]
+        for trial in xrange(30):
+            breakpoints = []
+            for interval_index in xrange(rand.randint(1, 12)):
+                start = rand.randint(0, 19000)
+                end = start + rand.choice([0, 1, 50, 150, 3000])
+                sv_type = rand.choice(["DEL", "INS", "INV", "DUP"])
+                use_pairs = is_pair_resolvable(sv_type, rand.choice([0, 100, end - start, 1000]), self.isize_min,
+                                               self.isize_max)
+                breakpoints += [(location, interval_index, sv_type, use_pairs) for location in
+                                get_genotype_locations(start, end, sv_type)]
+            window = rand.choice([50, 100, 300])
+            for bam in bams:
+                self.assertEqual(sweep_breakpoint_evidence("chr1", breakpoints, bam, self.isize_min, self.isize_max,
+                                                           window),
+                                 self.count_naively(breakpoints, bam, window))
+
+
+class TestGenotypeDeletion(unittest.TestCase):
+    isize_min = 250
+    isize_max = 450
+
+    def simulate_deletion(self, rand, start, end, alt_frac, num_pairs=3000):
+        # Pairs from 7-13 kb with the ALT haplotype lacking start-end. Reads across the deletion junction on the ALT
+        # haplotype are soft-clipped at the breakpoint on their longer side.
+        alignments = []
+        for index in xrange(num_pairs):
+            is_alt = rand.random() < alt_frac
+            fragment_start = rand.randint(7000, 13000 - (end - start if is_alt else 0))
+            isize = int(rand.gauss(350, 30))
+            ends = []
+            for read_start, is_reverse in [(fragment_start, False), (fragment_start + isize - 100, True)]:
+                if not is_alt or read_start + 100 <= start:
+                    ends.append((read_start, read_start + 100, [(0, 100)], is_reverse))
+                elif read_start >= start:
+                    ends.append((read_start + end - start, read_start + end - start + 100, [(0, 100)], is_reverse))
+                elif start - read_start >= 50:
+                    ends.append((read_start, start, [(0, start - read_start), (4, 100 - start + read_start)],
+                                 is_reverse))
+                else:
+                    ends.append((end, end + 100 - start + read_start,
+                                 [(4, start - read_start), (0, 100 - start + read_start)], is_reverse))
+            tlen = ends[1][1] - ends[0][0]
+            for (pos, aend, cigar, is_reverse), mate, read_tlen in [(ends[0], ends[1], tlen),
+                                                                    (ends[1], ends[0], -tlen)]:
+                alignments.append(SimulatedAlignment(
+                    qname="f%d" % index, pos=pos, aend=aend, is_unmapped=False, is_duplicate=False, is_paired=True,
+                    mate_is_unmapped=False, tid=0, rnext=0, is_reverse=is_reverse, pnext=mate[0],
+                    mate_is_reverse=mate[3], tlen=read_tlen, qlen=100, flag=0, cigar=cigar, tags={}))
+        return SimulatedBam(alignments)
+
+    def test_genotype_deletion(self):
+        rand = random.Random(0)
+        for end in [11000, 10060]:
+            for alt_frac, expected_gt in [(0.0, GT_REF), (0.5, GT_HET), (1.0, GT_HOM)]:
+                bam = self.simulate_deletion(rand, 10000, end, alt_frac)
+                genotype = genotype_chromosome_intervals("chr1", [(10000, end, "DEL", end - 10000)], [bam],
+                                                         self.isize_min, self.isize_max)[0]
+                self.assertEqual(genotype.split(":")[0], expected_gt, "%d bp at %.1f: %s" % (
+                    end - 10000, alt_frac, genotype))
 
 
 if __name__ == "__main__":
@@ -223,16 +675,23 @@ if __name__ == "__main__":
     parser.add_argument("--window", help="Window to use for genotyping", default=GT_WINDOW, type=int)
     parser.add_argument("--isize_mean", help="Insert size mean", default=ISIZE_MEAN, type=float)
     parser.add_argument("--isize_sd", help="Insert size standard deviation", default=ISIZE_SD, type=float)
-    parser.add_argument("--normal_frac", help="Minimum fraction of normal reads to call heterozygous",
-                        default=GT_NORMAL_FRAC, type=float)
+    parser.add_argument("--error_rate", "--normal_frac", dest="error_rate",
+                        help="Expected fraction of reads of the other allele for homozygous calls. --normal_frac is a "
+                             "deprecated alias", default=GT_ERROR_RATE, type=float)
+    parser.add_argument("--mean_read_length", help="Mean read length, used to balance the work between threads",
+                        default=MEAN_READ_LENGTH, type=float)
+    parser.add_argument("--mean_read_coverage", help="Mean read coverage, used to balance the work between threads",
+                        default=MEAN_READ_COVERAGE, type=float)
 
     args = parser.parse_args()
 
     logger.info("Command-line: " + " ".join(sys.argv))
+    if any(arg.split("=")[0] == "--normal_frac" for arg in sys.argv[1:]):
+        logger.warn("--normal_frac is deprecated, use --error_rate instead")
 
     genotyped_bed = parallel_genotype_intervals(args.intervals_file.name, args.bams, args.workdir, args.nthreads,
                                                 args.chromosomes, args.window, args.isize_mean, args.isize_sd,
-                                                args.normal_frac)
+                                                args.error_rate, args.mean_read_length, args.mean_read_coverage)
     if genotyped_bed:
         logger.info("Generated genotyped BED as %s" % genotyped_bed)
         sys.exit(os.EX_OK)
@@ -0,0 +1,34 @@
+import base64
+import json
+import zlib
+
+# INFO dictionaries are carried from stage to stage base64 encoded in the first comma-separated item of the
+# BED name field. Large ones, like the soft-clip sub-interval lists, are zlib compressed first and marked with
+# a prefix which can't appear in base64.
+COMPRESSED_INFO_PREFIX = "z:"
+COMPRESS_INFO_MIN_SIZE = 256
+MAX_DECODED_INFOS = 100000
+
+decoded_infos = {}
+
+
+def encode_info(info):
+    info_json = json.dumps(info, separators=(",", ":"))
+    if len(info_json) >= COMPRESS_INFO_MIN_SIZE:
+        return COMPRESSED_INFO_PREFIX + base64.b64encode(zlib.compress(info_json))
+    return base64.b64encode(info_json)
+
+
+def decode_info(encoded_info):
+    # The same name field is decoded by several stages, so decoded dictionaries are cached per process.
+    # Callers get their own copy of the top-level dictionary and can update it freely.
+    info = decoded_infos.get(encoded_info)
+    if info is None:
+        if encoded_info.startswith(COMPRESSED_INFO_PREFIX):
+            info = json.loads(zlib.decompress(base64.b64decode(encoded_info[len(COMPRESSED_INFO_PREFIX):])))
+        else:
+            info = json.loads(base64.b64decode(encoded_info))
+        if len(decoded_infos) >= MAX_DECODED_INFOS:
+            decoded_infos.clear()
+        decoded_infos[encoded_info] = info
+    return dict(info)
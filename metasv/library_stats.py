@@ -0,0 +1,246 @@
+import argparse
+import json
+import logging
+import os
+import random
+import struct
+from defaults import *
+from bam_utils import get_bam_handle, get_bam_contigs, is_bam_handle_open, close_bam_handle
+
+logger = logging.getLogger(__name__)
+
+LIBRARY_STATS_SUFFIX = ".metasv_stats.json"
+LIBRARY_STATS_VERSION = 1
+
+# The linear index of a BAI has the offset of the first read overlapping every 16 kbp window. The pseudo-bin holds
+# the offsets of the start and the end of the contig's reads.
+BAI_LINEAR_WINDOW = 16384
+BAI_PSEUDO_BIN = 37450
+
+
+def get_index_file(bam):
+    for index_file in [bam + ".bai", os.path.splitext(bam)[0] + ".bai", bam + ".csi", bam + ".crai"]:
+        if os.path.isfile(index_file):
+            return index_file
+    return None
+
+
+def get_index_read_volumes(bam):
+    # Compressed bytes of the reads in each linear index window per contig, from the BAI alone. Deeper windows take
+    # up more of the BAM, so this is a local depth estimate which doesn't read any alignments. None without a BAI.
+    index_file = get_index_file(bam)
+    if index_file is None or not index_file.endswith(".bai"):
+        return None
+
+    contigs = [chrom for chrom, length in get_bam_contigs(bam)]
+    volumes = {}
+    with open(index_file, "rb") as index_fd:
+        magic, num_refs = struct.unpack("<4si", index_fd.read(8))
+        if magic != "BAI\1" or num_refs != len(contigs):
+            return None
+        for chrom in contigs:
+            reads_end = None
+            num_bins, = struct.unpack("<i", index_fd.read(4))
+            for bin_index in xrange(num_bins):
+                bin_id, num_chunks = struct.unpack("<Ii", index_fd.read(8))
+                chunks = index_fd.read(16 * num_chunks)
+                if bin_id == BAI_PSEUDO_BIN:
+                    reads_end = struct.unpack("<QQ", chunks[:16])[1]
+            num_windows, = struct.unpack("<i", index_fd.read(4))
+            offsets = [offset >> 16 for offset in
+                       struct.unpack("<%dQ" % num_windows, index_fd.read(8 * num_windows))]
+            if reads_end is not None:
+                offsets.append(reads_end >> 16)
+
+            # Windows without reads may have no offset, they get the one of the window before
+            previous_offset = next((offset for offset in offsets if offset), 0)
+            for index, offset in enumerate(offsets):
+                offsets[index] = previous_offset = offset or previous_offset
+            volumes[chrom] = [max(0, next_offset - offset) for offset, next_offset in zip(offsets, offsets[1:])]
+    return volumes
+
+
+def median(sorted_values):
+    mid = len(sorted_values) / 2
+    if len(sorted_values) % 2:
+        return float(sorted_values[mid])
+    return (sorted_values[mid - 1] + sorted_values[mid]) / 2.0
+
+
+def robust_isize_stats(isizes):
+    # Median and MAD based SD so that the long tail of chimeric and SV-spanning pairs doesn't inflate the estimates
+    isizes = sorted(isizes)
+    isize_median = median(isizes)
+    isize_mad = median(sorted([abs(isize - isize_median) for isize in isizes]))
+    return {"isize_mean": isize_median, "isize_sd": 1.4826 * isize_mad, "num_pairs": len(isizes)}
+
+
+def sample_library_stats(bam, chromosomes=[], num_loci=LIBRARY_STATS_NUM_LOCI, min_mapq=LIBRARY_STATS_MIN_MAPQ,
+                         seed=0):
+    func_logger = logging.getLogger(sample_library_stats.__name__)
+
+    sam_file = get_bam_handle(bam)
+    contigs = [(chrom, length) for chrom, length in zip(sam_file.references, sam_file.lengths) if
+               not chromosomes or chrom in chromosomes]
+    genome_length = sum([length for chrom, length in contigs])
+    if not genome_length:
+        return None
+
+    # Loci are drawn uniformly over the selected contigs and each one costs a single index seek. Loci without
+    # any read, like gaps or contigs nothing maps to, don't count towards the depth.
+    rand = random.Random(seed)
+    loci = sorted([rand.randint(0, genome_length - 1) for i in xrange(num_loci)])
+
+    num_covered_loci = 0
+    depth_sum = 0
+    num_reads = 0
+    read_length_sum = 0
+    isizes = {}
+    seen_reads = set()
+    contig_index = 0
+    contig_offset = 0
+    for locus in loci:
+        while locus >= contig_offset + contigs[contig_index][1]:
+            contig_offset += contigs[contig_index][1]
+            contig_index += 1
+        chrom = contigs[contig_index][0]
+        pos = locus - contig_offset
+
+        depth = 0
+        for aln in sam_file.fetch(chrom, pos, pos + 1):
+            if aln.is_unmapped:
+                continue
+            depth += 1
+
+            # Nearby loci can share reads, these are only counted once for the read length and insert size
+            read_key = (aln.qname, aln.is_read1, aln.pos)
+            if read_key in seen_reads:
+                continue
+            seen_reads.add(read_key)
+
+            num_reads += 1
+            read_length_sum += aln.rlen
+            if not aln.is_proper_pair or not aln.is_read1 or aln.mapq < min_mapq or aln.tlen == 0:
+                continue
+            try:
+                read_group = aln.opt("RG")
+            except KeyError:
+                read_group = ""
+            isizes.setdefault(read_group, []).append(abs(aln.tlen))
+
+        if depth:
+            num_covered_loci += 1
+            depth_sum += depth
+
+    if not num_reads:
+        func_logger.warn("No reads found at %d sampled loci in %s" % (num_loci, bam))
+        return None
+
+    stats = {"mean_read_length": float(read_length_sum) / num_reads,
+             "mean_read_coverage": float(depth_sum) / num_covered_loci,
+             "num_loci": num_loci, "num_covered_loci": num_covered_loci,
+             "read_groups": dict([(name, robust_isize_stats(read_group_isizes)) for
+                                  name, read_group_isizes in isizes.items()])}
+    all_isizes = sum(isizes.values(), [])
+    if all_isizes:
+        stats.update(robust_isize_stats(all_isizes))
+    return stats
+
+
+def get_library_stats(bam, chromosomes=[], num_loci=LIBRARY_STATS_NUM_LOCI, min_mapq=LIBRARY_STATS_MIN_MAPQ):
+    func_logger = logging.getLogger(get_library_stats.__name__)
+
+    # The stats are cached next to the BAM and are recomputed whenever the index changes
+    index_file = get_index_file(bam)
+    if index_file is None:
+        func_logger.warn("BAM %s is not indexed, can't estimate library statistics" % bam)
+        return None
+    cache_key = {"version": LIBRARY_STATS_VERSION, "index_mtime": os.path.getmtime(index_file),
+                 "chromosomes": sorted(chromosomes), "num_loci": num_loci, "min_mapq": min_mapq}
+
+    stats_file = bam + LIBRARY_STATS_SUFFIX
+    if os.path.isfile(stats_file):
+        try:
+            with open(stats_file) as stats_fd:
+                cached = json.load(stats_fd)
+            if cached.get("key") == cache_key:
+                func_logger.info("Loaded library statistics for %s from %s" % (bam, stats_file))
+                return cached["stats"]
+        except (IOError, ValueError):
+            func_logger.warn("Ignoring unreadable library statistics in %s" % stats_file)
+
+    func_logger.info("Sampling %d loci from %s for library statistics" % (num_loci, bam))
+    stats = sample_library_stats(bam, chromosomes=chromosomes, num_loci=num_loci, min_mapq=min_mapq)
+    if stats is None:
+        return None
+
+    try:
+        with open(stats_file, "w") as stats_fd:
+            json.dump({"key": cache_key, "stats": stats}, stats_fd, indent=2, sort_keys=True)
+    except IOError:
+        func_logger.warn("Could not cache library statistics in %s" % stats_file)
+    return stats
+
+
+def combine_library_stats(stats_list):
+    # Insert sizes and read lengths are pooled over the BAMs. The coverage filters look at one BAM at a time,
+    # so the depth is averaged instead of summed.
+    stats_list = filter(None, stats_list)
+    if not stats_list:
+        return None
+
+    combined = {"mean_read_length": sum([stats["mean_read_length"] for stats in stats_list]) / len(stats_list),
+                "mean_read_coverage": sum([stats["mean_read_coverage"] for stats in stats_list]) / len(stats_list)}
+
+    isize_stats_list = [stats for stats in stats_list if "isize_mean" in stats]
+    num_pairs = sum([stats["num_pairs"] for stats in isize_stats_list])
+    if num_pairs:
+        isize_mean = sum([stats["isize_mean"] * stats["num_pairs"] for stats in isize_stats_list]) / num_pairs
+        isize_var = sum([(stats["isize_sd"] ** 2 + (stats["isize_mean"] - isize_mean) ** 2) * stats["num_pairs"] for
+                         stats in isize_stats_list]) / num_pairs
+        combined.update({"isize_mean": isize_mean, "isize_sd": isize_var ** 0.5, "num_pairs": num_pairs})
+    return combined
+
+
+def set_library_stats_defaults(args, bams, chromosomes=[]):
+    # Fill in the library parameters not given on the command-line, falling back to the defaults if the BAMs
+    # can't tell
+    stats_defaults = [("isize_mean", ISIZE_MEAN), ("isize_sd", ISIZE_SD), ("mean_read_length", MEAN_READ_LENGTH),
+                      ("mean_read_coverage", MEAN_READ_COVERAGE)]
+    missing = [name for name, default in stats_defaults if getattr(args, name, None) is None]
+
+    stats = None
+    if missing and bams:
+        # Only the handles opened here are closed, before the stages fork their pools
+        opened_bams = [bam for bam in bams if not is_bam_handle_open(bam)]
+        stats = combine_library_stats([get_library_stats(bam, chromosomes=chromosomes) for bam in bams])
+        for bam in opened_bams:
+            close_bam_handle(bam)
+
+    for name, default in stats_defaults:
+        if getattr(args, name, None) is not None:
+            continue
+        if stats is not None and name in stats:
+            setattr(args, name, stats[name])
+            logger.info("Estimated %s from the BAMs as %.2f" % (name, stats[name]))
+        else:
+            setattr(args, name, default)
+            logger.info("Using default %s of %.2f" % (name, default))
+
+
+if __name__ == "__main__":
+    FORMAT = '%(levelname)s %(asctime)-15s %(name)-20s %(message)s'
+    logging.basicConfig(level=logging.INFO, format=FORMAT)
+
+    parser = argparse.ArgumentParser(description="Estimate library statistics by sampling reads from an indexed BAM",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--bam", help="Indexed BAM", required=True)
+    parser.add_argument("--chromosomes", nargs="+", help="Chromosomes to sample from", default=[])
+    parser.add_argument("--num_loci", type=int, help="Number of loci to sample", default=LIBRARY_STATS_NUM_LOCI)
+    parser.add_argument("--min_mapq", type=int, help="Minimum MAPQ for insert-size estimation",
+                        default=LIBRARY_STATS_MIN_MAPQ)
+
+    args = parser.parse_args()
+
+    print json.dumps(get_library_stats(args.bam, chromosomes=args.chromosomes, num_loci=args.num_loci,
+                                       min_mapq=args.min_mapq), indent=2, sort_keys=True)
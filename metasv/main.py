@@ -1,9 +1,13 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import shutil
+import multiprocessing
+import operator
+import traceback
+from functools import partial
 
 from defaults import *
 from vcf_utils import *
-from sv_interval import SVInterval, get_gaps_file, interval_overlaps_interval_list, merge_intervals, merge_intervals_recursively
+from sv_interval import SVInterval, IntervalIndex, get_gaps_file, merge_intervals, merge_intervals_recursively
 from pindel_reader import PindelReader
 from breakdancer_reader import BreakDancerReader
 from breakseq_reader import BreakSeqReader
@@ -14,6 +18,8 @@ from run_age import run_age_parallel
 from generate_final_vcf import convert_metasv_bed_to_vcf
 from fasta_utils import get_contigs
 from genotype import parallel_genotype_intervals
+from library_stats import set_library_stats_defaults
+from bam_utils import set_alignment_options
 from _version import __version__
 
 FORMAT = '%(levelname)s %(asctime)-15s %(name)-20s %(message)s'
@@ -28,6 +34,118 @@ def create_dirs(dirlist):
             os.makedirs(dirname)
 
 
+def load_native_intervals(index, native_file, toolname, sv_reader, gap_intervals, contig_whitelist,
+                          svs_to_report=SVS_SUPPORTED, minsvlen=MIN_SV_LENGTH, wiggle=WIGGLE, inswiggle=INS_WIGGLE,
+                          bd_min_inv_len=0):
+    func_logger = logging.getLogger("%s-%s" % (load_native_intervals.__name__, multiprocessing.current_process()))
+
+    func_logger.info("Loading SV intervals from %s" % native_file)
+    intervals = defaultdict(list)
+    try:
+        for record in sv_reader(native_file, svs_to_report=svs_to_report):
+            interval = record.to_sv_interval()
+            if not interval:
+                # This is the case for SVs we want to skip
+                continue
+            if toolname == "BreakDancer" and interval.sv_type == "INV" and abs(interval.length) < bd_min_inv_len:
+                # Filter BreakDancer artifact INVs with size < readlength+4*isize_sd
+                continue
+            if interval.chrom in contig_whitelist and not gap_intervals.overlaps(interval):
+
+                # Check length
+                if interval.length < minsvlen and interval.sv_type not in ["ITX", "CTX"]:
+                    continue
+
+                # Set wiggle
+                if interval.sv_type not in ["ITX", "CTX"]:
+                    interval.wiggle = max(inswiggle if interval.sv_type == "INS" else 0, wiggle)
+                else:
+                    interval.wiggle = TX_WIGGLE
+
+                intervals[interval.sv_type].append(interval)
+    except Exception as e:
+        func_logger.error('Caught exception in worker thread')
+
+        # This prints the type, value, and stack trace of the
+        # current exception being handled.
+        traceback.print_exc()
+
+        print()
+        raise e
+
+    return index, dict(intervals)
+
+
+def load_vcf_intervals(index, vcffile, toolname, gap_intervals, include_intervals, contig_whitelist,
+                       minsvlen=MIN_SV_LENGTH, wiggle=WIGGLE, inswiggle=INS_WIGGLE, svs_to_report=SVS_SUPPORTED,
+                       maxsvlen=MAX_SV_LENGTH):
+    func_logger = logging.getLogger("%s-%s" % (load_vcf_intervals.__name__, multiprocessing.current_process()))
+
+    try:
+        intervals = load_intervals(vcffile, {}, gap_intervals, include_intervals, toolname, contig_whitelist,
+                                   minsvlen=minsvlen, wiggle=wiggle, inswiggle=inswiggle,
+                                   svs_to_report=svs_to_report, maxsvlen=maxsvlen)
+
+        # PyVCF calls reference their whole records, so only their GT strings are sent back
+        for sv_type_intervals in intervals.values():
+            for interval in sv_type_intervals:
+                if interval.gt is not None:
+                    interval.gt = getattr(interval.gt.data, "GT", None)
+    except Exception as e:
+        func_logger.error('Caught exception in worker thread')
+
+        # This prints the type, value, and stack trace of the
+        # current exception being handled.
+        traceback.print_exc()
+
+        print()
+        raise e
+
+    return index, intervals
+
+
+def load_input_callback(result, result_list):
+    if result is not None:
+        result_list.append(result)
+
+
+def merge_contig_intervals(index, chrom, sv_type, tool_intervals, overlap_ratio=OVERLAP_RATIO, minsvlen=MIN_SV_LENGTH,
+                           maxsvlen=MAX_SV_LENGTH):
+    func_logger = logging.getLogger("%s-%s" % (merge_contig_intervals.__name__, multiprocessing.current_process()))
+
+    try:
+        # Do the intra-tool merging
+        tool_merged_intervals = []
+        for intervals in tool_intervals:
+            tool_merged_intervals += merge_intervals(intervals)
+
+        # Do the inter-tool merging
+        final_intervals = []
+        for interval in merge_intervals_recursively(tool_merged_intervals, overlap_ratio):
+            interval.do_validation(overlap_ratio)
+            interval.fix_pos()
+            if minsvlen <= interval.length <= maxsvlen or interval.sv_type in ["ITX", "CTX"]:
+                final_intervals.append(interval)
+    except Exception as e:
+        func_logger.error('Caught exception in worker thread')
+
+        # This prints the type, value, and stack trace of the
+        # current exception being handled.
+        traceback.print_exc()
+
+        print()
+        raise e
+
+    func_logger.info("Merged %d SVs of type %s on %s into %d" % (
+        sum(map(len, tool_intervals)), sv_type, chrom, len(final_intervals)))
+    return index, chrom, final_intervals
+
+
+def merge_contig_intervals_callback(result, result_list):
+    if result is not None:
+        result_list.append(result)
+
+
 def run_metasv(args):
     logger.info("Running MetaSV %s" % __version__)
     logger.info("Arguments are " + str(args))
@@ -60,7 +178,7 @@ def run_metasv(args):
 
     fasta_handle = pysam.Fastafile(args.reference) if os.path.isfile(args.reference) else None
     contigs = get_contigs(args.reference)
-    include_intervals = sorted(
+    include_intervals = IntervalIndex(
         [SVInterval(contig.name, 0, contig.length, contig.name, "include", length=contig.length) for contig in contigs])
 
     # Generate the list of contigs to process
@@ -71,6 +189,12 @@ def run_metasv(args):
                                                                                         "chrM"])
     logger.info("Only SVs on the following contigs will be reported: %s" % (sorted(list(contig_whitelist))))
 
+    # CRAMs are decoded against the same reference
+    set_alignment_options(reference=args.reference, decoding_threads=args.bam_decoding_threads)
+
+    # Library parameters not given on the command-line are estimated by sampling the BAMs
+    set_library_stats_defaults(args, args.bams, chromosomes=sorted(list(contig_whitelist)))
+
     # Load the intervals from different files
     vcf_name_list = [("CNVnator", args.cnvnator_vcf), ("Pindel", args.pindel_vcf),
                      ("BreakDancer", args.breakdancer_vcf),
@@ -86,54 +210,39 @@ def run_metasv(args):
     intervals = {}
     sv_types = set()
 
-    gap_intervals = []
+    gap_intervals = IntervalIndex()
     if args.filter_gaps:
         gaps = args.gaps if args.gaps else get_gaps_file(contig_whitelist)
-        gap_intervals = sorted(load_gap_intervals(gaps))
+        gap_intervals = IntervalIndex(load_gap_intervals(gaps))
+
+    # Every (tool, file) pair is loaded in its own process
+    load_tasks = []
 
     # Handles native input
-    logger.info("Load native files")
     for toolname, nativename, svReader in native_name_list:
         # If no native file is given, ignore the tool
         if not nativename: continue
 
-        tools.append(toolname)
-        intervals[toolname] = defaultdict(list)
+        if toolname not in intervals:
+            tools.append(toolname)
+            intervals[toolname] = {}
 
         for native_file in nativename:
-            for record in svReader(native_file, svs_to_report=args.svs_to_report):
-                interval = record.to_sv_interval()
-                if not interval:
-                    # This is the case for SVs we want to skip
-                    continue
-                BD_min_inv_len = args.mean_read_length+4*args.isize_sd
-                if toolname=="BreakDancer" and interval.sv_type == "INV" and  abs(interval.length)< BD_min_inv_len:
-                    #Filter BreakDancer artifact INVs with size < readlength+4*isize_sd
-                    continue
-                if not interval_overlaps_interval_list(interval, gap_intervals) and interval.chrom in contig_whitelist:
-                    
-                    # Check length
-                    if interval.length < args.minsvlen and interval.sv_type not in  ["ITX", "CTX"]:
-                        continue
-
-                    # Set wiggle
-                    if interval.sv_type not in ["ITX","CTX"]:
-                        interval.wiggle = max(args.inswiggle if interval.sv_type == "INS" else 0, args.wiggle)
-                    else:
-                        interval.wiggle = TX_WIGGLE
-                    
-                    intervals[toolname][interval.sv_type].append(interval)
-        sv_types |= set(intervals[toolname].keys())
+            kwargs_dict = {"svs_to_report": args.svs_to_report, "minsvlen": args.minsvlen, "wiggle": args.wiggle,
+                           "inswiggle": args.inswiggle,
+                           "bd_min_inv_len": args.mean_read_length + 4 * args.isize_sd}
+            load_tasks.append((toolname, load_native_intervals,
+                               [native_file, toolname, svReader, gap_intervals, contig_whitelist], kwargs_dict))
 
     # Handles the VCF input cases, we will just deal with these cases
-    logger.info("Load VCF files")
     for toolname, vcfname in vcf_name_list:
         # If no VCF is given, ignore the tool
         if not vcfname:
             continue
 
-        tools.append(toolname)
-        intervals[toolname] = {}
+        if toolname not in intervals:
+            tools.append(toolname)
+            intervals[toolname] = {}
 
         vcf_list = []
         for vcffile in vcfname:
@@ -145,14 +254,33 @@ def run_metasv(args):
                 vcf_list.append(vcffile)
 
         for vcffile in vcf_list:
-            load_intervals(vcffile, intervals[toolname], gap_intervals, include_intervals, toolname, contig_whitelist,
-                           minsvlen=args.minsvlen, wiggle=args.wiggle, inswiggle=args.inswiggle,
-                           svs_to_report=args.svs_to_report, maxsvlen=args.maxsvlen)
+            kwargs_dict = {"minsvlen": args.minsvlen, "wiggle": args.wiggle, "inswiggle": args.inswiggle,
+                           "svs_to_report": args.svs_to_report, "maxsvlen": args.maxsvlen}
+            load_tasks.append((toolname, load_vcf_intervals,
+                               [vcffile, toolname, gap_intervals, include_intervals, contig_whitelist], kwargs_dict))
+
+    logger.info("Load %d native and VCF files using %d processes" % (len(load_tasks), args.num_threads))
+    pool = multiprocessing.Pool(args.num_threads)
+    loaded_results = []
+    for index, (toolname, load_function, load_args, kwargs_dict) in enumerate(load_tasks):
+        pool.apply_async(load_function, args=[index] + load_args, kwds=kwargs_dict,
+                         callback=partial(load_input_callback, result_list=loaded_results))
+    pool.close()
+    pool.join()
+
+    if len(loaded_results) != len(load_tasks):
+        logger.error("Loading failed for %d files" % (len(load_tasks) - len(loaded_results)))
+        return 1
+
+    # Keep the input order so merging does not depend on which file finished first
+    for index, file_intervals in sorted(loaded_results, key=operator.itemgetter(0)):
+        toolname = load_tasks[index][0]
+        for sv_type, sv_type_intervals in file_intervals.iteritems():
+            intervals[toolname].setdefault(sv_type, []).extend(sv_type_intervals)
+    for toolname in tools:
         sv_types |= set(intervals[toolname].keys())
 
     logger.info("SV types are %s" % (str(sv_types)))
-    tool_merged_intervals = {}
-    final_intervals = []
 
     # This will just output per-tool VCFs, no intra-tool merging is done yet
     if args.enable_per_tool_output:
@@ -170,7 +298,7 @@ def run_metasv(args):
             chr_intervals_tool = {contig.name: [] for contig in contigs}
             for sv_type in sv_types:
                 if sv_type in intervals[toolname]:
-                    intervals_tool.extend([copy.deepcopy(interval) for interval in intervals[toolname][sv_type]])
+                    intervals_tool.extend([interval.shallow_copy() for interval in intervals[toolname][sv_type]])
             for interval in intervals_tool:
                 # Marghoob says that this is just to fill-in some metadata
                 interval.do_validation(args.overlap_ratio)
@@ -190,32 +318,39 @@ def run_metasv(args):
             pysam.tabix_index(tool_out, force=True, preset="vcf")
 
 
-    # Do merging here
+    # Do merging here. Merging never crosses contigs, so every (contig, SV type) partition is merged,
+    # validated and filtered in its own process
     logger.info("Do merging")
+    partitions = OrderedDict()
     for sv_type in sv_types:
-        logger.info("Processing SVs of type %s" % sv_type)
-        tool_merged_intervals[sv_type] = []
-
-        # Do the intra-tool merging
-        logger.info("Intra-tool Merging SVs of type %s" % sv_type)
         for tool in tools:
-            logger.debug("Is %s in tool keys? %s" % (sv_type, str(intervals[tool].keys())))
             if sv_type not in intervals[tool]:
-                logger.debug("%s not in tool %s" % (sv_type, tool))
                 continue
-            logger.info("First level merging for %s for tool %s" % (sv_type, tool))
-            tool_merged_intervals[sv_type] += merge_intervals(intervals[tool][sv_type])
-
-        # Do the inter-tool merging
-        logger.info("Inter-tool Merging SVs of type %s" % sv_type)
-        final_intervals.extend(merge_intervals_recursively(tool_merged_intervals[sv_type],args.overlap_ratio))
+            tool_chr_intervals = defaultdict(list)
+            for interval in intervals[tool][sv_type]:
+                tool_chr_intervals[interval.chrom].append(interval)
+            for chrom in sorted(tool_chr_intervals.keys()):
+                partitions.setdefault((chrom, sv_type), []).append(tool_chr_intervals[chrom])
+    logger.info("Merging %d (contig, SV type) partitions using %d processes" % (len(partitions), args.num_threads))
+
+    pool = multiprocessing.Pool(args.num_threads)
+    merged_results = []
+    for index, ((chrom, sv_type), tool_intervals) in enumerate(partitions.iteritems()):
+        kwargs_dict = {"overlap_ratio": args.overlap_ratio, "minsvlen": args.minsvlen, "maxsvlen": args.maxsvlen}
+        pool.apply_async(merge_contig_intervals, args=[index, chrom, sv_type, tool_intervals], kwds=kwargs_dict,
+                         callback=partial(merge_contig_intervals_callback, result_list=merged_results))
+    pool.close()
+    pool.join()
+
+    if len(merged_results) != len(partitions):
+        logger.error("Merging failed for %d partitions" % (len(partitions) - len(merged_results)))
+        return 1
 
+    # Results come back in completion order. They are put back in partition order, which the stable sort below
+    # keeps for calls at the same coordinates.
     final_chr_intervals = {contig.name: [] for contig in contigs}
-    for interval in final_intervals:
-        interval.do_validation(args.overlap_ratio)
-        interval.fix_pos()
-        if args.minsvlen <= interval.length <= args.maxsvlen or interval.sv_type in ["ITX", "CTX"]:
-            final_chr_intervals[interval.chrom].append(interval)
+    for index, chrom, chr_intervals in sorted(merged_results, key=operator.itemgetter(0)):
+        final_chr_intervals[chrom].extend(chr_intervals)
 
     # This is the merged VCF without assembly, ok for deletions at this point
     logger.info("Output merged VCF without assembly ")
@@ -286,7 +421,8 @@ def run_metasv(args):
                                                           mean_read_coverage=args.mean_read_coverage, 
                                                           min_ins_cov_frac=args.min_ins_cov_frac,
                                                           max_ins_cov_frac=args.max_ins_cov_frac,
-                                                          assembly_max_tools=args.assembly_max_tools)
+                                                          assembly_max_tools=args.assembly_max_tools,
+                                                          tile_size=args.sc_tile_size)
             logger.info("Generated intervals for assembly in %s" % assembly_bed)
 
         logger.info("Will run assembly now")
@@ -308,7 +444,7 @@ def run_metasv(args):
                                            min_contig_len=AGE_MIN_CONTIG_LENGTH, min_del_subalign_len=args.min_del_subalign_len,
                                            min_inv_subalign_len=args.min_inv_subalign_len,
                                            age_window=args.age_window,
-                                           age_workdir=age_tmpdir)
+                                           age_workdir=age_tmpdir, max_age_procs=args.age_procs_per_thread)
 
         final_bed = os.path.join(args.workdir, "final.bed")
         if breakpoints_bed:
@@ -328,7 +464,9 @@ def run_metasv(args):
                                                     nthreads=args.num_threads, chromosomes=list(contig_whitelist),
                                                     window=args.gt_window, isize_mean=args.isize_mean,
                                                     isize_sd=args.isize_sd,
-                                                    normal_frac_threshold=args.gt_normal_frac)
+                                                    error_rate=args.gt_error_rate,
+                                                    mean_read_length=args.mean_read_length,
+                                                    mean_read_coverage=args.mean_read_coverage)
 
         logger.info("Output final VCF file")
 
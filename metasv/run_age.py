@@ -4,10 +4,9 @@ import argparse
 import multiprocessing
 import subprocess
 import hashlib
+from collections import OrderedDict
 from functools import partial
-import json
-import base64
-from external_cmd import TimedExternalCmd
+from external_cmd import TimedExternalCmd, TimedExternalCmdPool
 
 import pysam
 import pybedtools
@@ -18,6 +17,8 @@ from svregion import SVRegion
 from age_parser import *
 from process_age_alignment import process_age_records
 from defaults import *
+from fasta_utils import SharedSequences, get_contigs
+from info_utils import encode_info, decode_info
 
 FORMAT = '%(levelname)s %(asctime)-15s %(name)-20s %(message)s'
 logging.basicConfig(level=logging.INFO, format=FORMAT)
@@ -36,163 +37,317 @@ def run_cmd(cmd, logger, out, err):
     return retcode
 
 
+# Reference windows and contigs preloaded by run_age_parallel, inherited by the pool workers
+age_sequences = None
+
+
+def init_age_worker(sequences):
+    global age_sequences
+    age_sequences = sequences
+
+
+class SharedFastafile:
+    # Serves fetch() from the shared sequences and only opens the FASTA for sequences which weren't preloaded
+    def __init__(self, sequences, fasta, name):
+        self.sequences = sequences
+        self.fasta = fasta
+        self.name = name
+        self.fasta_handle = None
+
+    def fetch(self, reference=None, start=None, end=None):
+        key = (self.name, reference, start, end)
+        if key in self.sequences:
+            return self.sequences.fetch(key)
+        if self.fasta_handle is None:
+            self.fasta_handle = pysam.Fastafile(self.fasta)
+        return self.fasta_handle.fetch(reference=reference, start=start, end=end)
+
+    def close(self):
+        if self.fasta_handle is not None:
+            self.fasta_handle.close()
+
+
+def load_age_sequences(region_list, contig_dict, reference, assembly, pad=AGE_PAD):
+    # The buffer is laid out from the region coordinates and the FASTA indexes first, so every sequence goes
+    # straight from the FASTA into shared memory and the parent never holds more than one of them
+    reference_fasta = pysam.Fastafile(reference)
+    reference_lengths = dict([(contig.name, contig.length) for contig in get_contigs(reference)])
+    sequence_lengths = OrderedDict()
+    for region in region_list:
+        region_object = SVRegion(*region)
+        if region_object.pos1 - pad < 0 or region_object.chrom1 not in reference_lengths:
+            continue
+        key = ("reference", region_object.chrom1, region_object.pos1 - pad, region_object.pos2 + pad)
+        sequence_lengths[key] = max(0, min(key[3], reference_lengths[key[1]]) - key[2])
+
+    assembly_fasta = None
+    if assembly:
+        assembly_fasta = pysam.Fastafile(assembly)
+        assembly_lengths = dict([(contig.name, contig.length) for contig in get_contigs(assembly)])
+        raw_names = set([contig.raw_name for region in region_list for contig in contig_dict[region]])
+        for raw_name in sorted(raw_names):
+            if raw_name in assembly_lengths:
+                sequence_lengths[("assembly", raw_name, None, None)] = assembly_lengths[raw_name]
+
+    sequences = SharedSequences(sequence_lengths.items())
+    for key in sequence_lengths:
+        if key[0] == "reference":
+            sequences.store(key, reference_fasta.fetch(reference=key[1], start=key[2], end=key[3]))
+        else:
+            sequences.store(key, assembly_fasta.fetch(key[1]))
+
+    reference_fasta.close()
+    if assembly_fasta:
+        assembly_fasta.close()
+
+    return sequences
+
+
+def load_matching_intervals(intervals_bed, region_list):
+    # Fields of the first BED record for each (chrom, start, end) of the regions, read in a single pass
+    region_keys = set([(region[0], region[1], region[3]) for region in region_list])
+    matching_intervals = {}
+    if intervals_bed:
+        for interval in pybedtools.BedTool(intervals_bed):
+            key = (interval.chrom, interval.start, interval.end)
+            if key in region_keys and key not in matching_intervals:
+                matching_intervals[key] = tuple(interval.fields)
+    return matching_intervals
+
+
+def prepare_age_region(region, matching_intervals, reference_fasta, pad=AGE_PAD, age_workdir=None,
+                       truncation_pad_read_age=AGE_TRUNCATION_PAD, dist_to_expected_bp=AGE_DIST_TO_BP,
+                       logger=None):
+    bedtools_interval = pybedtools.Interval(region[0], region[1], region[3])
+    matching_fields = matching_intervals.get((bedtools_interval.chrom, bedtools_interval.start, bedtools_interval.end))
+    if matching_fields is None:
+        logger.info("Matching interval not found for %s" % (str(bedtools_interval)))
+        matching_interval = bedtools_interval
+    else:
+        matching_interval = pybedtools.create_interval_from_list(list(matching_fields))
+    logger.info("Matching interval %s" % (str(matching_interval)))
+    sc_locations = []
+    try:
+        sc_locations = map(int, decode_info(matching_interval.name.split(",")[0])["SC_LOCATIONS"].split(","))
+    except:
+        pass
+
+    region_object = SVRegion(region[0], region[1], region[2], region[3])
+    if region_object.pos1 - pad < 0:
+        logger.error("Region too close to start of chromosome. Skipping.")
+        return None
+
+    reference_sequence = reference_fasta.fetch(reference=region_object.chrom1, start=region_object.pos1 - pad,
+                                               end=region_object.pos2 + pad)
+    region_name = "%s.%d.%d" % (region_object.chrom1, region_object.pos1, region_object.pos2)
+    ref_name = os.path.join(age_workdir, "%s.ref.fa" % region_name)
+
+    logger.info("Writing the ref sequence for region %s" % region_name)
+    with open(ref_name, "w") as file_handle:
+        file_handle.write(">{}.ref\n{}".format(region_name, reference_sequence))
+
+    # For large SVs, middle sequences has no effect on genotyping. So, the middle region of the reference can be
+    # truncated to speed up. The truncated reference is the same for all the contigs of the region.
+    truncate_start = pad + dist_to_expected_bp + truncation_pad_read_age + 1
+    truncate_end = len(reference_sequence) - (pad + dist_to_expected_bp + truncation_pad_read_age)
+    region_name_tr = "%s.%d.%d.tr_%d_%d" % (region_object.chrom1, region_object.pos1, region_object.pos2,
+                                            truncate_start, truncate_end)
+
+    return {"matching_interval": matching_interval, "sc_locations": sc_locations, "region_object": region_object,
+            "reference_sequence": reference_sequence, "region_name": region_name, "ref_name": ref_name,
+            "truncate_start": truncate_start, "truncate_end": truncate_end,
+            "ref_name_tr": os.path.join(age_workdir, "%s.ref.fa" % region_name_tr), "region_name_tr": region_name_tr,
+            "age_records": [], "num_pending": 0, "submitted": False}
+
+
+def get_truncated_ref(region_state, logger=None):
+    if "ref_len_tr" not in region_state:
+        logger.info("Truncate the reference sequence.")
+        reference_sequence = region_state["reference_sequence"]
+        reference_sequence_tr = reference_sequence[0:region_state["truncate_start"] - 1] + reference_sequence[
+                                                                                          region_state["truncate_end"]:]
+        logger.info("Writing the truncated ref sequence for region %s" % region_state["region_name_tr"])
+        with open(region_state["ref_name_tr"], "w") as file_handle:
+            file_handle.write(">{}.ref\n{}".format(region_state["region_name_tr"], reference_sequence_tr))
+        region_state["ref_len_tr"] = len(reference_sequence_tr)
+    return region_state["ref_name_tr"], region_state["ref_len_tr"]
+
+
+def generate_age_jobs(region_list, region_states, contig_dict, matching_intervals, reference_fasta, assembly_fasta,
+                      pad=AGE_PAD, age=None, age_workdir=None, timeout=AGE_TIMEOUT,
+                      truncation_pad_read_age=AGE_TRUNCATION_PAD,
+                      max_interval_len_truncation_age=AGE_MAX_INTERVAL_TRUNCATION, dist_to_expected_bp=AGE_DIST_TO_BP,
+                      finish_region=None, logger=None):
+    # Files for a region are only written once the command pool asks for its first job
+    for region in region_list:
+        if region not in contig_dict:
+            continue
+        if not contig_dict[region]:
+            continue
+
+        region_state = prepare_age_region(region, matching_intervals, reference_fasta, pad=pad,
+                                          age_workdir=age_workdir, truncation_pad_read_age=truncation_pad_read_age,
+                                          dist_to_expected_bp=dist_to_expected_bp, logger=logger)
+        if region_state is None:
+            continue
+        region_states[region] = region_state
+        region_object = region_state["region_object"]
+
+        logger.info("Processing %d contigs for region %s" % (len(contig_dict[region]), str(region_object)))
+        for contig_index, contig in enumerate(contig_dict[region]):
+            logger.info(
+                "Writing the assembeled sequence %s of length %s" % (contig.raw_name, contig.sequence_len))
+
+            tr_region = []
+            if region_object.length() > max_interval_len_truncation_age and contig.sv_type in ["INV", "DEL", "DUP"]:
+                ref_f_name, ref_len = get_truncated_ref(region_state, logger=logger)
+                tr_region = [region_state["truncate_start"],
+                             region_state["truncate_end"] - region_state["truncate_start"] + 1]
+            else:
+                ref_len = region_object.length()
+                ref_f_name = region_state["ref_name"]
+
+            if contig.sequence_len * ref_len >= 100000000:
+                logger.info("Skipping contig because AGE problem is large (contig_len = %d , ref_len= %d)" % (
+                contig.sequence_len, ref_len))
+                continue
+
+            contig_sequence = assembly_fasta.fetch(contig.raw_name)
+
+            prefix = get_age_file_prefix(contig)
+            asm_name = os.path.join(age_workdir, "%s.as.fa" % prefix)
+            out = os.path.join(age_workdir, "%s.age.out" % prefix)
+            err = os.path.join(age_workdir, "%s.age.err" % prefix)
+
+            with open(asm_name, "w") as file_handle:
+                file_handle.write(">{}.as\n{}".format(region_state["region_name"], contig_sequence))
+
+            age_cmd = "%s %s -both -go=-6 %s %s" % (
+                age, "-inv" if contig.sv_type == "INV" else "-tdup" if contig.sv_type == "DUP" else "-indel",
+                ref_f_name, asm_name)
+            fd_out = open(out, "w")
+            fd_err = open(err, "w")
+            region_state["num_pending"] += 1
+            yield ((region, contig_index, contig, contig_sequence, tr_region, asm_name, out, err, fd_out, fd_err),
+                   TimedExternalCmd(age_cmd, logger),
+                   {"cmd_log_fd_out": fd_out, "cmd_log_fd_err": fd_err, "timeout": timeout})
+
+        region_state["submitted"] = True
+        if not region_state["num_pending"]:
+            finish_region(region)
+
+
+def finish_age_region(region_state, pad=AGE_PAD, dist_to_expected_bp=AGE_DIST_TO_BP,
+                      min_del_subalign_len=MIN_DEL_SUBALIGN_LENGTH, min_inv_subalign_len=MIN_INV_SUBALIGN_LENGTH,
+                      age_window=AGE_WINDOW_SIZE, keep_temp=False, logger=None):
+    region_object = region_state["region_object"]
+
+    # AGE runs finish in any order, the records are put back in contig order before deduplication
+    age_records = [age_record for contig_index, age_record in sorted(region_state["age_records"])]
+    unique_age_records = get_unique_age_records(age_records)
+
+    logger.info("Unique %d AGE records for region %s" % (len(unique_age_records), str(region_object)))
+    for age_record in unique_age_records:
+        logger.info(str(age_record))
+
+    bedtools_interval = None
+    sv_types = list(set([age_record.contig.sv_type for age_record in unique_age_records]))
+    if len(sv_types) != 1:
+        logger.error("Some problem. Mixed SV types for this interval %s" % (str(sv_types)))
+    else:
+        sv_type = sv_types[0]
+        logger.info("Processing region of type %s" % sv_type)
+        breakpoints, info_dict = process_age_records(unique_age_records, sv_type=sv_type,
+                                                     pad=pad, dist_to_expected_bp=dist_to_expected_bp,
+                                                     min_del_subalign_len=min_del_subalign_len,
+                                                     min_inv_subalign_len=min_inv_subalign_len,
+                                                     age_window=age_window, sc_locations=region_state["sc_locations"])
+        bedtools_fields = region_state["matching_interval"].fields
+        if len(breakpoints) == 1 and sv_type == "INS":
+            bedtools_fields += map(str, [breakpoints[0][0], breakpoints[0][0] + 1, breakpoints[0][1], breakpoints[0][2]])
+        elif len(breakpoints) == 2 and (sv_type in ["DEL","INV","DUP"]):
+            bedtools_fields += map(str, breakpoints + [breakpoints[1] - breakpoints[0]] + ["."])
+        else:
+            bedtools_fields += map(str, [bedtools_fields[1], bedtools_fields[2], -1, "."])
+        bedtools_fields[3] += ";AS"
+        bedtools_fields.append(encode_info(info_dict))
+        logger.info("Writing out fields %s" % (str(bedtools_fields)))
+        bedtools_interval = pybedtools.create_interval_from_list(bedtools_fields)
+
+    if not keep_temp:
+        os.remove(region_state["ref_name"])
+        if "ref_len_tr" in region_state:
+            os.remove(region_state["ref_name_tr"])
+
+    return bedtools_interval
+
+
 def run_age_single(intervals_bed=None, region_list=[], contig_dict={}, reference=None, assembly=None, pad=AGE_PAD,
                    age=None, truncation_pad_read_age = AGE_TRUNCATION_PAD,
                    max_interval_len_truncation_age = AGE_MAX_INTERVAL_TRUNCATION,
                    dist_to_expected_bp = AGE_DIST_TO_BP, min_del_subalign_len = MIN_DEL_SUBALIGN_LENGTH, 
                    min_inv_subalign_len = MIN_INV_SUBALIGN_LENGTH, age_window = AGE_WINDOW_SIZE,
-                   age_workdir=None, timeout=AGE_TIMEOUT, keep_temp=False, myid=0):
+                   age_workdir=None, timeout=AGE_TIMEOUT, keep_temp=False, myid=0, max_age_procs=AGE_PROCS_PER_THREAD,
+                   matching_intervals=None):
     thread_logger = logging.getLogger("%s-%s" % (run_age_single.__name__, multiprocessing.current_process()))
 
     bedtools_intervals = []
-    intervals_bedtool = pybedtools.BedTool(intervals_bed)
+    if matching_intervals is None:
+        matching_intervals = load_matching_intervals(intervals_bed, region_list)
 
-    assembly_fasta = pysam.Fastafile(assembly) if assembly else None
-    reference_fasta = pysam.Fastafile(reference)
+    if age_sequences is not None:
+        assembly_fasta = SharedFastafile(age_sequences, assembly, "assembly") if assembly else None
+        reference_fasta = SharedFastafile(age_sequences, reference, "reference")
+    else:
+        assembly_fasta = pysam.Fastafile(assembly) if assembly else None
+        reference_fasta = pysam.Fastafile(reference)
 
     breakpoints_bed = None
 
-    thread_logger.info("Will process %d intervals" % (len(region_list)))
+    thread_logger.info("Will process %d intervals with up to %d AGE processes" % (len(region_list), max_age_procs))
 
     try:
-        for region in region_list:
-            bedtools_interval = pybedtools.Interval(region[0], region[1], region[3])
-            matching_intervals = [interval for interval in intervals_bedtool if (
-                interval.start == bedtools_interval.start and interval.end == bedtools_interval.end and interval.chrom == bedtools_interval.chrom)]
-            if not matching_intervals:
-                thread_logger.info("Matching interval not found for %s" % (str(bedtools_interval)))
-                matching_interval = bedtools_interval
-            else:
-                matching_interval = matching_intervals[0]
-            thread_logger.info("Matching interval %s" % (str(matching_interval)))
-            sc_locations = []
-            try:
-                sc_locations = map(int, json.loads(base64.b64decode(matching_interval.name.split(",")[0]))["SC_LOCATIONS"].split(","))
-            except:
-                pass
-
-            if region not in contig_dict:
-                continue
-            if not contig_dict[region]:
-                continue
-
-            region_object = SVRegion(region[0], region[1], region[2], region[3])
-            if region_object.pos1 - pad < 0:
-                thread_logger.error("Region too close to start of chromosome. Skipping.")
-                continue
-
-            reference_sequence = reference_fasta.fetch(reference=region_object.chrom1, start=region_object.pos1 - pad,
-                                                       end=region_object.pos2 + pad)
-            region_name = "%s.%d.%d" % (region_object.chrom1, region_object.pos1, region_object.pos2)
-            ref_name = os.path.join(age_workdir, "%s.ref.fa" % region_name)
-
-            thread_logger.info("Writing the ref sequence for region %s" % region_name)
-            with open(ref_name, "w") as file_handle:
-                file_handle.write(">{}.ref\n{}".format(region_name, reference_sequence))
-
-
-            
-
-            age_records = []
-            thread_logger.info("Processing %d contigs for region %s" % (len(contig_dict[region]), str(region_object)))
-            for contig in contig_dict[region]:
-                thread_logger.info(
-                    "Writing the assembeled sequence %s of length %s" % (contig.raw_name, contig.sequence_len))
-                
-                tr_region=[]
-                if region_object.length()>max_interval_len_truncation_age and contig.sv_type in ["INV","DEL","DUP"]:
-                    # For large SVs, middle sequences has no effect on genotyping. So, we truncate middle region of reference to speed up
-                    thread_logger.info("Truncate the reference sequence.")
-                    
-
-                    truncate_start = pad + dist_to_expected_bp + truncation_pad_read_age +1
-                    truncate_end = len(reference_sequence) -  (pad + dist_to_expected_bp + truncation_pad_read_age)
-                    reference_sequence_tr=reference_sequence[0:truncate_start-1]+reference_sequence[truncate_end:]
-                    region_name_tr = "%s.%d.%d.tr_%d_%d" % (region_object.chrom1, region_object.pos1, region_object.pos2,truncate_start,truncate_end)
-                    ref_name_tr = os.path.join(age_workdir, "%s.ref.fa" % region_name_tr)
-
-                    thread_logger.info("Writing the truncated ref sequence for region %s, contig %s" % (region_name_tr, contig.raw_name))
-                    with open(ref_name_tr, "w") as file_handle:
-                        file_handle.write(">{}.ref\n{}".format(region_name_tr, reference_sequence_tr))
-                        
-                    ref_len = len(reference_sequence_tr)
-                    ref_f_name = ref_name_tr
-                    tr_region = [truncate_start,truncate_end-truncate_start+1]
-                    
-                else:
-                    ref_len = region_object.length()
-                    ref_f_name = ref_name
-                    
-                if contig.sequence_len * ref_len >= 100000000:
-                    thread_logger.info("Skipping contig because AGE problem is large (contig_len = %d , ref_len= %d)"%(contig.sequence_len, ref_len))
-                    continue
-
-                contig_sequence = assembly_fasta.fetch(contig.raw_name)
-
-                prefix = get_age_file_prefix(contig)
-                asm_name = os.path.join(age_workdir, "%s.as.fa" % prefix)
-                out = os.path.join(age_workdir, "%s.age.out" % prefix)
-                err = os.path.join(age_workdir, "%s.age.err" % prefix)
-                fd_out = open(out, "w")
-                fd_err = open(err, "w")
-
-                with open(asm_name, "w") as file_handle:
-                    file_handle.write(">{}.as\n{}".format(region_name, contig_sequence))
-
-                age_cmd = "%s %s -both -go=-6 %s %s" % (
-                    age, "-inv" if contig.sv_type == "INV" else "-tdup" if contig.sv_type == "DUP" else "-indel",
-                    ref_f_name, asm_name)
-                cmd_runner = TimedExternalCmd(age_cmd, thread_logger)
-                retcode = cmd_runner.run(timeout=timeout, cmd_log_fd_out=fd_out, cmd_log_fd_err=fd_err)
-                fd_out.close()
-                fd_err.close()
-
-                if retcode == 0:
-                    age_record = AgeRecord(out,tr_region_1=tr_region)
-                    if len(age_record.inputs) == 2:
-                        age_record.contig = contig
-                        age_record.set_assembly_contig(contig_sequence)
-                        age_records.append(age_record)
-                    else:
-                        thread_logger.error("Number of inputs != 2 in age output file %s. Skipping." % out)
-
-                if not keep_temp:
-                    os.remove(asm_name)
-                    os.remove(err)
-                    if tr_region:
-                        os.remove(ref_name_tr)
-
-            unique_age_records = get_unique_age_records(age_records)
-
-            thread_logger.info("Unique %d AGE records for region %s" % (len(unique_age_records), str(region_object)))
-            for age_record in unique_age_records:
-                thread_logger.info(str(age_record))
-
-            sv_types = list(set([age_record.contig.sv_type for age_record in unique_age_records]))
-            if len(sv_types) != 1:
-                thread_logger.error("Some problem. Mixed SV types for this interval %s" % (str(sv_types)))
-            else:
-                sv_type = sv_types[0]
-                thread_logger.info("Processing region of type %s" % sv_type)
-                breakpoints, info_dict = process_age_records(unique_age_records, sv_type=sv_type, 
-                                                             pad=pad, dist_to_expected_bp=dist_to_expected_bp,
-                                                             min_del_subalign_len=min_del_subalign_len,
-                                                             min_inv_subalign_len=min_inv_subalign_len,
-                                                             age_window=age_window, sc_locations=sc_locations)
-                bedtools_fields = matching_interval.fields
-                if len(breakpoints) == 1 and sv_type == "INS":
-                    bedtools_fields += map(str, [breakpoints[0][0], breakpoints[0][0] + 1, breakpoints[0][1], breakpoints[0][2]])
-                elif len(breakpoints) == 2 and (sv_type in ["DEL","INV","DUP"]):
-                    bedtools_fields += map(str, breakpoints + [breakpoints[1] - breakpoints[0]] + ["."])
+        region_states = {}
+
+        def finish_region(region):
+            bedtools_interval = finish_age_region(region_states.pop(region), pad=pad,
+                                                  dist_to_expected_bp=dist_to_expected_bp,
+                                                  min_del_subalign_len=min_del_subalign_len,
+                                                  min_inv_subalign_len=min_inv_subalign_len, age_window=age_window,
+                                                  keep_temp=keep_temp, logger=thread_logger)
+            if bedtools_interval is not None:
+                bedtools_intervals.append(bedtools_interval)
+
+        # AGE is single-threaded and short-lived, so several runs are kept in flight while the results of the
+        # finished ones are parsed
+        age_jobs = generate_age_jobs(region_list, region_states, contig_dict, matching_intervals, reference_fasta,
+                                     assembly_fasta, pad=pad, age=age, age_workdir=age_workdir, timeout=timeout,
+                                     truncation_pad_read_age=truncation_pad_read_age,
+                                     max_interval_len_truncation_age=max_interval_len_truncation_age,
+                                     dist_to_expected_bp=dist_to_expected_bp, finish_region=finish_region,
+                                     logger=thread_logger)
+        for job, cmd_runner, retcode in TimedExternalCmdPool(max_running=max_age_procs).run(age_jobs):
+            region, contig_index, contig, contig_sequence, tr_region, asm_name, out, err, fd_out, fd_err = job
+            fd_out.close()
+            fd_err.close()
+
+            region_state = region_states[region]
+            if retcode == 0:
+                age_record = AgeRecord(out,tr_region_1=tr_region)
+                if len(age_record.inputs) == 2:
+                    age_record.contig = contig
+                    age_record.set_assembly_contig(contig_sequence)
+                    region_state["age_records"].append((contig_index, age_record))
                 else:
-                    bedtools_fields += map(str, [bedtools_fields[1], bedtools_fields[2], -1, "."])
-                bedtools_fields[3] += ";AS"
-                bedtools_fields.append(base64.b64encode(json.dumps(info_dict)))
-                thread_logger.info("Writing out fields %s" % (str(bedtools_fields)))
-                bedtools_intervals.append(pybedtools.create_interval_from_list(bedtools_fields))
+                    thread_logger.error("Number of inputs != 2 in age output file %s. Skipping." % out)
 
             if not keep_temp:
-                os.remove(ref_name)
+                os.remove(asm_name)
+                os.remove(err)
+
+            region_state["num_pending"] -= 1
+            if region_state["submitted"] and not region_state["num_pending"]:
+                finish_region(region)
     except Exception as e:
         thread_logger.error('Caught exception in worker thread')
 
@@ -225,7 +380,7 @@ def run_age_parallel(intervals_bed=None, reference=None, assembly=None, pad=AGE_
                      min_contig_len=AGE_MIN_CONTIG_LENGTH,
                      max_region_len=AGE_MAX_REGION_LENGTH, sv_types=[], 
                      min_del_subalign_len=MIN_DEL_SUBALIGN_LENGTH, min_inv_subalign_len=MIN_INV_SUBALIGN_LENGTH,
-                     age_window = AGE_WINDOW_SIZE):
+                     age_window = AGE_WINDOW_SIZE, max_age_procs=AGE_PROCS_PER_THREAD):
     func_logger = logging.getLogger("%s-%s" % (run_age_parallel.__name__, multiprocessing.current_process()))
 
     if not os.path.isdir(age_workdir):
@@ -274,17 +429,29 @@ def run_age_parallel(intervals_bed=None, reference=None, assembly=None, pad=AGE_
     func_logger.info("Will process %d regions with %d contigs (%d small contigs ignored) using %d threads" % (
         len(region_list), sum([len(value) for value in contig_dict.values()]), small_contigs_count, nthreads))
 
+    # The padded reference windows and the contigs are read once here. The workers are forked after this and
+    # slice them out of shared memory instead of seeking in the FASTA files over and over.
+    sequences = load_age_sequences(region_list, contig_dict, reference, assembly, pad=pad)
+    func_logger.info("Loaded %d sequences with %d bases for AGE" % (len(sequences), sequences.size()))
+
     pybedtools.set_tempdir(age_workdir)
-    pool = multiprocessing.Pool(nthreads)
+    pool = multiprocessing.Pool(nthreads, initializer=init_age_worker, initargs=[sequences])
+
+    matching_intervals = load_matching_intervals(intervals_bed, region_list)
 
     breakpoints_beds = []
     for i in xrange(nthreads):
         region_sublist = [region for (j, region) in enumerate(region_list) if (j % nthreads) == i]
-        kwargs_dict = {"intervals_bed": intervals_bed, "region_list": region_sublist, "contig_dict": contig_dict,
+        matching_intervals_sublist = dict([(key, matching_intervals[key]) for key in
+                                           [(region[0], region[1], region[3]) for region in region_sublist] if
+                                           key in matching_intervals])
+        kwargs_dict = {"intervals_bed": intervals_bed, "region_list": region_sublist,
+                       "contig_dict": dict([(region, contig_dict[region]) for region in region_sublist]),
+                       "matching_intervals": matching_intervals_sublist,
                        "reference": reference, "assembly": assembly, "pad": pad, "age": age, "age_workdir": age_workdir,
                        "timeout": timeout, "keep_temp": keep_temp, "myid": i, 
                        "min_del_subalign_len": min_del_subalign_len, "min_inv_subalign_len": min_inv_subalign_len,
-                       "age_window" : age_window}
+                       "age_window" : age_window, "max_age_procs": max_age_procs}
         pool.apply_async(run_age_single, args=[], kwds=kwargs_dict,
                          callback=partial(run_age_single_callback, result_list=breakpoints_beds))
 
@@ -335,6 +502,8 @@ if __name__ == "__main__":
                         default=MIN_INV_SUBALIGN_LENGTH)
     parser.add_argument("--age_window", help="Window size for AGE to merge nearby breakpoints", type=int,
                         default=AGE_WINDOW_SIZE)
+    parser.add_argument("--max_age_procs", help="Maximum number of AGE processes to run at once in each thread",
+                        type=int, default=AGE_PROCS_PER_THREAD)
     parser.add_argument("--intervals_bed", help="BED file for assembly", type=file, required=True)
 
     args = parser.parse_args()
@@ -344,4 +513,4 @@ if __name__ == "__main__":
                      keep_temp=args.keep_temp, assembly_tool=args.assembly_tool, chrs=args.chrs, nthreads=args.nthreads,
                      min_contig_len=args.min_contig_len, max_region_len=args.max_region_len, sv_types=args.sv_types, 
                      min_del_subalign_len=args.min_del_subalign_len, min_inv_subalign_len=args.min_inv_subalign_len,
-                     age_window = args.age_window)
+                     age_window = args.age_window, max_age_procs=args.max_age_procs)
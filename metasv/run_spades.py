@@ -2,18 +2,18 @@ import os
 import argparse
 import logging
 import multiprocessing
-import fileinput
 import traceback
+from cStringIO import StringIO
 from functools import partial, update_wrapper
-import json
-import base64
 from external_cmd import TimedExternalCmd
 
 import pysam
 import pybedtools
 
 import extract_pairs
+from bam_utils import get_bam_handles
 from defaults import *
+from info_utils import encode_info, decode_info
 
 FORMAT = '%(levelname)s %(asctime)-15s %(name)-20s %(message)s'
 logging.basicConfig(level=logging.INFO, format=FORMAT)
@@ -21,6 +21,9 @@ logger = logging.getLogger(__name__)
 
 precise_methods = set(["AS", "SR", "JM"])
 
+# Scratch directories whose spades.log this process has already started, the first interval of a run truncates it
+started_spades_logs = set()
+
 
 def append_contigs(src, interval, dst_fd, fn_id=0, sv_type="INS"):
     with open(src, "r") as fd:
@@ -32,61 +35,70 @@ def append_contigs(src, interval, dst_fd, fn_id=0, sv_type="INS"):
                 dst_fd.write(line)
 
 
-def run_spades_single(intervals=[], bams=[], spades=None, spades_options="", work=None, pad=SPADES_PAD, timeout=SPADES_TIMEOUT,
-                      isize_min=ISIZE_MIN,
-                      isize_max=ISIZE_MAX, stop_on_fail=False, max_read_pairs=EXTRACTION_MAX_READ_PAIRS):
+def get_extraction_span(interval, pad=SPADES_PAD, truncation_pad=EXTRACTION_TRUNCATION_PAD,
+                        max_interval_len_truncation=EXTRACTION_MAX_INTERVAL_TRUNCATION):
+    # Number of bases extract_read_pairs will fetch reads from, large 2-breakpoint SVs are truncated to their ends
+    sv_type = interval.name.split(",")[1]
+    span = interval.end - interval.start + 2 * pad
+    if span > max_interval_len_truncation and sv_type in ["INV", "DEL", "DUP"]:
+        span = 2 * (pad + truncation_pad)
+    return span
+
+
+def run_spades_single(index=0, interval=None, bams=[], spades=None, spades_options="", work=None, pad=SPADES_PAD,
+                      timeout=SPADES_TIMEOUT, isize_min=ISIZE_MIN, isize_max=ISIZE_MAX, stop_on_fail=False,
+                      max_read_pairs=EXTRACTION_MAX_READ_PAIRS):
     thread_logger = logging.getLogger("%s-%s" % (run_spades_single.__name__, multiprocessing.current_process()))
 
+    # Every worker process reuses its own scratch directory for the intervals it picks up
+    work = os.path.join(work, multiprocessing.current_process().name)
     if not os.path.isdir(work):
         thread_logger.info("Creating %s" % work)
         os.makedirs(work)
 
-    merged_contigs = open(os.path.join(work, "merged.fa"), "w")
-    spades_log_fd = open(os.path.join(work, "spades.log"), "w")
+    merged_contigs = StringIO()
+    spades_log_fd = open(os.path.join(work, "spades.log"), "a" if work in started_spades_logs else "w")
+    started_spades_logs.add(work)
 
     extract_fns = [extract_pairs.all_pair_hq, extract_pairs.non_perfect_hq]
 
     try:
-        bam_handles = [pysam.Samfile(bam, "rb") for bam in bams]
-
-        for interval in intervals:
-            region = "%s:%d-%d" % (str(interval.chrom), interval.start, interval.end)
-            thread_logger.info("Processing interval %s" % (str(interval).strip()))
-
-            sv_type = interval.name.split(",")[1]
-
-            extraction_counts = extract_pairs.extract_read_pairs(bam_handles, region, "%s/" % work, extract_fns, pad=pad,
-                                                                 max_read_pairs=max_read_pairs, sv_type=sv_type)
-            all_pair_count = extraction_counts[0][1]
-
-            for fn_id, ((end1, end2), extracted_count) in enumerate(extraction_counts):
-                extract_fn_name = extract_fns[fn_id].__name__
-
-                if fn_id > 0 and extracted_count == all_pair_count:
-                    thread_logger.info("Skipping assembly from %s since read count same as all_pairs" % extract_fn_name)
-                    continue
-
-                if extracted_count >= 5:
-                    extra_opt = "--sc" if not fn_id == 0 else ""
-                    spades_log_fd.write("Running spades for interval %s with extraction function %s\n" % (
+        bam_handles = get_bam_handles(bams)
+
+        region = "%s:%d-%d" % (str(interval.chrom), interval.start, interval.end)
+        thread_logger.info("Processing interval %s" % (str(interval).strip()))
+
+        sv_type = interval.name.split(",")[1]
+
+        extraction_counts = extract_pairs.extract_read_pairs(bam_handles, region, "%s/" % work, extract_fns, pad=pad,
+                                                             max_read_pairs=max_read_pairs, sv_type=sv_type)
+        all_pair_count = extraction_counts[0][1]
+
+        for fn_id, ((end1, end2), extracted_count) in enumerate(extraction_counts):
+            extract_fn_name = extract_fns[fn_id].__name__
+
+            if fn_id > 0 and extracted_count == all_pair_count:
+                thread_logger.info("Skipping assembly from %s since read count same as all_pairs" % extract_fn_name)
+                continue
+
+            if extracted_count >= 5:
+                extra_opt = "--sc" if not fn_id == 0 else ""
+                spades_log_fd.write("Running spades for interval %s with extraction function %s\n" % (
+                    str(interval).strip(), extract_fn_name))
+                cmd = TimedExternalCmd("%s -1 %s -2 %s -o %s/spades_%s/ -m 4 -t 1 --phred-offset 33 %s %s" % (
+                    spades, end1, end2, work, extract_fn_name, extra_opt, spades_options), thread_logger)
+                retcode = cmd.run(cmd_log_fd_out=spades_log_fd, timeout=timeout)
+                if retcode == 0:
+                    append_contigs(os.path.join(work, "spades_%s/contigs.fasta") % extract_fn_name, interval,
+                                   merged_contigs, fn_id, sv_type)
+                elif not cmd.did_timeout:
+                    thread_logger.error("Spades failed")
+                    if stop_on_fail:
+                        thread_logger.error("Aborting!")
+                        raise Exception("Spades failure on interval %s for extraction function %s\n" % (
                         str(interval).strip(), extract_fn_name))
-                    cmd = TimedExternalCmd("%s -1 %s -2 %s -o %s/spades_%s/ -m 4 -t 1 --phred-offset 33 %s %s" % (
-                        spades, end1, end2, work, extract_fn_name, extra_opt, spades_options), thread_logger)
-                    retcode = cmd.run(cmd_log_fd_out=spades_log_fd, timeout=timeout)
-                    if retcode == 0:
-                        append_contigs(os.path.join(work, "spades_%s/contigs.fasta") % extract_fn_name, interval,
-                                       merged_contigs, fn_id, sv_type)
-                    elif not cmd.did_timeout:
-                        thread_logger.error("Spades failed")
-                        if stop_on_fail:
-                            thread_logger.error("Aborting!")
-                            raise Exception("Spades failure on interval %s for extraction function %s\n" % (
-                            str(interval).strip(), extract_fn_name))
-                else:
-                    thread_logger.info("Too few read pairs (%d) extracted. Skipping assembly." % extracted_count)
-
-        for bam_handle in bam_handles:
-            bam_handle.close()
+            else:
+                thread_logger.info("Too few read pairs (%d) extracted. Skipping assembly." % extracted_count)
 
     except Exception as e:
         thread_logger.error('Caught exception in worker thread')
@@ -98,14 +110,38 @@ def run_spades_single(intervals=[], bams=[], spades=None, spades_options="", wor
         print()
         raise e
 
-    merged_contigs.close()
+    spades_log_fd.close()
+
+    return index, merged_contigs.getvalue()
+
 
-    return os.path.abspath(merged_contigs.name)
+class OrderedContigWriter:
+    # Writes the contigs of the assembled intervals in the order of the intervals as the assemblies finish.
+    # Assemblies which finish before the ones ahead of them are held back until those are written.
+    def __init__(self, fd):
+        self.fd = fd
+        self.next_index = 0
+        self.pending = {}
 
+    def write_contigs(self, contigs):
+        for line in contigs.splitlines():
+            self.fd.write("%s\n" % (line.strip()))
 
-def run_spades_single_callback(result, result_list):
+    def add(self, index, contigs):
+        self.pending[index] = contigs
+        while self.next_index in self.pending:
+            self.write_contigs(self.pending.pop(self.next_index))
+            self.next_index += 1
+
+    def flush(self):
+        # Intervals whose assembly failed leave a gap, the ones held back behind it are written in order
+        for index in sorted(self.pending.keys()):
+            self.write_contigs(self.pending.pop(index))
+
+
+def run_spades_single_callback(result, contig_writer):
     if result is not None:
-        result_list.append(result)
+        contig_writer.add(*result)
 
 
 def should_be_assembled(interval, max_interval_size=SPADES_MAX_INTERVAL_SIZE,
@@ -126,7 +162,7 @@ def should_be_assembled(interval, max_interval_size=SPADES_MAX_INTERVAL_SIZE,
     if not should_assemble: return False
 
     try:
-        info = json.loads(base64.b64decode(name_fields[0]))
+        info = decode_info(name_fields[0])
     except TypeError:
         info = dict()
     methods = set(name_fields[3].split(";"))
@@ -158,7 +194,7 @@ def add_breakpoints(interval):
         breakpoints = [interval.start, interval.end]
     fields += map(str, breakpoints)
     fields += name_fields[2:3]
-    fields.append(base64.b64encode(json.dumps(dict())))  # Does nothing, make sure the fields line up
+    fields.append(encode_info(dict()))  # Does nothing, make sure the fields line up
     return pybedtools.create_interval_from_list(fields)
 
 
@@ -191,24 +227,28 @@ def run_spades_parallel(bams=[], spades=None, spades_options="", bed=None, work=
     logger.info("%d intervals selected" % len(selected_intervals))
     logger.info("%d intervals ignored" % len(ignored_intervals))
 
-    pool = multiprocessing.Pool(nthreads)
-    assembly_fastas = []
-    for i in xrange(nthreads):
-        intervals = [interval for (j, interval) in enumerate(selected_intervals) if (j % nthreads) == i]
-        kwargs_dict = {"intervals": intervals, "bams": bams, "spades": spades, "spades_options": spades_options, "work": "%s/%d" % (work, i), "pad": pad,
-                       "timeout": timeout, "isize_min": isize_min, "isize_max": isize_max, "stop_on_fail": stop_on_fail,
-                       "max_read_pairs": max_read_pairs}
-        pool.apply_async(run_spades_single, kwds=kwargs_dict,
-                         callback=partial(run_spades_single_callback, result_list=assembly_fastas))
-
-    pool.close()
-    pool.join()
+    # One task per interval on the pool's shared queue, longest first, so that idle workers pick up the
+    # remaining short intervals instead of waiting behind a statically assigned batch
+    spans = [get_extraction_span(interval, pad=pad) for interval in selected_intervals]
+    assembly_order = sorted(xrange(len(selected_intervals)), key=lambda index: spans[index], reverse=True)
 
-    logger.info("Merging the contigs from %s" % (str(assembly_fastas)))
+    # Contigs are written in the order of the intervals in the BED, not in the order the assemblies finish
     assembled_fasta = os.path.join(work, "spades_assembled.fa")
     with open(assembled_fasta, "w") as assembled_fd:
-        for line in fileinput.input(assembly_fastas):
-            assembled_fd.write("%s\n" % (line.strip()))
+        contig_writer = OrderedContigWriter(assembled_fd)
+
+        pool = multiprocessing.Pool(nthreads)
+        for index in assembly_order:
+            kwargs_dict = {"index": index, "interval": selected_intervals[index], "bams": bams, "spades": spades,
+                           "spades_options": spades_options, "work": work, "pad": pad, "timeout": timeout,
+                           "isize_min": isize_min, "isize_max": isize_max, "stop_on_fail": stop_on_fail,
+                           "max_read_pairs": max_read_pairs}
+            pool.apply_async(run_spades_single, kwds=kwargs_dict,
+                             callback=partial(run_spades_single_callback, contig_writer=contig_writer))
+
+        pool.close()
+        pool.join()
+        contig_writer.flush()
 
     if os.path.getsize(assembled_fasta) > 0:
         logger.info("Indexing the assemblies")
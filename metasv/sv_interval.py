@@ -4,12 +4,11 @@ logger = logging.getLogger(__name__)
 
 import operator
 import os
-import copy
-import bisect
+from collections import defaultdict
 import pybedtools
 import vcf
-import json
-import base64
+
+from info_utils import encode_info
 
 svs_of_interest = ["DEL", "INS", "DUP", "DUP:TANDEM", "INV" ,"ITX", "CTX"]
 sv_sources = ["Pindel", "BreakSeq", "HaplotypeCaller", "BreakDancer", "CNVnator",
@@ -35,7 +34,20 @@ def get_gaps_file(contig_names):
     return None
 
 
-class SVInterval:
+interned_sources = {}
+
+
+def intern_sources(sources):
+    """Return a shared frozenset equal to sources, so calls from the same tools don't each carry their own set."""
+    sources = frozenset(sources)
+    return interned_sources.setdefault(sources, sources)
+
+
+class SVInterval(object):
+    # Millions of these get loaded for whole-genome inputs, so avoid a per-instance __dict__
+    __slots__ = ["chrom", "chrom2", "start", "end", "name", "sv_type", "length", "info", "sources", "gt", "wiggle",
+                 "sub_intervals", "is_precise", "is_validated", "validating_interval", "cipos", "ciend", "native_sv"]
+
     def __init__(self, chrom=None,  start=0, end=0, name=None, sv_type=None, length=0, sources=set(), gt="./1", wiggle=0,
                  info=None, cipos=[], ciend=[], native_sv=None, chrom2=None):
         self.chrom = chrom
@@ -46,10 +58,11 @@ class SVInterval:
         self.sv_type = sv_type
         self.length = length
         self.info = info
-        self.sources = sources
+        self.sources = intern_sources(sources)
         self.gt = gt
         self.wiggle = wiggle
-        self.sub_intervals = []
+        # Replaced by a list once something gets merged into this interval
+        self.sub_intervals = ()
         self.is_precise = False
         self.is_validated = False
         self.validating_interval = None
@@ -63,7 +76,7 @@ class SVInterval:
         self.length = max(self.length, interval.length)
         self.name = self.name + "," + interval.name
         self.sub_intervals.append(interval)
-        self.sources |= interval.sources
+        self.sources = intern_sources(self.sources | interval.sources)
 
     def set_merged(self, interval1, interval2):
         self.chrom = interval1.chrom
@@ -74,9 +87,28 @@ class SVInterval:
         self.sv_type = interval1.sv_type
         self.info = None
         self.sub_intervals = [interval1, interval2]
-        self.sources = interval1.sources | interval2.sources
+        self.sources = intern_sources(interval1.sources | interval2.sources)
         self.gt = interval1.gt
 
+    def __getstate__(self):
+        return [getattr(self, slot) for slot in SVInterval.__slots__]
+
+    def __setstate__(self, state):
+        for slot, value in zip(SVInterval.__slots__, state):
+            setattr(self, slot, value)
+        self.sources = intern_sources(self.sources)
+
+    def shallow_copy(self):
+        """Copy sharing sources, INFO and sub-intervals with this interval, which are never modified in place.
+
+        Only the list of sub-intervals is duplicated since merge() appends to it.
+        """
+        interval = SVInterval.__new__(SVInterval)
+        interval.__setstate__(self.__getstate__())
+        if self.sub_intervals:
+            interval.sub_intervals = list(self.sub_intervals)
+        return interval
+
     def __lt__(self, other):
         if self.chrom != other.chrom: return self.chrom < other.chrom
         if self.start != other.start: return self.start < other.start
@@ -88,7 +120,8 @@ class SVInterval:
         return "%s-%d-%s-%d-%d-%s" % (self.chrom, self.start, self.chrom2, self.end, self.length, ",".join(list(self.sources)))
 
     def __repr__(self):
-        return "<" + self.__class__.__name__ + " " + str(self.__dict__) + ">"
+        return "<" + self.__class__.__name__ + " " + str(
+            {slot: getattr(self, slot) for slot in SVInterval.__slots__}) + ">"
 
     def overlaps(self, other, min_fraction_self=1e-9, min_fraction_other=1e-9, min_overlap_length_self=1,
                  min_overlap_length_other=1):
@@ -292,7 +325,7 @@ class SVInterval:
                 info.update({"IMPRECISE": True})
 
         return pybedtools.Interval(self.chrom, self.start, end, name="%s,%s,%d,%s" % (
-            base64.b64encode(json.dumps(info)), self.sv_type, self.length,
+            encode_info(info), self.sv_type, self.length,
             ";".join(self._get_svmethods())),
             score=str(len(self.sources)))
 
@@ -314,62 +347,204 @@ class SVInterval:
             sample_name, type_of_computational_approach, id_num)
 
 
-def interval_overlaps_interval_list(interval, interval_list, min_fraction_self=1e-9, min_fraction_other=1e-9):
-    index = bisect.bisect_left(interval_list, interval)
-    if index > 0 and interval.overlaps(interval_list[index - 1], min_fraction_self, min_fraction_other,
-                                       min_overlap_length_self=1, min_overlap_length_other=1):
-        return True
-    if index < len(interval_list) and interval.overlaps(interval_list[index], min_fraction_self, min_fraction_other,
-                                                        min_overlap_length_self=1, min_overlap_length_other=1):
-        return True
-    return False
+def get_extent(interval):
+    return min(interval.start, interval.end) - interval.wiggle, max(interval.start, interval.end) + interval.wiggle
 
 
-def merge_intervals(interval_list):
-    interval_list.sort()
-    merged_intervals = []
-    if not interval_list:
-        return []
+class IntervalIndex:
+    """Per-chromosome augmented interval tree over a list of SVIntervals.
+
+    Intervals of a chromosome are kept in an array sorted by their wiggled start. The array is
+    viewed as an implicit balanced binary tree (the node of a slice is its middle element) and every
+    node stores the maximum wiggled end of its subtree, so a query visits O(log n + k) nodes even
+    for nested or very long intervals.
+    """
+
+    def __init__(self, intervals=[]):
+        entries_by_chrom = defaultdict(list)
+        for interval in intervals:
+            entries_by_chrom[interval.chrom].append(get_extent(interval) + (interval,))
 
-    current_merged_interval = copy.deepcopy(interval_list[0])
-    for i in xrange(len(interval_list) - 1):
-        next_interval = interval_list[i + 1]
+        self.num_intervals = 0
+        self.chroms = {}
+        for chrom, entries in entries_by_chrom.iteritems():
+            entries.sort(key=operator.itemgetter(0))
+            los = [entry[0] for entry in entries]
+            his = [entry[1] for entry in entries]
+            members = [entry[2] for entry in entries]
+            max_his = list(his)
+            self._fill_max_his(his, max_his, 0, len(his))
+            self.chroms[chrom] = (los, his, max_his, members)
+            self.num_intervals += len(members)
 
-        if current_merged_interval.overlaps(next_interval) or current_merged_interval.is_adjacent(next_interval):
+    @staticmethod
+    def _fill_max_his(his, max_his, lo, hi):
+        if lo >= hi:
+            return None
+        mid = (lo + hi) / 2
+        for sub_max in [IntervalIndex._fill_max_his(his, max_his, lo, mid),
+                        IntervalIndex._fill_max_his(his, max_his, mid + 1, hi)]:
+            if sub_max is not None and sub_max > max_his[mid]:
+                max_his[mid] = sub_max
+        return max_his[mid]
+
+    def __len__(self):
+        return self.num_intervals
+
+    def find_overlapping(self, interval):
+        """Yield the indexed intervals whose wiggled extent intersects the wiggled extent of interval."""
+        if interval.chrom not in self.chroms:
+            return
+        los, his, max_his, members = self.chroms[interval.chrom]
+        query_lo, query_hi = get_extent(interval)
+
+        stack = [(0, len(los))]
+        while stack:
+            lo, hi = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) / 2
+            # Nothing in this subtree ends after the query starts
+            if max_his[mid] <= query_lo:
+                continue
+            stack.append((lo, mid))
+            # The middle and everything to its right start after the query ends
+            if los[mid] >= query_hi:
+                continue
+            if his[mid] > query_lo:
+                yield members[mid]
+            stack.append((mid + 1, hi))
+
+    def overlaps(self, interval, min_fraction_self=1e-9, min_fraction_other=1e-9):
+        for other in self.find_overlapping(interval):
+            if interval.overlaps(other, min_fraction_self, min_fraction_other, min_overlap_length_self=1,
+                                 min_overlap_length_other=1):
+                return True
+        return False
+
+
+def interval_overlaps_interval_list(interval, interval_list, min_fraction_self=1e-9, min_fraction_other=1e-9):
+    if not interval_list:
+        return False
+    # Callers querying the same list many times should pass a prebuilt IntervalIndex
+    interval_index = interval_list if isinstance(interval_list, IntervalIndex) else IntervalIndex(interval_list)
+    return interval_index.overlaps(interval, min_fraction_self, min_fraction_other)
+
+
+def iter_merged_intervals(interval_list):
+    """Sweep intervals sorted by (chrom, start, end) and yield each merged interval as soon as it is closed.
+
+    The sweep keeps a single open merged interval whose end is the right frontier of the active set: an
+    interval starting beyond that frontier (and not adjacent to it) can never join it, so it is emitted.
+    Input intervals are never modified. A merged interval references its inputs as sub-intervals, and an
+    interval which merged with nothing is yielded as a shallow copy.
+    """
+    current_merged_interval = None
+    # Whether current_merged_interval was created here, as opposed to still being an input interval
+    owns_current = False
+    for interval in interval_list:
+        if current_merged_interval is None:
+            current_merged_interval, owns_current = interval, False
+        elif current_merged_interval.overlaps(interval) or current_merged_interval.is_adjacent(interval):
             if current_merged_interval.sub_intervals:
-                current_merged_interval.merge(next_interval)
+                if not owns_current:
+                    current_merged_interval, owns_current = current_merged_interval.shallow_copy(), True
+                current_merged_interval.merge(interval)
             else:
                 new_merged_interval = SVInterval()
-                # logger.debug("Merging %s with %s" % (repr(current_merged_interval), repr(next_interval)))
-                new_merged_interval.set_merged(current_merged_interval, next_interval)
-                current_merged_interval = new_merged_interval
+                new_merged_interval.set_merged(current_merged_interval, interval)
+                current_merged_interval, owns_current = new_merged_interval, True
         else:
-            merged_intervals.append(current_merged_interval)
-            current_merged_interval = copy.deepcopy(next_interval)
+            yield current_merged_interval if owns_current else current_merged_interval.shallow_copy()
+            current_merged_interval, owns_current = interval, False
 
-    merged_intervals.append(current_merged_interval)
+    if current_merged_interval is not None:
+        yield current_merged_interval if owns_current else current_merged_interval.shallow_copy()
+
+
+def merge_intervals(interval_list):
+    interval_list.sort()
+    merged_intervals = list(iter_merged_intervals(interval_list))
     merged_intervals.sort()
     return merged_intervals
 
 
-def merge_intervals_recursively(interval_list,overlap_ratio):
+def resolve_merged_interval(merged_interval, overlap_ratio):
+    """Split a merged interval until every member overlaps its merged interval reciprocally by overlap_ratio.
+
+    Members which overlap the merged interval poorly (typically small calls swallowed by a large one) and
+    members which overlap it well are re-merged separately. If no member overlaps well, the members are
+    reported unmerged.
+    """
+    if not merged_interval.sub_intervals:
+        yield merged_interval
+        return
+
+    # Intervals which overlap well with the merged interval
+    well_overlapping = []
+    # Intervals which do not overlap well with the merged interval
+    poorly_overlapping = []
+    for interval in merged_interval.sub_intervals:
+        if interval.overlaps(merged_interval, overlap_ratio, overlap_ratio):
+            well_overlapping.append(interval)
+        else:
+            poorly_overlapping.append(interval)
+
+    if not poorly_overlapping:
+        yield merged_interval
+    elif not well_overlapping:
+        for interval in sorted(poorly_overlapping):
+            yield interval
+    else:
+        for interval_subset in [poorly_overlapping, well_overlapping]:
+            interval_subset.sort()
+            for sub_merged_interval in iter_merged_intervals(interval_subset):
+                for resolved_interval in resolve_merged_interval(sub_merged_interval, overlap_ratio):
+                    yield resolved_interval
+
+
+def iter_merged_intervals_recursively(interval_list, overlap_ratio):
+    """Stream the reciprocal-overlap merge of interval_list, which must be sorted, one merged cluster at a time.
+
+    The sweep's clusters are disjoint once the wiggle is applied: no member of one cluster overlaps or is adjacent
+    to a member of another within its wiggle, so every cluster is resolved on its own members without rescanning
+    the rest of the list. The intervals resolved from one cluster can still overlap each other.
+    """
+    for merged_interval in iter_merged_intervals(interval_list):
+        for resolved_interval in resolve_merged_interval(merged_interval, overlap_ratio):
+            yield resolved_interval
+
+
+def split_intervals_recursively(interval_list, overlap_ratio):
     merged_intervals = merge_intervals(interval_list)
 
     # Intervals which overlap well with merged_intervals
     intervals1 = []
     # Intervals which do not overlap well with merged_intervals.
-    # Used to filter out small intervals which got merged with large intervals
     intervals2 = []
+    merged_index = IntervalIndex(merged_intervals)
     for interval in interval_list:
-        if interval_overlaps_interval_list(interval, merged_intervals, overlap_ratio,overlap_ratio ):
-            intervals2.append(interval)
-        else:
+        if merged_index.overlaps(interval, overlap_ratio, overlap_ratio):
             intervals1.append(interval)
-    if len(intervals1)==0:
+        else:
+            intervals2.append(interval)
+    if not intervals2:
         return merged_intervals
-    if len(intervals2)==0:
-        intervals1.sort()
-        return intervals1
-    final_merged = merge_intervals_recursively(intervals1,overlap_ratio) + merge_intervals_recursively(intervals2,overlap_ratio)
+    if not intervals1:
+        intervals2.sort()
+        return intervals2
+    final_merged = split_intervals_recursively(intervals2, overlap_ratio) + split_intervals_recursively(
+        intervals1, overlap_ratio)
+    final_merged.sort()
+    return final_merged
+
+
+def merge_intervals_recursively(interval_list, overlap_ratio):
+    interval_list.sort()
+    if any(interval.sv_type in ["ITX", "CTX"] for interval in interval_list):
+        # Translocation overlaps compare breakpoint positions instead of extents, so a call can match a merged
+        # interval other than its own and the list has to be split as a whole
+        return split_intervals_recursively(interval_list, overlap_ratio)
+    final_merged = list(iter_merged_intervals_recursively(interval_list, overlap_ratio))
     final_merged.sort()
     return final_merged
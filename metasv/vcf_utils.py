@@ -5,6 +5,7 @@ logger = logging.getLogger(__name__)
 from sv_interval import *
 from defaults import SVS_SUPPORTED, MAX_SV_LENGTH
 import pysam
+import itertools
 
 # Callers to remove filtered values when reading
 REMOVE_FILTERED = set(["BreakSeq", "Lumpy", "Manta", "CNVkit", "WHAM"])
@@ -62,13 +63,90 @@ def get_gt(gt, fmt):
     return gt.split(":")[fmt_index]
 
 
+def get_info_fields(info, keys):
+    """Look up the raw string values of a few INFO keys without parsing the whole INFO column."""
+    values = {}
+    for field in info.split(";"):
+        key, _, value = field.partition("=")
+        if key in keys:
+            values[key] = value
+    return values
+
+
+def iter_prefiltered_lines(tabix_file, contigs, source=None, minsvlen=50, maxsvlen=MAX_SV_LENGTH,
+                           svs_to_report=SVS_SUPPORTED):
+    """Yield raw VCF lines of the given contigs which can pass the record filters in load_intervals.
+
+    Only CHROM, REF, ALT, FILTER and the SVTYPE, END and SVLEN INFO keys are looked at, so PyVCF never
+    parses the records dropped here.
+    """
+    # The file is only read through this generator, so it is closed once the lines run out
+    try:
+        for contig in contigs:
+            for line in tabix_file.fetch(contig):
+                fields = line.split("\t", 8)
+                if len(fields) < 8:
+                    continue
+                chrom, pos, _, ref, alt, _, sv_filter, info = fields[:8]
+
+                if (source in ["HaplotypeCaller"] or source in REMOVE_FILTERED) and sv_filter not in [".", "PASS"] \
+                        and "PASS" not in sv_filter.split(";"):
+                    continue
+                if "," in alt:
+                    continue
+
+                if source in ["HaplotypeCaller"]:
+                    if max(len(ref), len(alt)) < minsvlen:
+                        continue
+                    yield line
+                    continue
+
+                info_fields = get_info_fields(info, ["SVTYPE", "END", "SVLEN"])
+                if "SVTYPE" not in info_fields or "END" not in info_fields:
+                    logger.error("Ignoring record due to missing SVTYPE or INFO field in %s:%s" % (chrom, pos))
+                    continue
+                sv_type = info_fields["SVTYPE"]
+                if sv_type == "DUP:TANDEM": sv_type = "DUP"
+                if sv_type not in svs_to_report:
+                    continue
+                if "SVLEN" in info_fields:
+                    svlen = abs(int(info_fields["SVLEN"].split(",")[0]))
+                elif source == "BreakSeq" and sv_type == "INS":
+                    svlen = 0
+                else:
+                    continue
+                if svlen < minsvlen:
+                    logger.warn("Skipping %s:%s due to small size" % (chrom, pos))
+                    continue
+                if svlen > maxsvlen:
+                    logger.warn("Skipping %s:%s due to large size" % (chrom, pos))
+                    continue
+                yield line
+    finally:
+        tabix_file.close()
+
+
 def load_intervals(in_vcf, intervals={}, gap_intervals=[], include_intervals=[], source=None, contig_whitelist=[],
                    minsvlen=50, wiggle=100, inswiggle=100, svs_to_report=SVS_SUPPORTED,
                    maxsvlen=MAX_SV_LENGTH):
     if not os.path.isfile(in_vcf): return intervals
     logger.info("Loading SV intervals from %s" % in_vcf)
 
-    vcf_reader = vcf.Reader(open(in_vcf))
+    # Every record is checked against these, so index them once per file unless the caller already did
+    if not isinstance(gap_intervals, IntervalIndex):
+        gap_intervals = IntervalIndex(gap_intervals)
+    if not isinstance(include_intervals, IntervalIndex):
+        include_intervals = IntervalIndex(include_intervals)
+
+    if in_vcf.endswith(".gz") and os.path.isfile(in_vcf + ".tbi"):
+        # Fetch only the whitelisted contigs and let PyVCF parse just the records surviving the cheap filters
+        tabix_file = pysam.Tabixfile(in_vcf)
+        contigs = sorted(set(contig_whitelist) & set(tabix_file.contigs))
+        vcf_reader = vcf.Reader(fsock=itertools.chain(
+            tabix_file.header, iter_prefiltered_lines(tabix_file, contigs, source=source, minsvlen=minsvlen,
+                                                      maxsvlen=maxsvlen, svs_to_report=svs_to_report)))
+    else:
+        vcf_reader = vcf.Reader(open(in_vcf))
     # Assume single sample for now
     sample = vcf_reader.samples[0] if vcf_reader.samples else None
     for vcf_record in vcf_reader:
@@ -144,13 +222,14 @@ def load_intervals(in_vcf, intervals={}, gap_intervals=[], include_intervals=[],
                                   sources=set([source]), wiggle=wiggle, gt=gt)
         if interval.sv_type not in svs_to_report:
             continue
-        if interval_overlaps_interval_list(interval, gap_intervals):
+        if gap_intervals.overlaps(interval):
             logger.warn("Skipping " + str(interval) + " due to overlap with gaps")
             continue
-        if not interval_overlaps_interval_list(interval, include_intervals, min_fraction_self=1.0):
+        if not include_intervals.overlaps(interval, min_fraction_self=1.0):
             logger.warn("Skipping " + str(interval) + " due to being outside the include regions")
             continue
-        interval.info = copy.deepcopy(vcf_record.INFO)
+        # The record is not used after this, so its INFO can be shared rather than copied
+        interval.info = vcf_record.INFO
 
         if interval.sv_type not in intervals:
             intervals[interval.sv_type] = [interval]
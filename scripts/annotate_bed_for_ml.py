@@ -14,10 +14,10 @@ import random
 from functools import partial
 from itertools import compress
 
-import pysam
 import vcf
 import pybedtools
 from pybedtools.parallel import parallel_apply
+from metasv.coverage_profile import get_coverage_profile
 
 FORMAT = '%(levelname)s %(asctime)-15s %(message)s'
 logging.basicConfig(level=logging.INFO, format=FORMAT)
@@ -99,26 +99,12 @@ def add_weighted_score(in_bed, score_bed):
     return pybedtools.BedTool(bed_array)
 
 
-def annotate_coverage(interval, bam=None):
+def annotate_coverage(interval, profile=None):
     fields = interval.fields
 
-    coverages = []
-    very_good_coverages = []
-    for start in xrange(interval.start, interval.end, 50):
-        end = start + 50
-        this_coverage = 0
-        this_very_good_coverage = 0
-        for aln in bam.fetch(interval.chrom, start, end):
-            if aln.is_duplicate: continue
-            # if aln.mapq < 2 or aln.is_duplicate: continue
-            this_coverage += 1
-
-            if aln.mapq >= 20 and aln.cigar is not None and int(aln.opt("NM")) < 2:
-                total_softclip = sum([length for (op, length) in aln.cigar if op == 4])
-                if total_softclip <= 10: this_very_good_coverage += 1
-
-        coverages.append(this_coverage)
-        very_good_coverages.append(this_very_good_coverage)
+    # Read counts of the 50 bp bins of the precomputed coverage profile overlapping the interval
+    coverages = list(profile.bins(interval.chrom, interval.start, interval.end, "reads"))
+    very_good_coverages = list(profile.bins(interval.chrom, interval.start, interval.end, "very_good_reads"))
 
     min_cov = min(coverages)
     max_cov = max(coverages)
@@ -142,8 +128,8 @@ def annotate_coverage(interval, bam=None):
     return pybedtools.create_interval_from_list(fields)
 
 
-def add_coverage_information(in_bed, bam):
-    return in_bed.each(partial(annotate_coverage, bam=bam))
+def add_coverage_information(in_bed, profile):
+    return in_bed.each(partial(annotate_coverage, profile=profile))
 
 
 pybedtools.set_tempdir(args.tmpdir)
@@ -197,8 +183,10 @@ if args.reference:
     bed_fields += ["GC_CONTENT"]
 
 if args.bam:
-    out_bed = add_coverage_information(out_bed, pysam.Samfile(args.bam, "rb")).saveas(
-        os.path.join(args.tmpdir, "bam.bed"))
+    # The profile is built under the tmpdir if it can't be kept next to the BAM, and removed again on close
+    coverage_profile = get_coverage_profile(args.bam, bin_size=50, fallback_dir=args.tmpdir)
+    out_bed = add_coverage_information(out_bed, coverage_profile).saveas(os.path.join(args.tmpdir, "bam.bed"))
+    coverage_profile.close()
     logger.info("Feature count after BAM %d" % (out_bed.count()))
     bed_fields += ["COVS", "AVG_COV", "MIN_COV", "MAX_COV", "MIN_COV_OVER_AVG_COV", "MAX_COV_OVER_AVG_COV"]
     bed_fields += ["VERY_GOOD_COVS", "AVG_VERY_GOOD_COV", "MIN_VERY_GOOD_COV", "MAX_VERY_GOOD_COV",
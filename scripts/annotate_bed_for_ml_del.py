@@ -96,26 +96,12 @@ def add_weighted_score(in_bed, score_bed):
     return pybedtools.BedTool(bed_array)
 
 
-def annotate_coverage(interval, bam=None):
+def annotate_coverage(interval, profile=None):
     fields = interval.fields
 
-    coverages = []
-    very_good_coverages = []
-    for start in xrange(interval.start, interval.end, 50):
-        end = start + 50
-        this_coverage = 0
-        this_very_good_coverage = 0
-        for aln in bam.fetch(interval.chrom, start, end):
-            if aln.is_duplicate: continue
-            # if aln.mapq < 2 or aln.is_duplicate: continue
-            this_coverage += 1
-
-            if aln.mapq >= 20 and aln.cigar is not None and int(aln.opt("NM")) < 2:
-                total_softclip = sum([length for (op, length) in aln.cigar if op == 4])
-                if total_softclip <= 10: this_very_good_coverage += 1
-
-        coverages.append(this_coverage)
-        very_good_coverages.append(this_very_good_coverage)
+    # Read counts of the 50 bp bins of the precomputed coverage profile overlapping the interval
+    coverages = list(profile.bins(interval.chrom, interval.start, interval.end, "reads"))
+    very_good_coverages = list(profile.bins(interval.chrom, interval.start, interval.end, "very_good_reads"))
 
     min_cov = min(coverages)
     max_cov = max(coverages)
@@ -139,8 +125,8 @@ def annotate_coverage(interval, bam=None):
     return pybedtools.create_interval_from_list(fields)
 
 
-def add_coverage_information(in_bed, bam):
-    return in_bed.each(partial(annotate_coverage, bam=bam))
+def add_coverage_information(in_bed, profile):
+    return in_bed.each(partial(annotate_coverage, profile=profile))
 
 
 pybedtools.set_tempdir(args.tmpdir)
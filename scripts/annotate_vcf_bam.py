@@ -5,8 +5,8 @@ import multiprocessing
 import logging
 import vcf
 import random
-import math
-import pysam
+from metasv.library_stats import get_library_stats
+from metasv.bam_utils import get_bam_handle
 
 
 def annotate_vcfs(bam, chromosomes, vcfs):
@@ -14,7 +14,7 @@ def annotate_vcfs(bam, chromosomes, vcfs):
     random.seed(0)
 
     # Load indexed BAM file
-    sam_file = pysam.Samfile(bam.name, "rb")
+    sam_file = get_bam_handle(bam.name)
 
     if not chromosomes:
         func_logger.info("Chromosome list unspecified. Inferring from the BAMs")
@@ -26,53 +26,18 @@ def annotate_vcfs(bam, chromosomes, vcfs):
         func_logger.error("Chromosome list empty")
         return None
 
-    # Read through samfile and get some statistics
-    # hard code this for now
-    read_limit = 1000
-
-    # this is temporary, needs to read the reference to be sensible
-    # TODODODODODO!!!
-    num_read = 0.0
-    cover_sum = 0.0
-    template_list = list()
-    first_chr = sam_file.getrname(0)
-    for i in xrange(0, read_limit):
-        loc = random.randint(0, 30000000)
-        alignments = sam_file.fetch(first_chr, loc, loc + 1)
-
-        curr_num = 0
-        for aln in alignments:
-            if aln.mapq < 18:
-                continue
-            curr_num += 1
-            cover_sum += 1
-            template_list.append(abs(aln.tlen))
-
-        if curr_num > 0:
-            num_read += 1
-
-    template_list.sort()
-    num_template = float(len(template_list))
-    low_bound = int(math.floor(num_template * 0.05))
-    upp_bound = int(math.ceil(num_template * 0.95))
-
-    insert_count = 0
-    insert_sum = 0.0
-    insert_sq_sum = 0.0
-
-    for i in xrange(low_bound, upp_bound):
-        insert_count += 1
-        insert_sum += template_list[i]
-        insert_sq_sum += template_list[i] * template_list[i]
-
-    mean_coverage = cover_sum / num_read
-    mean_insert_size = insert_sum / insert_count
-    sd_insert_size = math.sqrt((insert_sq_sum / insert_count) - (mean_insert_size * mean_insert_size))
+    # Sample the library statistics over all the chromosomes
+    stats = get_library_stats(bam.name, chromosomes=chromosomes)
+    if stats is None or "isize_mean" not in stats:
+        func_logger.error("Could not estimate library statistics from %s" % bam.name)
+        return None
+
+    mean_coverage = stats["mean_read_coverage"]
+    mean_insert_size = stats["isize_mean"]
+    sd_insert_size = stats["isize_sd"]
     func_logger.info("Estimated coverage mean:      {0:.2f}".format(mean_coverage))
     func_logger.info("Estimated template size mean: {0:.2f}".format(mean_insert_size))
     func_logger.info("Estimated template size sd:   {0:.2f}".format(sd_insert_size))
-    func_logger.info("Estimated template size Q5:   {0:.2f}".format(template_list[low_bound]))
-    func_logger.info("Estimated template size Q95:  {0:.2f}".format(template_list[upp_bound - 1]))
 
     template_upper_bound = mean_insert_size + (3 * sd_insert_size)
     template_lower_bound = mean_insert_size - (3 * sd_insert_size)
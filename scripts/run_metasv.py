@@ -2,6 +2,7 @@
 
 import sys
 import argparse
+import logging
 from metasv.main import run_metasv
 from metasv.defaults import *
 from metasv._version import __version__
@@ -39,7 +40,8 @@ if __name__ == "__main__":
     input_parser.add_argument("--wham_vcf", nargs="+", help="VCF file or dir for WHAM VCFs",
                               default=[])
                               
-    input_parser.add_argument("--mean_read_length", type=float, default=MEAN_READ_LENGTH, help="Mean read length")
+    input_parser.add_argument("--mean_read_length", type=float,
+                              help="Mean read length. Estimated from the BAMs if unspecified, otherwise %d" % MEAN_READ_LENGTH)
 
     reference_parser = parser.add_argument_group("Reference options")
     reference_parser.add_argument("--reference", metavar="reference", help="Reference file", required=True)
@@ -52,9 +54,14 @@ if __name__ == "__main__":
                                   help="Keep only the major contigs + MT")
 
     bam_parser = parser.add_argument_group("Input BAM options")
-    bam_parser.add_argument("--bams", nargs="+", help="BAMs", default=[])
-    bam_parser.add_argument("--isize_mean", type=float, default=ISIZE_MEAN, help="Insert size mean")
-    bam_parser.add_argument("--isize_sd", type=float, default=ISIZE_SD, help="Insert size standard deviation")
+    bam_parser.add_argument("--bams", nargs="+", help="BAMs or CRAMs, CRAMs are decoded against the reference",
+                            default=[])
+    bam_parser.add_argument("--bam_decoding_threads", type=int, default=ALIGNMENT_DECODING_THREADS,
+                            help="Decoding threads per open BAM or CRAM")
+    bam_parser.add_argument("--isize_mean", type=float,
+                            help="Insert size mean. Estimated from the BAMs if unspecified, otherwise %g" % ISIZE_MEAN)
+    bam_parser.add_argument("--isize_sd", type=float,
+                            help="Insert size standard deviation. Estimated from the BAMs if unspecified, otherwise %g" % ISIZE_SD)
 
     merging_parser = parser.add_argument_group("Tool output merging options")
     merging_parser.add_argument("--wiggle", help="Wiggle for interval overlap", default=WIGGLE, type=int)
@@ -82,9 +89,12 @@ if __name__ == "__main__":
     insertion_parser.add_argument("--max_ins_intervals", help="Maximum number of insertion intervals to generate",
                                   type=int,
                                   default=MAX_INTERVALS)
-    insertion_parser.add_argument("--mean_read_coverage", type=float, default=MEAN_READ_COVERAGE, help="Mean read coverage")
+    insertion_parser.add_argument("--mean_read_coverage", type=float,
+                                  help="Mean read coverage. Estimated from the BAMs if unspecified, otherwise %d" % MEAN_READ_COVERAGE)
     insertion_parser.add_argument("--min_ins_cov_frac", type=float, default=MIN_INS_COVERAGE_FRAC, help="Minimum read coverage around the insertion breakpoint.")
     insertion_parser.add_argument("--max_ins_cov_frac", type=float, default=MAX_INS_COVERAGE_FRAC, help="Maximum read coverage around the insertion breakpoint.")
+    insertion_parser.add_argument("--sc_tile_size", type=int, default=SC_TILE_SIZE,
+                                  help="Size of the genomic tiles scanned independently for soft-clips. Use 0 to scan whole chromosomes")
 
 
 
@@ -108,6 +118,8 @@ if __name__ == "__main__":
     as_parser.add_argument("--stop_spades_on_fail", action="store_true", help="Abort on SPAdes failure")
     as_parser.add_argument("--age", help="Path to AGE executable")
     as_parser.add_argument("--age_timeout", help="Maximum time (in seconds) for running AGE on an assembled contig", default=AGE_TIMEOUT, type=int)
+    as_parser.add_argument("--age_procs_per_thread", help="Maximum number of AGE processes each thread keeps running",
+                           default=AGE_PROCS_PER_THREAD, type=int)
     as_parser.add_argument("--min_inv_subalign_len", help="Minimum length of inversion sub-alginment", type=int,
                         default=MIN_INV_SUBALIGN_LENGTH)
     as_parser.add_argument("--min_del_subalign_len", help="Minimum length of deletion sub-alginment", type=int,
@@ -118,8 +130,10 @@ if __name__ == "__main__":
                                   action="store_true")
     gt_parser = parser.add_argument_group("Genotyping options")
     gt_parser.add_argument("--gt_window", type=int, default=GT_WINDOW, help="Window for genotyping")
-    gt_parser.add_argument("--gt_normal_frac", type=float, default=GT_NORMAL_FRAC,
-                           help="Min. fraction of reads supporting reference for genotyping")
+    gt_parser.add_argument("--gt_error_rate", "--gt_normal_frac", dest="gt_error_rate", type=float,
+                           default=GT_ERROR_RATE,
+                           help="Expected fraction of reads of the other allele for homozygous genotypes. "
+                                "--gt_normal_frac is a deprecated alias")
 
     out_parser = parser.add_argument_group("Output options")
     out_parser.add_argument("--svs_to_report", nargs="+", help="SV types to report", default=SVS_SUPPORTED,
@@ -137,6 +151,9 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
+    if any(arg.split("=")[0] == "--gt_normal_frac" for arg in sys.argv[1:]):
+        logging.getLogger(__name__).warn("--gt_normal_frac is deprecated, use --gt_error_rate instead")
+
     args.svs_to_assemble = set(args.svs_to_assemble) & set(args.svs_to_report)
     args.svs_to_softclip = set(args.svs_to_softclip) & set(args.svs_to_report)
     sys.exit(run_metasv(args))